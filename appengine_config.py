@@ -0,0 +1,11 @@
+### App Engine configuration for the TinyWebDB service: packages vendored into lib/
+### (see requirements.txt) are added to the import path, when there are any.
+
+import os
+
+from google.appengine.ext import vendor
+
+LIB = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lib')
+
+if os.path.isdir(LIB):
+  vendor.add(LIB)
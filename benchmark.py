@@ -0,0 +1,205 @@
+### A benchmark of the TinyWebDB service, driving main.application through WSGI
+### in this process against an in-memory storage engine.
+###
+### For each database size and each concurrency level, every scenario is run by
+### that many threads for a few seconds, and one JSON object per line is written
+### with its throughput and latency percentiles, so that runs can be compared
+### by a script. The scenarios are
+###   storeavalue           -- store a value at an existing tag
+###   getvalue              -- get the value of an existing tag
+###   getvalue:<special>    -- get each of *all_tags*, *all_values*,
+###                            *all_timestamps* and *all_entries*
+###   getvalues             -- get the values of 20 existing tags and *all_timestamps*
+###   addentries            -- add an entries file of 100 entries
+###   addentries:large      -- add an entries file of 2000 entries (four batches)
+###   writeentries          -- write out all entries
+###
+### The in-memory engine answers at once, which hides what overlapping storage calls
+### (see Storage.get_multi_async and write_async) saves against the datastore. With
+### --storage-latency, every storage call costs a round trip of that many milliseconds
+### instead, which calls started asynchronously spend in the background; with
+### --compare-pipelining as well, each scenario is also run with asynchronous calls
+### waiting out their round trip at once, as if they were not overlapped.
+###
+### Usage: python benchmark.py [--sizes 100,1000,10000,100000] [--concurrency 1,4,16]
+###                            [--seconds S] [--scenarios NAME,...] [--output FILE]
+###                            [--storage-latency MS [--compare-pipelining]]
+
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+specialTags = ['*all_tags*', '*all_values*', '*all_timestamps*', '*all_entries*']
+addEntriesSize = 100
+largeAddEntriesSize = 2000
+getValuesSize = 20
+
+def tagName(i):
+  return 't%06d' % i
+
+# The scenarios, as (name, function making the next request's (path, params))
+def scenarios(size):
+  def storeAValue(rng):
+    return ('/storeavalue', {'tag': tagName(rng.randrange(size)), 'value': json.dumps([rng.random(), 'x' * 20])})
+  def getValue(rng):
+    return ('/getvalue', {'tag': tagName(rng.randrange(size))})
+  def getSpecial(tag):
+    return lambda rng : ('/getvalue', {'tag': tag})
+  def getValues(rng):
+    tags = [tagName(rng.randrange(size)) for i in range(getValuesSize)] + ['*all_timestamps*']
+    return ('/getvalues', {'tags': json.dumps(tags)})
+  def addEntries(count):
+    def add(rng):
+      first = rng.randrange(size)
+      entries = [[tagName((first + i) % size), i] for i in range(count)]
+      return ('/addentries', {'entriesFile': json.dumps(entries)})
+    return add
+  def writeEntries(rng):
+    return ('/writeentries', {})
+  return ([('storeavalue', storeAValue), ('getvalue', getValue)] +
+          [('getvalue:' + tag, getSpecial(tag)) for tag in specialTags] +
+          [('getvalues', getValues), ('addentries', addEntries(addEntriesSize)),
+           ('addentries:large', addEntries(largeAddEntriesSize)), ('writeentries', writeEntries)])
+
+# A storage engine standing in for a remote one: every call of the wrapped engine
+# costs a round trip of latency seconds. Calls started by get_multi_async and
+# write_async spend it in the background if pipelined, and at once if not.
+class RemoteStorage(object):
+
+  def __init__(self, engine, latency, pipelined):
+    self.engine = engine
+    self.latency = latency
+    self.pipelined = pipelined
+
+  def __getattr__(self, name):
+    attribute = getattr(self.engine, name)
+    if name.startswith('_') or name == 'for_namespace' or not callable(attribute):
+      return attribute
+    def call(*args, **kwargs):
+      time.sleep(self.latency)
+      return attribute(*args, **kwargs)
+    return call
+
+  def get_multi_async(self, tags):
+    return self.started(self.engine.get_multi, list(tags))
+
+  def write_async(self, puts, deletes, atomic=False):
+    return self.started(self.engine.write, puts, deletes, atomic)
+
+  def started(self, function, *args):
+    import storage
+    if not self.pipelined:
+      time.sleep(self.latency)
+      return storage.finished(function, *args)
+    ready = time.time() + self.latency
+    def wait():
+      time.sleep(max(0, ready - time.time()))
+      return function(*args)
+    return storage.Future(wait)
+
+# Make every storage call of the service cost a round trip (see RemoteStorage)
+def useRemoteStorage(main, engine, latency, pipelined):
+  import metrics
+  import namespaces
+  main.store = metrics.InstrumentedStorage(namespaces.NamespacedStorage(RemoteStorage(engine, latency, pipelined)))
+
+# Empty the database and fill it with size entries
+def fill(main, size):
+  main.deleteAllTags()
+  for start in range(0, size, 1000):
+    pairs = [(tagName(i), json.dumps([i, 'value %d' % i])) for i in range(start, min(start + 1000, size))]
+    main.store.put_multi(pairs)
+    main.invalidateValues([tag for (tag, value) in pairs])
+
+def call(main, path, params):
+  import webapp2
+  response = webapp2.Request.blank(path, POST=params).get_response(main.application)
+  body = response.body # Read a streamed body to the end
+  return (response.status_int, len(body))
+
+# Run the scenario with concurrency threads for about seconds seconds (each
+# thread making at least one request), and return its results
+def run(main, name, makeRequest, size, concurrency, seconds):
+  latencies = []
+  errors = [0]
+  lock = threading.Lock()
+  deadline = time.time() + seconds
+  def worker(number):
+    rng = random.Random(number)
+    mine = []
+    failed = 0
+    while True:
+      (path, params) = makeRequest(rng)
+      start = time.time()
+      (status, length) = call(main, path, params)
+      mine.append(time.time() - start)
+      if status != 200:
+        failed += 1
+      if time.time() > deadline:
+        break
+    with lock:
+      latencies.extend(mine)
+      errors[0] += failed
+  threads = [threading.Thread(target=worker, args=(n,)) for n in range(concurrency)]
+  start = time.time()
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  elapsed = time.time() - start
+  latencies.sort()
+  return {'scenario': name, 'size': size, 'concurrency': concurrency,
+          'requests': len(latencies), 'errors': errors[0], 'seconds': round(elapsed, 3),
+          'requests_per_second': round(len(latencies) / elapsed, 1),
+          'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+          'p99_ms': round(percentile(latencies, 99) * 1000, 3)}
+
+def percentile(sortedValues, p):
+  if not sortedValues:
+    return 0.0
+  return sortedValues[min(len(sortedValues) - 1, int(len(sortedValues) * p / 100.0))]
+
+def numbers(text):
+  return [int(n) for n in text.split(',') if n]
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark the TinyWebDB service through WSGI')
+  parser.add_argument('--sizes', type=numbers, default=[100, 1000, 10000, 100000], help='database sizes')
+  parser.add_argument('--concurrency', type=numbers, default=[1, 4, 16], help='numbers of threads')
+  parser.add_argument('--seconds', type=float, default=2, help='time per scenario')
+  parser.add_argument('--scenarios', default='', help='only run these scenarios (comma separated)')
+  parser.add_argument('--output', help='write results to this file rather than to standard output')
+  parser.add_argument('--storage-latency', type=float, default=0, help='milliseconds each storage call takes')
+  parser.add_argument('--compare-pipelining', action='store_true',
+                      help='also run without overlapping asynchronous storage calls')
+  args = parser.parse_args()
+  os.environ.setdefault('TINYWEBDB_STORAGE', 'memory')
+  os.environ.setdefault('TINYWEBDB_CACHE', 'local')
+  import logging
+  logging.getLogger().setLevel(logging.WARNING) # The handlers log every request at info level
+  import main as service
+  engine = service.store.storage.storage # Under the metrics and namespace wrappers
+  pipelining = [True, False] if args.compare_pipelining and args.storage_latency else [True]
+  wanted = set(name for name in args.scenarios.split(',') if name)
+  output = open(args.output, 'w') if args.output else sys.stdout
+  for size in args.sizes:
+    for (name, makeRequest) in scenarios(size):
+      if wanted and name not in wanted:
+        continue
+      for concurrency in args.concurrency:
+        for pipelined in pipelining:
+          if args.storage_latency:
+            useRemoteStorage(service, engine, args.storage_latency / 1000.0, pipelined)
+          fill(service, size) # Afresh, as storeavalue and addentries change it
+          result = run(service, name, makeRequest, size, concurrency, args.seconds)
+          result['storage_latency_ms'] = args.storage_latency
+          result['pipelined'] = pipelined
+          output.write(json.dumps(result, sort_keys=True) + '\n')
+          output.flush()
+
+if __name__ == '__main__':
+  main()
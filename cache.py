@@ -0,0 +1,305 @@
+### A bounded read-through cache of stored entries for GetValue.
+###
+### ValueCache keeps up to max_size values in a local LRU, each for at most
+### ttl seconds. When it is given a memcache client it also keeps the values
+### there, so that instances share them: a local miss is looked up in memcache
+### before the caller goes to storage, and invalidating a tag drops it from both.
+### Other instances may serve a value from their local LRU up to ttl seconds
+### after it has been invalidated here, so ttl should stay small when memcache is
+### used. Values stay in memcache for at most shared_ttl seconds.
+###
+### Each tag also has a generation in memcache, which every invalidation bumps.
+### A value is put in memcache together with the generation read before it was
+### read from storage, and only if memcache holds no value yet (add, not set), and
+### it is only served while the generation is unchanged. So a value read by one
+### instance before another one wrote and invalidated the tag is never served
+### from memcache, however the two interleave.
+###
+### Writers must call invalidate (or invalidate_multi) for every tag they
+### change. The hit, miss and eviction counters are reported by stats().
+
+import collections
+import threading
+import time
+
+try:
+  from google.appengine.api import memcache
+except ImportError:
+  memcache = None # Only the local tier is available outside App Engine
+
+GENERATION_PREFIX = 'generation:'
+
+# The generation a tag starts at when memcache holds none for it (never having had
+# one, or having lost it): the time in milliseconds, so that it does not repeat one
+# that values still in memcache may carry
+def initialGeneration():
+  return int(time.time() * 1000)
+
+# Returned by get when the cache holds nothing for a tag
+MISSING = object()
+
+# The characters an item of VersionedCache or LRUCache is counted as holding
+# beyond its own, for what Python keeps with every string
+ITEM_OVERHEAD = 50
+
+def itemChars(item):
+  return len(item) + ITEM_OVERHEAD
+
+class ValueCache(object):
+
+  def __init__(self, max_size=1000, ttl=5, memcache_client=None, shared_ttl=60, prefix='value:'):
+    self.max_size = max_size
+    self.ttl = ttl
+    self.memcache = memcache_client
+    self.shared_ttl = shared_ttl
+    self.prefix = prefix
+    self.lock = threading.Lock()
+    self.entries = collections.OrderedDict() # tag -> (value, expiry time), oldest first
+    self.invalidations = 0 # Bumped by every invalidation; see fill
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  # Return the value cached for tag, or MISSING.
+  def get(self, tag):
+    now = time.time()
+    with self.lock:
+      item = self.entries.get(tag)
+      if item is not None:
+        if item[1] > now:
+          del self.entries[tag] # Move to the most recently used end
+          self.entries[tag] = item
+          self.hits += 1
+          return item[0]
+        del self.entries[tag] # Expired
+    if self.memcache is not None:
+      found = self.memcache.get_multi([self.prefix + tag, GENERATION_PREFIX + tag])
+      cached = found.get(self.prefix + tag)
+      if cached is not None and len(cached) == 2 and cached[1] == found.get(GENERATION_PREFIX + tag):
+        with self.lock:
+          self.hits += 1
+          self.remember(tag, cached[0], now)
+        return cached[0]
+      if cached is not None: # Read before the tag was last invalidated
+        self.memcache.delete(self.prefix + tag)
+    with self.lock:
+      self.misses += 1
+    return MISSING
+
+  # The token to pass to fill after reading tags from storage. Take it before
+  # reading them.
+  def token(self, tags=()):
+    with self.lock:
+      invalidations = self.invalidations
+    generations = None
+    if self.memcache is not None and tags:
+      generations = self.memcache.offset_multi(dict((tag, 0) for tag in tags), key_prefix=GENERATION_PREFIX,
+                                               initial_value=initialGeneration())
+    return (invalidations, generations)
+
+  # Cache value (read from storage) for tag, unless it might be stale: locally,
+  # if some tag has been invalidated here since token was taken, and in memcache,
+  # if the tag has been invalidated anywhere since (see the top of this file).
+  def fill(self, tag, value, token):
+    (invalidations, generations) = token
+    with self.lock:
+      if invalidations != self.invalidations:
+        return
+      self.remember(tag, value, time.time())
+    generation = generations.get(tag) if generations else None
+    if generation is not None:
+      self.memcache.add(self.prefix + tag, (value, generation), time=self.shared_ttl)
+
+  # Must hold the lock
+  def remember(self, tag, value, now):
+    if tag in self.entries:
+      del self.entries[tag]
+    self.entries[tag] = (value, now + self.ttl)
+    while len(self.entries) > self.max_size:
+      self.entries.popitem(last=False)
+      self.evictions += 1
+
+  def invalidate(self, tag):
+    self.invalidate_multi([tag])
+
+  def invalidate_multi(self, tags):
+    tags = list(tags)
+    with self.lock:
+      self.invalidations += 1
+      for tag in tags:
+        self.entries.pop(tag, None)
+    if self.memcache is not None and tags:
+      self.memcache.offset_multi(dict((tag, 1) for tag in tags), key_prefix=GENERATION_PREFIX,
+                                 initial_value=initialGeneration())
+      self.memcache.delete_multi(tags, key_prefix=self.prefix)
+
+  def stats(self):
+    with self.lock:
+      return {'size': len(self.entries), 'max_size': self.max_size, 'ttl': self.ttl,
+              'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+# Results computed from the whole database, each kept together with the change
+# version of the storage engine (see Storage.version) it was computed at. A
+# result is reused until the version changes, so reading it costs no storage
+# work when nothing has changed. Results are lists of strings, which together hold
+# at most max_chars characters (see itemChars): the least recently used results
+# are dropped to make room, and a result larger than that is not kept at all, so
+# that memory stays bounded on large databases.
+#
+# Where queries may not yet reflect a write for some seconds after it (see
+# Storage.settle_seconds), a result is only kept if it was computed once its
+# version had been current for settle seconds, as far as this cache has seen: one
+# computed sooner might miss the write that made the version, and would then be
+# served until the next write.
+class VersionedCache(object):
+
+  def __init__(self, max_chars=10000000, settle=0):
+    self.max_chars = max_chars
+    self.settle = settle
+    self.lock = threading.Lock()
+    self.results = collections.OrderedDict() # name -> (version, result, chars), oldest first
+    self.chars = 0
+    self.seen = {} # name -> (version, when it was first seen)
+    self.hits = 0
+    self.misses = 0
+
+  # Whether a result called name computed now at version may be kept
+  def settled(self, name, version):
+    if version is None:
+      return False
+    if not self.settle:
+      return True
+    now = time.time()
+    with self.lock:
+      seen = self.seen.get(name)
+      if seen is None or seen[0] != version:
+        seen = self.seen[name] = (version, now)
+    return now - seen[1] >= self.settle
+
+  # Return the result called name at version, calling build() to compute it
+  # if the one kept is for another version.
+  def get(self, name, version, build):
+    kept = self.kept(name, version)
+    if kept is not None:
+      return kept
+    settled = self.settled(name, version)
+    result = build()
+    self.keep(name, version if settled else None, result)
+    return result
+
+  # Iterate over the items of the result called name at version: the kept
+  # ones, or else those of the iterable items, which are kept along the way
+  # unless they turn out to hold more than max_chars characters.
+  def stream(self, name, version, items):
+    kept = self.kept(name, version)
+    if kept is not None:
+      for item in kept:
+        yield item
+      return
+    if not self.settled(name, version):
+      version = None # Not to be kept
+    result = []
+    chars = 0
+    for item in items:
+      if result is not None:
+        result.append(item)
+        chars += itemChars(item)
+        if chars > self.max_chars:
+          result = None
+      yield item
+    self.keep(name, version, result)
+
+  # The result called name kept for version, or None
+  def kept(self, name, version):
+    if version is None:
+      return None
+    with self.lock:
+      kept = self.results.get(name)
+      if kept is None or kept[0] != version:
+        return None
+      del self.results[name] # Move to the most recently used end
+      self.results[name] = kept
+      self.hits += 1
+      return kept[1]
+
+  def keep(self, name, version, result):
+    chars = sum(itemChars(item) for item in result) if result is not None else 0
+    with self.lock:
+      self.misses += 1
+      old = self.results.pop(name, None)
+      if old is not None:
+        self.chars -= old[2]
+      if version is None or result is None or chars > self.max_chars:
+        return
+      self.results[name] = (version, result, chars)
+      self.chars += chars
+      while self.chars > self.max_chars:
+        (_, (_, _, dropped)) = self.results.popitem(last=False)
+        self.chars -= dropped
+
+  def stats(self):
+    with self.lock:
+      return {'results': len(self.results), 'chars': self.chars, 'max_chars': self.max_chars,
+              'hits': self.hits, 'misses': self.misses}
+
+# A map of strings that forgets its least recently used items once they hold
+# more than max_chars characters (see itemChars), and never keeps a string larger
+# than that. Nothing is ever invalidated, so a key must determine its value: a tag
+# together with the date its entry was written, say.
+class LRUCache(object):
+
+  def __init__(self, max_chars=1000000):
+    self.max_chars = max_chars
+    self.lock = threading.Lock()
+    self.items = collections.OrderedDict() # key -> value, oldest first
+    self.chars = 0
+    self.hits = 0
+    self.misses = 0
+
+  # Return the value kept for key, or None
+  def get(self, key):
+    with self.lock:
+      value = self.items.pop(key, None)
+      if value is None:
+        self.misses += 1
+        return None
+      self.items[key] = value # Move to the most recently used end
+      self.hits += 1
+      return value
+
+  def put(self, key, value):
+    chars = itemChars(value)
+    with self.lock:
+      old = self.items.pop(key, None)
+      if old is not None:
+        self.chars -= itemChars(old)
+      if chars > self.max_chars:
+        return
+      self.items[key] = value
+      self.chars += chars
+      while self.chars > self.max_chars:
+        (_, dropped) = self.items.popitem(last=False)
+        self.chars -= itemChars(dropped)
+
+  def stats(self):
+    with self.lock:
+      return {'size': len(self.items), 'chars': self.chars, 'max_chars': self.max_chars,
+              'hits': self.hits, 'misses': self.misses}
+
+# Build the value cache described by spec, which is one of
+#   none       -- no caching
+#   local      -- a local LRU only
+#   memcache   -- a local LRU backed by memcache (the default on App Engine)
+def make_value_cache(spec, max_size, ttl):
+  if not spec:
+    spec = 'memcache' if memcache is not None else 'local'
+  if spec == 'none':
+    return None
+  elif spec == 'local':
+    return ValueCache(max_size, ttl)
+  elif spec == 'memcache':
+    if memcache is None:
+      raise ValueError('memcache is only available on App Engine')
+    return ValueCache(max_size, ttl, memcache.Client())
+  else:
+    raise ValueError('unknown value cache: %s' % spec)
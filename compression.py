@@ -0,0 +1,105 @@
+### Compressed responses for the TinyWebDB service.
+###
+### compress wraps the WSGI application so that JSON, MessagePack, text and HTML
+### responses of at least TINYWEBDB_COMPRESS_MIN_SIZE bytes (1024 by default) are
+### sent gzip (or deflate) encoded to clients that accept it. Streamed responses are
+### compressed as they are streamed, and only as much of them is held back as
+### is needed to see whether they reach the minimum size.
+
+import itertools
+import os
+import zlib
+
+import httpheaders
+
+minSize = int(os.environ.get('TINYWEBDB_COMPRESS_MIN_SIZE', '1024'))
+
+LEVEL = 6
+# The zlib window bits giving each encoding's format
+WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+COMPRESSIBLE_TYPES = ('application/jsonrequest', 'application/json', 'application/x-msgpack', 'text/')
+
+# Wrap the WSGI application so that large responses are compressed
+def compress(application):
+
+  def compressed(environ, start_response):
+    encoding = acceptedEncoding(environ.get('HTTP_ACCEPT_ENCODING', ''))
+    if encoding is None:
+      return application(environ, start_response)
+    response = []
+    def startResponse(status, headers, exc_info=None):
+      if exc_info is not None and response:
+        raise exc_info[0], exc_info[1], exc_info[2]
+      response[:] = [status, headers]
+      return writeNotSupported
+    body = application(environ, startResponse)
+    return compressedBody(body, encoding, response, start_response)
+
+  return compressed
+
+def writeNotSupported(data):
+  raise NotImplementedError('compress does not support the WSGI write callable')
+
+# The encoding to use for a request with the given Accept-Encoding header, or None
+def acceptedEncoding(acceptEncoding):
+  accepted = dict(httpheaders.qualityValues(acceptEncoding))
+  for encoding in ('gzip', 'deflate'):
+    if accepted.get(encoding, 0) > 0:
+      return encoding
+  return None
+
+def compressedBody(body, encoding, response, start_response):
+  try:
+    chunks = iter(body)
+    buffered = []
+    size = 0
+    for chunk in chunks:
+      buffered.append(chunk)
+      size += len(chunk)
+      if size >= minSize:
+        break
+    (status, headers) = response
+    if not compressible(status, headers):
+      start_response(status, headers)
+      for chunk in itertools.chain(buffered, chunks):
+        yield chunk
+      return
+    headers = headers + [('Vary', 'Accept-Encoding')]
+    if size < minSize: # The whole body is in buffered
+      start_response(status, headers)
+      for chunk in buffered:
+        yield chunk
+      return
+    start_response(status, compressedHeaders(headers, encoding))
+    compressor = zlib.compressobj(LEVEL, zlib.DEFLATED, WBITS[encoding])
+    for chunk in itertools.chain(buffered, chunks):
+      data = compressor.compress(chunk)
+      if data:
+        yield data
+    yield compressor.flush()
+  finally:
+    if hasattr(body, 'close'):
+      body.close()
+
+def compressible(status, headers):
+  if not status.startswith('200'):
+    return False
+  contentType = ''
+  for (name, value) in headers:
+    if name.lower() == 'content-encoding':
+      return False
+    elif name.lower() == 'content-type':
+      contentType = value.lower()
+  return contentType.startswith(COMPRESSIBLE_TYPES)
+
+# The headers of a response once it is compressed: without its length, and with a
+# weak ETag, as the compressed body is not byte for byte the one the ETag was made for
+def compressedHeaders(headers, encoding):
+  result = [('Content-Encoding', encoding)]
+  for (name, value) in headers:
+    if name.lower() == 'content-length':
+      continue
+    elif name.lower() == 'etag' and not value.startswith('W/'):
+      value = 'W/' + value
+    result.append((name, value))
+  return result
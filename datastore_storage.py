@@ -0,0 +1,442 @@
+### The App Engine datastore storage engine (see storage.py).
+###
+### Each StoredData entity uses (an encoding of) its tag as its key name, so
+### reads and writes are direct key lookups rather than GQL queries on the tag
+### property, and are strongly consistent. Entities written by older versions
+### of this service have numeric ids instead; migrate_to_key_names re-keys them.
+### Until it has, lookups that miss fall back to a query on the tag property (see
+### DatastoreStorage.legacyLookup), so that existing entries stay readable.
+### Large values may be stored compressed (see storage.encodeValue).
+### A deleted entry leaves a Tombstone child entity, in the entry's entity group,
+### the start of the last truncation is kept in a Truncation entity, and the date
+### before which tombstones have been pruned in a Pruning entity. The change feed
+### queries StoredData and Tombstone entities by date, through the built-in single
+### property indexes. Like all non-ancestor queries, these are eventually consistent,
+### and the dates come from the clocks of the instances that wrote the entities, so
+### the feed only reports changes once they are settle_seconds old (see
+### Storage.changes). A change that takes longer than that to show up in queries,
+### or is dated by a clock running further behind, is missed by a client that has
+### already been given a later position.
+### Each namespace (see namespaces.py) is a datastore namespace, which also holds
+### its change version in memcache. Legacy entities only exist in the default one.
+### Independent datastore calls are made as asynchronous RPCs that overlap: the put
+### and delete batches of a write, and the queries of the change feed.
+
+import datetime
+import itertools
+import os
+import time
+
+from google.appengine.api import datastore
+from google.appengine.api import memcache
+from google.appengine.ext import db
+from google.appengine.ext.db import metadata
+
+from storage import Entry, Future, Storage, WriteFailed, datePosition, encodeValue, positionDate
+
+TAG_PAGE_SIZE = 1000
+# While legacy entities remain, whether they still do is checked again at most
+# every LEGACY_CHECK_SECONDS
+LEGACY_CHECK_SECONDS = 60
+# The most entities the datastore puts or deletes in one call
+BATCH_SIZE = 500
+
+# The change version lives in memcache rather than in an entity, which every
+# write would contend on. If memcache loses it, it restarts from the current
+# time in microseconds, well past any version handed out before.
+VERSION_KEY = 'StoredData:version'
+
+class StoredData(db.Model):
+  tag = db.StringProperty()
+  ## value = db.StringProperty(multiline=True)
+  ## defining value as a string property limits individual values to 500
+  ## characters.   To remove this limit, define value to be a text
+  ## property instead, by commenting out the previous line
+  ## and replacing it by this one:
+  value = db.TextProperty()
+  date = db.DateTimeProperty(required=True, auto_now=True)
+
+# Left by a deleted entry, as the child (named TOMBSTONE_NAME) of its key
+class Tombstone(db.Model):
+  tag = db.StringProperty()
+  date = db.DateTimeProperty(required=True, auto_now=True)
+
+# The single entity (named TRUNCATION_NAME) holding the date the last truncation started
+class Truncation(db.Model):
+  date = db.DateTimeProperty(required=True)
+
+# The single entity (named TRUNCATION_NAME) holding the date before which tombstones
+# have been pruned
+class Pruning(db.Model):
+  date = db.DateTimeProperty(required=True)
+
+TOMBSTONE_NAME = 'deleted'
+TRUNCATION_NAME = 'last'
+
+# Key names may not be empty or of the form __*__, but tags may. Such tags
+# (and, to keep the encoding one-to-one, tags that start with '=') get a '='
+# prefix. The tag property always holds the tag itself.
+def keyName(tag):
+  if tag == '' or tag.startswith('=') or (tag.startswith('__') and tag.endswith('__')):
+    return '=' + tag
+  return tag
+
+def keyFor(tag, namespace=''):
+  return db.Key.from_path('StoredData', keyName(tag), namespace=namespace)
+
+def tombstoneKey(tag, namespace=''):
+  return db.Key.from_path('StoredData', keyName(tag), 'Tombstone', TOMBSTONE_NAME, namespace=namespace)
+
+def tombstoneFor(tag, namespace=''):
+  return Tombstone(key = tombstoneKey(tag, namespace), tag = tag)
+
+def truncationKey(namespace=''):
+  return db.Key.from_path('Truncation', TRUNCATION_NAME, namespace=namespace)
+
+def pruningKey(namespace=''):
+  return db.Key.from_path('Pruning', TRUNCATION_NAME, namespace=namespace)
+
+# The tag of a key named by keyName
+def keyTag(key):
+  name = key.name()
+  if name.startswith('='):
+    return name[1:]
+  return name
+
+class DatastoreStorage(Storage):
+
+  # Every tag (with its tombstone) is its own entity group, and a cross-group
+  # transaction may touch at most 25 of them.
+  max_atomic_tags = 25
+
+  # Queries other than ancestor queries are eventually consistent
+  settle_seconds = 5
+
+  # legacy_lookup (or the TINYWEBDB_LEGACY_KEYS environment variable, 1 or 0)
+  # forces the fallback for legacy entities on or off. By default it is on for
+  # as long as legacy entities are found (see legacyLookup).
+  def __init__(self, legacy_lookup=None, namespace=''):
+    if legacy_lookup is None:
+      legacy_lookup = {'1': True, '0': False}.get(os.environ.get('TINYWEBDB_LEGACY_KEYS'))
+    if namespace:
+      legacy_lookup = False # Legacy entities only exist in the default namespace
+    self.legacy_lookup = legacy_lookup
+    self.legacyFound = None # Whether legacy entities were found at the last check
+    self.legacyChecked = 0
+    self.namespace = namespace
+
+  def for_namespace(self, namespace):
+    if namespace == self.namespace:
+      return self
+    return DatastoreStorage(self.legacy_lookup, namespace)
+
+  # Whether legacy (id-keyed) entities may remain, in which case lookups that miss
+  # fall back to a query on the tag property, writes replace the old entity, and
+  # scans drop a legacy entity listed next to a keyed one for the same tag. Unless
+  # forced, this is found by looking at the first key: keys with ids sort before
+  # keys with names. Once none remain, none are ever written again.
+  def legacyLookup(self):
+    if self.legacy_lookup is not None:
+      return self.legacy_lookup
+    if self.legacyFound is not False and time.time() - self.legacyChecked >= LEGACY_CHECK_SECONDS:
+      first = StoredData.all(keys_only=True).order('__key__').get()
+      self.legacyFound = first is not None and first.name() is None
+      self.legacyChecked = time.time()
+    return self.legacyFound
+
+  def query(self, model, **options):
+    return model.all(namespace=self.namespace, **options)
+
+  def legacyEntities(self, tag):
+    return [e for e in db.GqlQuery("SELECT * FROM StoredData where tag = :1", tag)
+            if e.key().name() is None]
+
+  def get(self, tag):
+    entity = StoredData.get(keyFor(tag, self.namespace))
+    if entity is None and self.legacyLookup():
+      legacy = self.legacyEntities(tag)
+      if legacy:
+        entity = legacy[0]
+    return modelEntry(entity)
+
+  def get_multi(self, tags):
+    tags = list(tags)
+    if not tags:
+      return []
+    entities = StoredData.get([keyFor(tag, self.namespace) for tag in tags])
+    if self.legacyLookup():
+      return [modelEntry(e) if e else self.get(tag) for (tag, e) in zip(tags, entities)]
+    return [modelEntry(e) for e in entities]
+
+  def get_multi_async(self, tags):
+    tags = list(tags)
+    if not tags or self.legacyLookup():
+      return Storage.get_multi_async(self, tags)
+    rpc = db.get_async([keyFor(tag, self.namespace) for tag in tags])
+    return Future(lambda : [modelEntry(e) for e in rpc.get_result()])
+
+  def put(self, tag, value):
+    return self.put_multi([(tag, value)])[0]
+
+  def put_multi(self, pairs):
+    return self.write(pairs, [])
+
+  def delete(self, tag):
+    self.delete_multi([tag])
+
+  def delete_multi(self, tags):
+    self.write([], tags)
+
+  def write(self, puts, deletes, atomic=False):
+    return self.write_async(puts, deletes, atomic).get_result()
+
+  # Deletes put tombstones and puts delete them, in the same batches. Outside a
+  # transaction, all the put and delete batches are sent at once, and the write
+  # has finished when they all have.
+  def write_async(self, puts, deletes, atomic=False):
+    stored = [StoredData(key = keyFor(tag, self.namespace), tag = tag, value = encodeValue(value))
+              for (tag, value) in puts]
+    entities = stored + [tombstoneFor(tag, self.namespace) for tag in deletes]
+    keys = ([keyFor(tag, self.namespace) for tag in deletes] +
+            [tombstoneKey(tag, self.namespace) for (tag, value) in puts])
+    if atomic:
+      if len(puts) + len(deletes) > self.max_atomic_tags:
+        raise WriteFailed('an atomic write may touch at most %d tags' % self.max_atomic_tags)
+      def apply():
+        db.put(entities)
+        db.delete(keys)
+      try:
+        db.run_in_transaction_options(db.create_transaction_options(xg=True), apply)
+      except db.TransactionFailedError as error:
+        raise WriteFailed(str(error))
+      rpcs = []
+    else:
+      rpcs = ([db.put_async(entities[i:i + BATCH_SIZE]) for i in range(0, len(entities), BATCH_SIZE)] +
+              [db.delete_async(keys[i:i + BATCH_SIZE]) # Deleting a missing key is not an error
+               for i in range(0, len(keys), BATCH_SIZE)])
+    def wait():
+      for rpc in rpcs:
+        rpc.get_result()
+      if self.legacyLookup():
+        self.deleteLegacy([tag for (tag, value) in puts] + list(deletes))
+      self.changed()
+      return [modelEntry(e) for e in stored]
+    return Future(wait)
+
+  def deleteLegacy(self, tags):
+    keys = []
+    for tag in tags:
+      keys.extend([e.key() for e in self.legacyEntities(tag)])
+    if keys:
+      db.delete(keys)
+
+  def scan(self, start=None, end=None):
+    query = self.query(StoredData).order("tag") # Orders lo to hi. Use "-tag" to order from hi to lo
+    if start is not None:
+      query.filter("tag >=", start)
+    if end is not None:
+      query.filter("tag <", end)
+    entries = (modelEntry(e) for e in query)
+    if self.legacyLookup():
+      return newestEntries(entries)
+    return entries
+
+  # Datastore query cursors
+  def scan_page(self, start=None, end=None, limit=100, cursor=None):
+    query = self.query(StoredData).order("tag")
+    if start is not None:
+      query.filter("tag >=", start)
+    if end is not None:
+      query.filter("tag <", end)
+    if cursor:
+      try:
+        query.with_cursor(cursor)
+      except db.BadValueError:
+        raise ValueError('bad cursor: %s' % cursor)
+    entities = query.fetch(limit)
+    page = [modelEntry(e) for e in entities]
+    if self.legacyLookup():
+      page = list(newestEntries(page))
+    if len(entities) < limit:
+      return (page, None)
+    return (page, query.cursor())
+
+  # A projection query on tag is answered from the index alone, a page of
+  # TAG_PAGE_SIZE tags per round trip.
+  def tags(self, start=None, end=None):
+    query = db.Query(StoredData, projection=('tag',), namespace=self.namespace).order("tag")
+    if start is not None:
+      query.filter("tag >=", start)
+    if end is not None:
+      query.filter("tag <", end)
+    tags = (e.tag for e in query.run(batch_size=TAG_PAGE_SIZE))
+    if self.legacyLookup():
+      return (tag for (tag, same) in itertools.groupby(tags))
+    return tags
+
+  # Call after every write
+  def changed(self):
+    memcache.incr(VERSION_KEY, initial_value=initialVersion(), namespace=self.namespace)
+
+  def version(self):
+    version = memcache.get(VERSION_KEY, namespace=self.namespace)
+    if version is None:
+      memcache.add(VERSION_KEY, initialVersion(), namespace=self.namespace)
+      version = memcache.get(VERSION_KEY, namespace=self.namespace) # Still None if memcache is unavailable
+    return version
+
+  def migrate_keys(self, batch_size, cursor=None):
+    if self.namespace:
+      return (0, None)
+    return migrate_to_key_names(batch_size, cursor)
+
+  # A keys-only query on date finds the entities (legacy ones included) stored no
+  # later than the start of the truncation, which the first batch records, without
+  # reading them, and they are deleted BATCH_SIZE at a time. Entities stored while
+  # the truncation goes on are dated after its start, so they are kept. The cursor
+  # holds the start (as a change feed position) and a query cursor, so a later
+  # call runs the same query, and does not meet deleted entities the index still lists.
+  def truncate(self, batch_size, cursor=None):
+    if cursor:
+      try:
+        (position, queryCursor) = cursor.split(':', 1)
+        started = positionDate(int(position))
+      except ValueError:
+        raise ValueError('bad cursor: %s' % cursor)
+    else:
+      started = datetime.datetime.utcnow()
+      Truncation(key = truncationKey(self.namespace), date = started).put()
+    query = self.query(StoredData, keys_only=True).filter('date <=', started).order('date')
+    if cursor:
+      try:
+        query.with_cursor(queryCursor)
+      except db.BadValueError:
+        raise ValueError('bad cursor: %s' % cursor)
+    keys = query.fetch(batch_size)
+    rpcs = [db.delete_async(keys[i:i + BATCH_SIZE]) for i in range(0, len(keys), BATCH_SIZE)]
+    for rpc in rpcs:
+      rpc.get_result()
+    if keys or not cursor:
+      self.changed()
+    tags = [keyTag(key) for key in keys if key.name() is not None] # Legacy keys have no tag
+    if len(keys) < batch_size:
+      return (len(keys), tags, None)
+    return (len(keys), tags, '%d:%s' % (datePosition(started), query.cursor()))
+
+  # Running a query sends its first RPC at once, so both queries run together
+  def changes_after(self, date, limit):
+    stored = self.query(StoredData).filter('date >', date).order('date').run(limit=limit)
+    deleted = self.query(Tombstone).filter('date >', date).order('date').run(limit=limit)
+    return changeEntries(list(stored), list(deleted))[:limit]
+
+  def changes_at(self, date):
+    stored = self.query(StoredData).filter('date =', date).run()
+    deleted = self.query(Tombstone).filter('date =', date).run()
+    return changeEntries(list(stored), list(deleted))
+
+  def truncated_at(self):
+    truncation = Truncation.get(truncationKey(self.namespace))
+    return truncation.date if truncation else None
+
+  # A keys-only query on date finds the tombstones, and each is deleted in a
+  # transaction of its entity group, unless the tag has been deleted again since
+  # (which replaces the tombstone with a newer one). The cursor is a query cursor.
+  def prune_tombstones(self, before, batch_size, cursor=None):
+    if cursor is None:
+      pruning = Pruning.get(pruningKey(self.namespace))
+      if pruning is None or pruning.date < before:
+        Pruning(key = pruningKey(self.namespace), date = before).put()
+    query = self.query(Tombstone, keys_only=True).filter('date <', before).order('date')
+    if cursor:
+      try:
+        query.with_cursor(cursor)
+      except db.BadValueError:
+        raise ValueError('bad cursor: %s' % cursor)
+    keys = query.fetch(batch_size)
+    for key in keys:
+      db.run_in_transaction(deleteIfBefore, key, before)
+    if len(keys) < batch_size:
+      return (len(keys), None)
+    return (len(keys), query.cursor())
+
+  def pruned_at(self):
+    pruning = Pruning.get(pruningKey(self.namespace))
+    return pruning.date if pruning else None
+
+  def namespaces(self):
+    return metadata.get_namespaces()
+
+# The changes (see Storage.changes) of the StoredData and Tombstone entities,
+# ordered by date and then by tag
+def changeEntries(stored, deleted):
+  changes = [modelEntry(e) for e in stored if e.tag is not None]
+  changes.extend(Entry(t.tag, None, t.date) for t in deleted)
+  changes.sort(key=lambda e : (e.date, e.tag))
+  return changes
+
+# Delete the tombstone with key if it was made before the date before. Must run in
+# a transaction.
+def deleteIfBefore(key, before):
+  tombstone = db.get(key)
+  if tombstone is not None and tombstone.date < before:
+    db.delete(key)
+
+# Put the raw entity copy unless the entity with its key has been written since
+# copy's date. Must run in a transaction.
+def putIfNewer(copy):
+  current = db.get(copy.key())
+  if current is None or current.date < copy['date']:
+    datastore.Put(copy)
+
+# Of each run of entries (ordered by tag) with the same tag, the most recently written:
+# a keyed entity and the legacy entity a write has not yet replaced
+def newestEntries(entries):
+  for (tag, same) in itertools.groupby(entries, lambda e : e.tag):
+    yield max(same, key=lambda e : e.date)
+
+def initialVersion():
+  return int(time.time() * 1000000)
+
+def modelEntry(entity):
+  if entity is None:
+    return None
+  return Entry(entity.tag, entity.value, entity.date)
+
+# Re-key up to batch_size legacy (id-keyed) StoredData entities so that they use
+# their tag as key name, starting at cursor. Returns (number re-keyed, next cursor),
+# where the next cursor is None once no legacy entities remain.
+#
+# Keys with ids sort before keys with names, so a key-ordered scan meets all
+# legacy entities first and can stop at the first named key. The copies are
+# written as raw entities so that the auto_now date is kept. When there are
+# several entities for one tag, the most recently written one wins. Each copy
+# is a compare-and-set on the date of the keyed entity, made in a transaction
+# on that entity alone, so a store that races with the migration is never
+# overwritten by an older legacy value.
+def migrate_to_key_names(batch_size=100, cursor=None):
+  query = StoredData.all().order('__key__')
+  if cursor:
+    query.with_cursor(cursor)
+  batch = query.fetch(batch_size)
+  legacy = [e for e in batch if e.key().name() is None]
+  done = len(legacy) < batch_size
+  newest = {}
+  for e in legacy:
+    if e.tag is not None and (e.tag not in newest or e.date > newest[e.tag].date):
+      newest[e.tag] = e
+  tags = newest.keys()
+  current = dict(zip(tags, StoredData.get_by_key_name([keyName(tag) for tag in tags]) if tags else []))
+  for tag in tags:
+    old = newest[tag]
+    if current[tag] is not None and current[tag].date >= old.date:
+      continue # Already rewritten under its key name since
+    copy = datastore.Entity('StoredData', name = keyName(tag))
+    copy['tag'] = tag
+    copy['value'] = db.Text(old.value) if old.value is not None else None
+    copy['date'] = old.date
+    db.run_in_transaction(putIfNewer, copy)
+  if legacy:
+    db.delete([e.key() for e in legacy])
+  if done:
+    return (len(legacy), None)
+  return (len(legacy), query.cursor())
@@ -0,0 +1,211 @@
+### A streaming parser for entries files, as read by AddEntriesFromFile.
+###
+### An entries file is a JSON list of tag/value pairs, where each pair is a
+### two-element list whose first element (the tag) is a string. EntriesParser
+### reads such a file a block at a time and yields the pairs one by one as it
+### finds them, checking each as it goes, so memory is bounded by the largest
+### entry rather than by the whole file. It stops at the first problem by
+### raising EntriesError, which says what is wrong and where.
+
+import json
+import re
+
+# Number of characters read from the file at a time
+READ_SIZE = 65536
+
+# The characters that matter while skipping over a JSON list or object
+STRUCTURE = re.compile(r'["\[\]{}]')
+# The characters that end a JSON number, true, false or null
+SCALAR_END = re.compile(r'[\s,\[\]{}"]')
+WHITESPACE = ' \t\n\r'
+
+# Raised for an entries file that is not a JSON list of tag/value pairs.
+# kind is one of
+#   empty                    -- the file is empty
+#   malformed                -- the file is not well-formed JSON (detail says why)
+#   database_not_a_list      -- the file holds a JSON value other than a list
+#   entry_not_a_list         -- an entry is not a list
+#   entry_not_a_pair         -- an entry is a list without exactly two elements
+#   entry_tag_not_a_string   -- the first element of an entry is not a string
+# entry is the offending value (if any), and line and column (both counted
+# from 1) locate the start of the problem in the file.
+class EntriesError(Exception):
+
+  def __init__(self, kind, entry=None, line=None, column=None, detail=None):
+    Exception.__init__(self, kind, entry, line, column, detail)
+    self.kind = kind
+    self.entry = entry
+    self.line = line
+    self.column = column
+    self.detail = detail
+
+class EntriesParser(object):
+
+  def __init__(self, fileobj):
+    self.file = fileobj
+    self.buffer = ''
+    self.pos = 0 # Index in buffer of the next character to parse
+    self.line = 1 # Position of buffer[pos] in the file
+    self.column = 1
+    self.eof = False
+    self.count = 0 # Number of entries yielded so far
+
+  # Iterate over the [tag, value] pairs of the file, raising EntriesError at
+  # the first problem. Pairs before the problem have already been yielded.
+  def entries(self):
+    self.skipWhitespace()
+    if self.peek() == '':
+      raise EntriesError('empty', line=self.line, column=self.column)
+    if self.peek() != '[':
+      (value, line, column) = self.value()
+      self.end()
+      raise EntriesError('database_not_a_list', value, line, column)
+    self.advance(1)
+    self.skipWhitespace()
+    if self.peek() == ']':
+      self.advance(1)
+    else:
+      while True:
+        (entry, line, column) = self.value()
+        if type(entry) != list:
+          raise EntriesError('entry_not_a_list', entry, line, column)
+        elif len(entry) != 2:
+          raise EntriesError('entry_not_a_pair', entry, line, column)
+        elif not isinstance(entry[0], basestring):
+          raise EntriesError('entry_tag_not_a_string', entry, line, column)
+        self.count += 1
+        yield entry
+        self.skipWhitespace()
+        c = self.peek()
+        if c == ']':
+          self.advance(1)
+          break
+        elif c != ',':
+          self.malformed("expected ',' or ']' after an entry")
+        self.advance(1)
+        self.skipWhitespace()
+    self.end()
+
+  # Check that nothing but whitespace is left
+  def end(self):
+    self.skipWhitespace()
+    if self.peek() != '':
+      self.malformed('extra data after the list of entries')
+
+  def malformed(self, detail, line=None, column=None):
+    if line is None:
+      (line, column) = (self.line, self.column)
+    if self.peek() == '' and self.eof:
+      detail = 'unexpected end of file'
+    raise EntriesError('malformed', None, line, column, detail)
+
+  ## Reading
+
+  # The next character, or '' at the end of the file
+  def peek(self):
+    while self.pos >= len(self.buffer):
+      if not self.more():
+        return ''
+    return self.buffer[self.pos]
+
+  # Read another block, dropping what has been parsed already. Returns False
+  # at the end of the file. Afterwards self.pos is 0.
+  def more(self):
+    if self.eof:
+      return False
+    data = self.file.read(READ_SIZE)
+    self.buffer = self.buffer[self.pos:] + data
+    self.pos = 0
+    if not data:
+      self.eof = True
+      return False
+    return True
+
+  # Move past the next n characters, keeping track of line and column
+  def advance(self, n):
+    text = self.buffer[self.pos:self.pos + n]
+    newlines = text.count('\n')
+    if newlines:
+      self.line += newlines
+      self.column = n - text.rfind('\n')
+    else:
+      self.column += n
+    self.pos += n
+
+  def skipWhitespace(self):
+    while self.peek() != '' and self.buffer[self.pos] in WHITESPACE:
+      self.advance(1)
+
+  # Parse the next JSON value, returning (value, line, column). Only the text
+  # of this one value is held while it is found and decoded.
+  def value(self):
+    (line, column) = (self.line, self.column)
+    c = self.peek()
+    if c == '':
+      self.malformed('expected a value')
+    if c in '[{':
+      length = self.structureLength()
+    elif c == '"':
+      length = self.stringLength(0)
+    else:
+      length = self.scalarLength()
+    text = self.buffer[self.pos:self.pos + length]
+    try:
+      value = json.loads(text)
+    except ValueError as error:
+      self.malformed(str(error), line, column)
+    self.advance(length)
+    return (value, line, column)
+
+  # The length of the list or object starting at buffer[pos]. Brackets are
+  # only counted here; whether they match is checked when the text is decoded.
+  def structureLength(self):
+    depth = 0
+    offset = 0
+    while True:
+      match = STRUCTURE.search(self.buffer, self.pos + offset)
+      if match is None:
+        offset = len(self.buffer) - self.pos
+        if not self.more():
+          self.malformed('unexpected end of file')
+        continue
+      offset = match.start() - self.pos
+      c = match.group()
+      if c == '"':
+        offset = self.stringLength(offset)
+      elif c in '[{':
+        depth += 1
+        offset += 1
+      else:
+        depth -= 1
+        offset += 1
+        if depth == 0:
+          return offset
+
+  # The offset just past the end of the string that starts at buffer[pos + offset]
+  def stringLength(self, offset):
+    offset += 1
+    while True:
+      end = self.buffer.find('"', self.pos + offset)
+      if end == -1:
+        offset = len(self.buffer) - self.pos
+        if not self.more():
+          self.malformed('unexpected end of file')
+        continue
+      backslashes = 0
+      while self.buffer[end - 1 - backslashes] == '\\':
+        backslashes += 1
+      offset = end - self.pos + 1
+      if backslashes % 2 == 0: # Otherwise the quote is escaped
+        return offset
+
+  # The length of the number, true, false or null starting at buffer[pos]
+  def scalarLength(self):
+    offset = 0
+    while True:
+      match = SCALAR_END.search(self.buffer, self.pos + offset)
+      if match is not None:
+        return max(match.start() - self.pos, 1)
+      offset = len(self.buffer) - self.pos
+      if not self.more():
+        return offset
@@ -0,0 +1,63 @@
+### Reply formats for the TinyWebDB service.
+###
+### Replies are made for App Inventor: JSON sent as application/jsonrequest, with
+### top-level string values wrapped in an extra pair of quotes (see
+### addExtraQuotesExpectedByAppInventor in main.py), or with fmt=html, a web page.
+### Other programs can ask for
+###   + plain JSON (application/json), without the extra quotes, with fmt=json or
+###     an Accept header preferring application/json, or
+###   + MessagePack (application/x-msgpack), which is smaller and quicker to parse,
+###     with fmt=msgpack or an Accept header preferring application/x-msgpack (or
+###     application/msgpack). This needs the msgpack package: without it, fmt=msgpack
+###     is answered with 406 Not Acceptable, and the Accept header is ignored.
+###     App Engine does not provide it, so it is vendored into lib/ before deploying
+###     (appengine_config.py adds lib/ to the import path), in its pure Python form:
+###       MSGPACK_PUREPYTHON=1 pip install -t lib -r requirements.txt
+### A request that replies in one format only never gets 406; one that replies in
+### either is refused before it does anything else.
+### GetValue (special tags included), /getvalues, /getprefix, /changes and
+### /writeentries reply in either; other requests reply in (plain) JSON to both.
+
+import httpheaders
+
+try:
+  import msgpack
+except ImportError:
+  msgpack = None # Only JSON replies
+
+PHONE = 'phone'
+HTML = 'html'
+JSON = 'json'
+MSGPACK = 'msgpack'
+
+CONTENT_TYPES = {PHONE: 'application/jsonrequest', JSON: 'application/json',
+                 MSGPACK: 'application/x-msgpack'}
+# The format each media type of an Accept header asks for
+ACCEPTED_TYPES = {'application/json': JSON, 'application/x-msgpack': MSGPACK,
+                  'application/msgpack': MSGPACK}
+
+def available(format):
+  return format != MSGPACK or msgpack is not None
+
+# The format of the reply to a request with the given fmt parameter and Accept
+# header, or None if fmt asks for a format that is not available. An Accept header
+# only chooses among the formats for machine clients; App Inventor and browsers
+# do not name them, and get what they always have.
+def negotiate(fmt, accept):
+  if fmt in (JSON, MSGPACK):
+    return fmt if available(fmt) else None
+  elif fmt == HTML:
+    return HTML
+  elif fmt:
+    return PHONE
+  best = (0, PHONE)
+  for (mediaType, quality) in httpheaders.qualityValues(accept):
+    format = ACCEPTED_TYPES.get(mediaType)
+    if format is not None and available(format) and quality > best[0]:
+      best = (quality, format)
+  return best[1]
+
+# The MessagePack encoding of value (made of what JSON can hold). Strings are
+# packed as str, as replies never hold binary data.
+def packed(value):
+  return msgpack.packb(value, use_bin_type=False)
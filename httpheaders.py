@@ -0,0 +1,18 @@
+### Parsing of HTTP request headers for the TinyWebDB service.
+
+import re
+
+# The items of a header that lists them with quality values (Accept,
+# Accept-Encoding), lower case, each with its quality (1.0 if it has none)
+def qualityValues(header):
+  for item in header.split(','):
+    parts = item.strip().split(';')
+    quality = 1.0
+    for parameter in parts[1:]:
+      match = re.match(r'\s*q\s*=\s*([0-9.]+)\s*$', parameter)
+      if match:
+        try:
+          quality = float(match.group(1))
+        except ValueError:
+          quality = 0.0
+    yield (parts[0].strip().lower(), quality)
@@ -60,19 +60,105 @@
 ### and should be fixed, perhaps by returning new JSON_VALUE that does the right thing!
 ### Note that this only affects top-level strings, and strings within lists are fine. 
 
+### All reads and writes now go through a pluggable storage engine (storage.py)
+### rather than through inline GQL queries. The TINYWEBDB_STORAGE environment variable
+### selects the engine: the App Engine datastore (the default), or a local SQLite
+### or in-memory database for load tests and self-hosted nodes.
+### In the datastore, entries are keyed by tag, so reads and writes are key lookups;
+### /migratekeys re-keys entities stored by older versions of this service.
+### *all_tags* is no longer a single JSON list entity that every new tag rewrites.
+### The ordered tag index of the storage engine is the tag list, so storing or
+### deleting a tag costs O(1) and *all_tags* is read by paging through that index.
+### GetValue reads regular tags through a bounded LRU/TTL cache of parsed values
+### (cache.py), optionally backed by memcache, which all writes invalidate.
+### *all_values*, *all_timestamps* and *all_entries* are kept together with the change
+### version of the storage engine, and only rebuilt after something has been stored or deleted.
+### *all_entries* and /writeentries are streamed rather than built in memory, and accept
+### limit and cursor parameters to return one page of entries at a time.
+### AddEntries writes entries with batched puts. When a file is too large to store
+### within one request, the rest is split into task queue chunks stored by /addentriestask.
+### Entries files are parsed as a stream that is checked as it is read (entriesparser.py),
+### so AddEntries no longer holds the whole file, and errors are reported with line and column.
+### /getvalues returns the values of a JSON list of tags with one batched lookup, and
+### /storevalues stores (or deletes) a JSON list of tag/value pairs with one batched write.
+### Values are stored as JSON text, and that text is what the phone gets: GetValue,
+### /getvalues and the *all_...* tags splice it into their replies without parsing it.
+### The main page shows the table a page at a time, can be filtered by tag prefix, is
+### streamed as it renders, and reuses the HTML of rows whose entries have not changed.
+### /metrics reports request latencies and response sizes by handler, storage calls
+### (overall and per request) and special tag use, in the Prometheus text format.
+### Requests are traced (tracing.py): a sample of them, and every slow one, is logged with
+### the time spent parsing, in storage calls and writing the response. Only short previews
+### of values are logged, rather than whole values and uploaded files.
+### GetValue replies carry an ETag (and, for regular tags, the Last-Modified date of the
+### entry) and answer conditional requests with 304 Not Modified. The special tags are
+### versioned by the change version of the storage engine. /getvalue also takes GETs with
+### a tag parameter, which caches can revalidate.
+### Large JSON, text and HTML responses are gzip (or deflate) encoded for clients that
+### accept it (compression.py), and with TINYWEBDB_COMPRESS_VALUES set, large values
+### are stored compressed and only decompressed when they are read (storage.py).
+### Deleting all tags no longer reads every entry and deletes them one at a time. The
+### entries are deleted in batches found by keys-only scans, and on a database too large
+### to empty within one request, the rest is deleted by /truncate tasks.
+### /changes is a change feed: given the position of its last reply, a client gets the
+### tags stored or deleted since then (found by date, deleted tags by their tombstones),
+### and with wait, the request is held until something changes (a long poll), so clients
+### no longer need to poll GetValue to see whether anything has changed. Changes are
+### reported once queries are sure to reflect them, and tombstones are kept for a week,
+### pruned daily by /prunetombstones (cron.yaml), after which older positions get 410 Gone.
+### /getprefix returns the entries whose tags start with a prefix (or lie in a start/end
+### range) as *all_entries* triples, read by a range scan of the tag index, so that a
+### group of tags costs what the group holds rather than what the whole database does.
+### Apps sharing a deployment can keep their data apart in namespaces (namespaces.py),
+### chosen by a /ns/<namespace>/ prefix of the service URL or a namespace parameter. Each
+### namespace has its own entries, tag index and change version, so *all_...* tags, the
+### main page, deleting all tags and /writeentries only touch that namespace's entries.
+### Links and forms in the web pages are relative, so they stay within the namespace.
+### Storage calls that do not depend on each other overlap: a write's put and delete
+### batches go out together, AddEntries reads the next batch while the last one is
+### written, and /getvalues builds special tags while its lookup is under way.
+### Tags that are stored many times a second can be named in TINYWEBDB_WRITE_BEHIND, so that
+### /storeavalue only buffers their latest values, which are written out together in one
+### batch once they have waited TINYWEBDB_WRITE_BEHIND_INTERVAL seconds, and by /flushwrites.
+### On automatically scaled App Engine instances that takes another request (writebehind.py).
+### Programs other than App Inventor can ask for plain JSON replies, without the extra
+### quotes around top-level strings, or for MessagePack ones (formats.py), with fmt=json or
+### fmt=msgpack or an Accept header: GetValue, /getvalues, /getprefix, /changes and /writeentries.
+### Tags stored by older versions of this service stay readable until /migratekeys has
+### re-keyed them, which it now does for the whole database, carrying on in tasks.
+
 import webapp2 # [lyn, 2014/11/24] updating to latest webapp
+import webob.datetime_utils
 import jinja2 # [lyn, 2014/11/24] updating to latest templates
 import os # [lyn, 2014/11/30] added
 import logging
 from cgi import escape
 # # from google.appengine.ext import webapp
 # # from google.appengine.ext.webapp.util import run_wsgi_app
-from google.appengine.ext import db
-# from google.appengine.ext.db import Key
+# from google.appengine.ext import db -- now only used by datastore_storage.py
 # [lyn, 2014/11/11] No longer works in Python 2.7: 
 #   from django.utils import simplejson as json
 import json
 import time
+import datetime
+import hashlib
+import urllib
+import itertools
+import StringIO
+import collections
+import storage
+import cache
+import entriesparser
+import compression
+import metrics
+import tracing
+import namespaces
+import writebehind
+import formats
+try:
+  from google.appengine.api import taskqueue
+except ImportError:
+  taskqueue = None # Outside App Engine, AddEntries always stores everything in the request
 
 JINJA_ENVIRONMENT = jinja2.Environment(
    loader=jinja2.FileSystemLoader(os.path.dirname(__file__)),
@@ -90,21 +176,97 @@ deleteValue = "*delete*"
 specialValues = [deleteValue]
 serverName = "alltags-deletable-tinywebdb"
 
-class StoredData(db.Model):
-  tag = db.StringProperty()
-  ## value = db.StringProperty(multiline=True)
-  ## defining value as a string property limits individual values to 500
-  ## characters.   To remove this limit, define value to be a text
-  ## property instead, by commenting out the previous line
-  ## and replacing it by this one:
-  value = db.TextProperty()
-  date = db.DateTimeProperty(required=True, auto_now=True)
-
+# The storage engine holding all tag/value entries (see storage.py), with its calls
+# counted and timed for /metrics. Calls go to the engine of the namespace of the
+# request (see namespaces.py). Stores of the tags matching TINYWEBDB_WRITE_BEHIND
+# are buffered and written out in batches (see writebehind.py for what that risks).
+store = metrics.InstrumentedStorage(namespaces.NamespacedStorage(writebehind.wrap(
+  storage.make_storage(os.environ.get('TINYWEBDB_STORAGE', 'datastore')),
+  os.environ.get('TINYWEBDB_WRITE_BEHIND'),
+  float(os.environ.get('TINYWEBDB_WRITE_BEHIND_INTERVAL', '1')),
+  int(os.environ.get('TINYWEBDB_WRITE_BEHIND_SIZE', '100')),
+  lambda namespace, tags : invalidateFlushed(namespace, tags))))
+
+# Read-through cache of stored entries in front of store (see cache.py), or None.
+# Every write must invalidate the tags it changes (see invalidateValues). Entries
+# are cached by namespaces.cacheKey(tag), as are the results of aggregateCache.
+valueCache = cache.make_value_cache(os.environ.get('TINYWEBDB_CACHE'),
+                                    int(os.environ.get('TINYWEBDB_CACHE_SIZE', '1000')),
+                                    int(os.environ.get('TINYWEBDB_CACHE_TTL', '5')))
+
+# The *all_tags*, *all_values*, *all_timestamps* and *all_entries* results, by change
+# version, holding at most aggregateCacheChars characters in all. Results computed
+# before queries reflect the last write are not kept.
+aggregateCacheChars = 10 * 1000 * 1000
+aggregateCache = cache.VersionedCache(aggregateCacheChars, store.settle_seconds)
+
+# Entry dates are GMT datetimes without a time zone
+UTC = webob.datetime_utils.UTC
+
+# The largest page that limit may ask for in paginated requests
+maxPageSize = 1000
+
+# The main page shows mainPageSize entries per page unless asked for another limit.
+# The HTML of rows is kept for reuse, up to rowCacheChars characters in all.
+mainPageSize = 100
+rowCacheChars = 5 * 1000 * 1000
+rowCache = cache.LRUCache(rowCacheChars)
+
+# AddEntries stores entries in batches of addEntriesBatchSize (the most the datastore
+# takes in one batch put). After addEntriesTimeBudget seconds it stops, leaving the
+# rest to tasks, each of which carries at most taskPayloadSize characters of entries.
+addEntriesBatchSize = 500
+addEntriesTimeBudget = 30 # App Engine requests have a 60 second deadline
+taskPayloadSize = 90000 # Tasks are limited to 100KB
+addEntriesEchoLimit = 100 # The number of added entries AddEntries lists
+
+# The most tags a batch request may name (the datastore looks up at most 1000 keys at once)
+maxBatchTags = 1000
+
+# /migratekeys re-keys migrateBatchSize entities at a time. After migrateTimeBudget
+# seconds it stops, leaving the rest to tasks.
+migrateBatchSize = 100
+migrateTimeBudget = 30
+
+# Deleting all tags deletes truncateBatchSize entries at a time. After truncateTimeBudget
+# seconds it stops, leaving the rest to /truncate tasks.
+truncateBatchSize = 1000
+truncateTimeBudget = 30
+
+# A long poll of /changes waits at most maxChangesWait seconds, checking the change
+# version of the storage engine every changesPollInterval seconds.
+maxChangesWait = 50 # App Engine requests have a 60 second deadline
+changesPollInterval = 0.5
+
+# /prunetombstones (run daily by cron.yaml) deletes the tombstones of entries deleted
+# more than tombstoneDays days ago, pruneBatchSize at a time. After pruneTimeBudget
+# seconds it stops, leaving the rest to tasks. Change feed clients whose position is
+# older than that must start over (see Changes).
+tombstoneDays = 7
+pruneBatchSize = 100
+pruneTimeBudget = 30
+
+# The main page shows the table a page at a time (limit and cursor parameters, as for
+# *all_entries*), optionally only the tags starting with the prefix parameter. The page
+# is streamed out as the template renders it.
 class MainPage(webapp2.RequestHandler):
   def get(self):
+    prefix = self.request.get('prefix')
+    limit = pageLimit(self) or mainPageSize
+    cursor = self.request.get('cursor') or None
+    try:
+      (entries, nextCursor) = store.scan_page(prefix or None, storage.prefixEnd(prefix) if prefix else None, limit, cursor)
+    except ValueError:
+      self.abort(400)
+    nextPageURL = ''
+    if nextCursor:
+      nextPageURL = escape('?' + urllib.urlencode({'prefix': prefix.encode('utf-8'), 'limit': limit, 'cursor': nextCursor}), True)
     self.response.headers['Content-Type'] = 'text/html'
     template = JINJA_ENVIRONMENT.get_template('index.html')
-    self.response.write(template.render({"tableEntries":  stored_entries_HTML()}))
+    tableRows = stored_entries_HTML(entries, cursor is None and not prefix, cursor is None and nextCursor is None)
+    self.response.app_iter = bufferedChunks(template.generate({"tableRows": tableRows,
+                                                               "prefix": escape(prefix, True),
+                                                               "nextPageURL": nextPageURL}))
 
 ########################################
 ### Implementing the operations
@@ -119,19 +281,22 @@ class MainPage(webapp2.RequestHandler):
 class StoreAValue(webapp2.RequestHandler):
 
   def store_a_value(self, tag, value):
-    logging.info('***info:store_a_value(%s,%s)***' % (tag,value))
+    # Values can be large, so only a preview of them is logged (see tracing.py)
+    logging.info('***info:store_a_value(%s,%s)***', tag, tracing.preview(value))
     extra_message = ''
     try:
-      pythonValue = json.loads(value)  # [lyn, 2011/11/25] Need the loads here to prevent stringification of value. 
-                                       # This correctly handles values from AppInventor and inputs on web page entered in JSON form 
-      logging.info('***try succeeed for %s***' % value)
+      with tracing.span('parse', value=tracing.preview(value)):
+        pythonValue = json.loads(value)  # [lyn, 2011/11/25] Need the loads here to prevent stringification of value. 
+                                         # This correctly handles values from AppInventor and inputs on web page entered in JSON form 
     except ValueError:
       extra_message = '''
       {value} is not in not in <a href="http://www.w3schools.com/json/json_syntax.asp">JSON form</a>.
       Treating it as if it were entered as "{value}".<br><br>
       '''.format(value=value)
       pythonValue = value # This is a fallback when input on web page is not in JSON form. Treat it as plain string. 
-      logging.info('***try failed for %s***' % value)
+      logging.info('***try failed for %s***', tracing.preview(value))
+    if tag in specialTags:
+      metrics.countSpecialTag(tag, 'store')
     if tag in specialNonAllKeysTags: 
       # Do not allow storing anything in *all_values*, *all_timestamps*, or *all_entries*
       WritePhoneOrWeb(self, '', lambda : json.dump(["CANNOT_STORE", tag, pythonValue], self.response.out))
@@ -145,26 +310,8 @@ class StoreAValue(webapp2.RequestHandler):
         self.store_a_regular_value(tag, json.dumps(pythonValue), pythonValue, extra_message)
 
   def store_a_regular_value(self, tag, stringValue, pythonValue, prolog):
-    ## There are potential readers/writers errors here :(
-    allKeysEntry = db.GqlQuery("SELECT * FROM StoredData where tag = :1", allKeysTag).get()
-    if allKeysEntry:
-      keyListString = allKeysEntry.value
-      keyList = json.loads(keyListString)
-      if not tag in keyList: # avoid duplicates
-         keyList.append(tag)
-         keyList.sort()  # keep key list sorted (could use insertion to be more efficient)
-         allKeysEntry.value = json.dumps(keyList) # only update text rep of value if there's a new key
-         allKeysEntry.put()
-    else: 
-      singletonList = [tag]
-      allKeysEntry = StoredData(tag = allKeysTag, value = json.dumps(singletonList)) # text rep of list with single key
-      allKeysEntry.put()
-    entry = db.GqlQuery("SELECT * FROM StoredData where tag = :1", tag).get()
-    if entry:
-      entry.value = stringValue
-    else: 
-      entry = StoredData(tag = tag, value = stringValue)
-    entry.put()
+    store.put(tag, stringValue) # The tag index is updated along with the entry
+    invalidateValues([tag])
     ## Send back a confirmation message.  The TinyWebDB component ignores
     ## the message (other than to note that it was received), but other
     ## components might use this.
@@ -182,24 +329,9 @@ class StoreAValue(webapp2.RequestHandler):
       self.delete_regular_tag(tag)
 
   def delete_regular_tag(self, tag):
-    ## There are potential readers/writers errors here :(
-
-    ## Delete tag from database
-    entry = db.GqlQuery("SELECT * FROM StoredData where tag = :1", tag).get()
-    if entry:
-      entry_key_string = str(entry.key())
-      key = db.Key(entry_key_string)
-      db.run_in_transaction(dbSafeDelete,key)
-
-    ## Delete tag from key list
-    allKeysEntry = db.GqlQuery("SELECT * FROM StoredData where tag = :1", allKeysTag).get()
-    if allKeysEntry:
-      keyListString = allKeysEntry.value
-      keyList = json.loads(keyListString)
-      if tag in keyList: 
-         keyList.remove(tag)
-         allKeysEntry.value = json.dumps(keyList) # only update text rep of value if there's a new key
-         allKeysEntry.put()
+    ## Delete tag from database (and so from the tag index)
+    store.delete(tag)
+    invalidateValues([tag])
 
     ## Return a JSON result
     result = ["STORED", tag, deleteValue]
@@ -208,23 +340,18 @@ class StoreAValue(webapp2.RequestHandler):
     WritePhoneOrWeb(self, '', lambda : json.dump(result, self.response.out))
 
   def delete_all_tags(self):
-    entries = StoredData.all().order("-tag")
-    for e in entries:
-      entry_key_string = str(e.key())
-      tag = escape(e.tag)
-      value = escape(e.value)
-      if tag == allKeysTag:
-         e.value = json.dumps([])
-         e.put()
-      else:
-        key = db.Key(entry_key_string)
-        db.run_in_transaction(dbSafeDelete,key)
+    (deleted, remaining) = deleteAllTags(time.time() + truncateTimeBudget)
+    prolog = ''
+    if remaining:
+      prolog = '''
+      {deleted} entries have been deleted. The rest are being deleted in the background.<br><br>
+      '''.format(deleted=deleted)
 
     ## Return a JSON result
     result = ["STORED", allKeysTag, deleteValue]
     if self.request.get('fmt') == "html":
       result = escapeJSON(result) # escape HTML markers 
-    WritePhoneOrWeb(self, '', lambda : json.dump(result, self.response.out))
+    WritePhoneOrWeb(self, prolog, lambda : json.dump(result, self.response.out))
 
   def post(self):
     tag = self.request.get('tag')
@@ -234,7 +361,7 @@ class StoreAValue(webapp2.RequestHandler):
   def get(self):
     self.response.out.write('''
     <html><body>
-    <form action="/storeavalue" method="post"
+    <form action="storeavalue" method="post"
           enctype=application/x-www-form-urlencoded>
        <p>Tag:&nbsp;<input type="text" name="tag" /> (A tag is a string, but it should *not* be enclosed in quotes --- e.g., color rather than "color" or 'color'.)</p>
        <p>Value:&nbsp;<input type="text" name="value" /> (You must use <a href="http://www.w3schools.com/json/json_syntax.asp">JSON encoding</a> for values -- e.g., "red" rather than red or 'red', [1, "two"] rather than [1, two], etc. Use the special value "*delete*" to delete an entry.) </p>
@@ -246,82 +373,303 @@ class GetValue(webapp2.RequestHandler):
 
   def get_value(self, tag):
     logging.info('info:get_value(%s)\n' % tag)
-    if tag == allValuesTag:
-      pythonValue = self.allValuesValue()
-    elif tag == allTimestampsTag:
-      pythonValue = self.allTimestampsValue()
-    elif tag == allEntriesTag:
-      pythonValue = self.allEntriesValue()
+    format = replyFormat(self)
+    if tag in specialTags:
+      metrics.countSpecialTag(tag, 'get')
+      ## Special tags change whenever anything is stored or deleted
+      if notModified(self, versionTag(self, tag, store.version()), None):
+        return
+    if tag == allEntriesTag:
+      return self.write_all_entries(format)
+    elif tag in specialTags:
+      valueJSON = specialValueJSON(tag)
     else:
-      entry = db.GqlQuery("SELECT * FROM StoredData where tag = :1", tag).get()
-      if entry:
-        pythonValue = json.loads(entry.value)
-      else: 
-        if tag == allKeysTag:
-          pythonValue = []
-        else: 
-          pythonValue = ""
+      entry = storedEntry(tag)
+      date = entry.date if entry else None
+      if notModified(self, versionTag(self, tag, date), date):
+        return
+      valueJSON = entryText(entry) or '""'
     ## We tag the returned result with "VALUE".  The TinyWebDB
     ## component makes no use of this, but other programs might.
     ## check if it is a html request and if so clean the tag and value variables
     # logging.info("self.request.get('fmt') = %s" % self.request.get('fmt'))
     # [lyn, 2014/12/14] It turns out AppInventor expects top level strings to have extra quotes
-    # (or else it won't correctly handled strings with spaces and commas). Take care of this here.
-    result = ["VALUE", tag, addExtraQuotesExpectedByAppInventor(pythonValue)]
-    if self.request.get('fmt') == "html":
-      result = escapeJSON(result) # escape HTML markers 
+    # (or else it won't correctly handled strings with spaces and commas). phoneValueJSON
+    # takes care of this. Clients that asked for plain JSON or MessagePack get the value as it is.
+    if format == formats.MSGPACK:
+      return WriteMessagePack(self, ["VALUE", tag, json.loads(valueJSON)])
+    if format != formats.JSON:
+      valueJSON = phoneValueJSON(valueJSON)
+    if format == formats.HTML:
+      result = escapeJSON(["VALUE", tag, json.loads(valueJSON)]) # escape HTML markers 
       # logging.info('escapeJSON(result) = %s' % result)
-    WritePhoneOrWeb(self, '', lambda : json.dump(result, self.response.out))
+      WritePhoneOrWeb(self, '', lambda : json.dump(result, self.response.out))
+    else:
+      ## The phone gets the stored JSON text as it is, without it being parsed and re-encoded
+      WritePhoneOrWeb(self, '', lambda : self.response.out.write(utf8('["VALUE", %s, %s]' % (json.dumps(tag), valueJSON))))
 
-  # Returns a list of values for all the tags in *all_keys* (which do not include special tags).
-  def allValuesValue(self):
-    # logging.info("allValuesValue")
-    entries = StoredData.all().order("tag") # Orders lo to hi. Use "-tag" to order from hi to lo
-    result = [] 
-    for e in entries:
-      if e.tag != allKeysTag: 
-        # logging.info('allValuesValue: entry tag = ' + e.tag + '; entry value = ' + e.value)
-        pythonValue = json.loads(e.value)
-        # logging.info('allValuesValue: pythonValue = ' + str(pythonValue))
-        result.append(pythonValue)
-    return result
-
-  # Returns a list of timestamps for all the tags in *all_keys* (which do not include special tags).
-  def allTimestampsValue(self):
-    entries = StoredData.all().order("tag") # Orders lo to hi. Use "-tag" to order from hi to lo
-    result = [] 
-    for e in entries:
-      if e.tag != allKeysTag: 
-#        result.append(e.date.ctime())
-         result.append(timeString(e.date))
-    return result
-
-  # Returns a list of all tag/value/timestamp triples, 
+  # Writes the list of all tag/value/timestamp triples, 
   # where a triple is a three-element list [<key>,<value>,<timestamp>]
   # The keys do not include special tags.
-  def allEntriesValue(self):
-    entries = StoredData.all().order("tag") # Orders lo to hi. Use "-tag" to order from hi to lo
-    result = [] 
-    for e in entries:
-      if e.tag != allKeysTag: 
-#       result.append([e.tag,json.loads(e.value),e.date.ctime()])
-        result.append([e.tag,json.loads(e.value),timeString(e.date)])
-    return result
+  # The list is streamed out rather than built up in memory. With a limit parameter,
+  # only one page of triples is returned, followed by the cursor for the next page
+  # (null after the last page): ["VALUE", "*all_entries*", <triples>, <cursor>]
+  def write_all_entries(self, format):
+    limit = pageLimit(self)
+    html = format == formats.HTML
+    if limit is None:
+      texts = aggregateCache.stream(namespaces.cacheKey(allEntriesTag), store.version(), allEntriesTexts())
+      if format == formats.MSGPACK: # MessagePack replies are built in memory
+        return WriteMessagePack(self, ["VALUE", allEntriesTag, [json.loads(t) for t in texts]])
+      if html:
+        texts = (json.dumps(escapeJSON(json.loads(t))) for t in texts) # escape HTML markers 
+      StreamPhoneOrWeb(self, '', valueListChunks(allEntriesTag, texts))
+    else:
+      (entries, nextCursor) = scanPage(self, limit)
+      entries = [e for e in entries if e.tag != allKeysTag]
+      if format == formats.MSGPACK:
+        WriteMessagePack(self, ["VALUE", allEntriesTag, [entryTriple(e) for e in entries], nextCursor])
+      elif html:
+        result = escapeJSON(["VALUE", allEntriesTag, [entryTriple(e) for e in entries], nextCursor]) # escape HTML markers 
+        WritePhoneOrWeb(self, '', lambda : json.dump(result, self.response.out))
+      else:
+        StreamPhoneOrWeb(self, '', valueListChunks(allEntriesTag, [entryTripleJSON(e) for e in entries], [nextCursor]))
 
   def post(self):
     tag = self.request.get('tag')
     self.get_value(tag)
 
+  # With a tag parameter, a GET gets a value as a POST does, but can be cached. As
+  # webapp2 responses say Cache-Control: no-cache, caches revalidate (see notModified).
   def get(self):
+    if 'tag' in self.request.GET:
+      return self.get_value(self.request.get('tag'))
     self.response.out.write('''
     <html><body>
-    <form action="/getvalue" method="post"
+    <form action="getvalue" method="post"
           enctype=application/x-www-form-urlencoded>
        <p>Tag:&nbsp;<input type="text" name="tag" /> (A tag is a string, but it should *not* be enclosed in quotes --- e.g., color rather than "color" or 'color'. Special tags are *all_tags*, *all_values*, *all_timestamps*, and *all_entries".)</p>
        <input type="hidden" name="fmt" value="html">
        <input type="submit" value="Get value">
     </form></body></html>\n''')
 
+# Store several tag/value pairs at once. The entries parameter is a JSON list of
+# tag/value pairs, as in an entries file, except that values may be *delete*. Each
+# pair is treated as /storeavalue would treat it, and the result is the list of what
+# /storeavalue would return for each pair: ["STORED", <tag>, <value>] or
+# ["CANNOT_STORE", <tag>, <value>]. When a tag appears more than once, its last pair
+# wins. All stores and deletes are made in one batched write; with atomic=true, that
+# write is a transaction, which can involve at most store.max_atomic_tags tags, and
+# which stores nothing (every result being CANNOT_STORE) if it fails.
+class StoreValues(webapp2.RequestHandler):
+
+  def store_values(self, pairs, atomic):
+    logging.info('info:store_values(%d pairs)' % len(pairs))
+    results = []
+    writes = collections.OrderedDict() # tag -> JSON text of value, or None to delete
+    deleteAll = False
+    for (tag, pythonValue) in pairs:
+      if tag in specialTags:
+        metrics.countSpecialTag(tag, 'store')
+      if tag in specialNonAllKeysTags or (tag == allKeysTag and (pythonValue != deleteValue or atomic)):
+        # Do not allow storing anything in *all_values*, *all_timestamps*, or *all_entries*,
+        # or anything other than *delete* in *all_tags* (and not that in an atomic write)
+        results.append(["CANNOT_STORE", tag, pythonValue])
+        continue
+      results.append(["STORED", tag, pythonValue])
+      if tag == allKeysTag: # Deleting all tags cancels earlier pairs
+        deleteAll = True
+        writes.clear()
+      elif pythonValue == deleteValue:
+        writes[tag] = None
+      else:
+        writes[tag] = json.dumps(pythonValue)
+    if atomic and store.max_atomic_tags is not None and len(writes) > store.max_atomic_tags:
+      self.abort(400, 'an atomic write may involve at most %d tags' % store.max_atomic_tags)
+    if deleteAll:
+      # Within the time budget, as for *delete* alone; a task that deletes the rest
+      # keeps the pairs written below, as they are stored after the deletion started
+      deleteAllTags(time.time() + truncateTimeBudget)
+    puts = [(tag, value) for (tag, value) in writes.items() if value is not None]
+    deletes = [tag for (tag, value) in writes.items() if value is None]
+    try:
+      store.write(puts, deletes, atomic)
+    except storage.WriteFailed as failure:
+      logging.info('info:store_values atomic write failed: %s' % failure)
+      results = [["CANNOT_STORE", r[1], r[2]] for r in results]
+    invalidateValues(writes.keys())
+    if self.request.get('fmt') == "html":
+      results = escapeJSON(results) # escape HTML markers 
+    WritePhoneOrWeb(self, '', lambda : json.dump(results, self.response.out))
+
+  def post(self):
+    parser = entriesparser.EntriesParser(StringIO.StringIO(self.request.get('entries')))
+    try:
+      pairs = list(itertools.islice(parser.entries(), maxBatchTags + 1))
+    except entriesparser.EntriesError as error:
+      self.abort(400, 'entries must be a JSON list of tag/value pairs (%s at %s)' % (error.kind, errorLocation(error)))
+    if len(pairs) > maxBatchTags:
+      self.abort(400, 'entries may have at most %d pairs' % maxBatchTags)
+    self.store_values(pairs, self.request.get('atomic') == 'true')
+
+  def get(self):
+    self.response.out.write('''
+    <html><body>
+    <form action="storevalues" method="post"
+          enctype=application/x-www-form-urlencoded>
+       <p>Entries:&nbsp;<input type="text" name="entries" /> (A JSON list of tag/value pairs --- e.g., [["color", "red"], ["food", "*delete*"]]. Use the special value "*delete*" to delete an entry.)</p>
+       <p><input type="checkbox" name="atomic" value="true" /> Store all or nothing</p>
+       <input type="hidden" name="fmt" value="html">
+       <input type="submit" value="Store values">
+    </form></body></html>\n''')
+
+# Get the values of several tags at once. The tags parameter is a JSON list of
+# tags, and the result is ["VALUES", <tags>, <values>], where the values are in the
+# same order as the tags and are what /getvalue would return for each tag (so
+# top-level strings get the extra quotes App Inventor expects). Regular tags are
+# looked up in a single batch.
+class GetValues(webapp2.RequestHandler):
+
+  def get_values(self, tags):
+    logging.info('info:get_values(%d tags)' % len(tags))
+    format = replyFormat(self)
+    # The special tags are read while the regular ones are being looked up
+    lookup = startStoredEntries([tag for tag in tags if tag not in specialTags])
+    specials = {}
+    for tag in tags:
+      if tag in specialTags and tag not in specials:
+        metrics.countSpecialTag(tag, 'get')
+        specials[tag] = specialValueJSON(tag)
+    entries = lookup()
+    valueJSONs = [specials[tag] if tag in specialTags else entryText(entries[tag]) or '""' for tag in tags]
+    if format == formats.MSGPACK:
+      return WriteMessagePack(self, ["VALUES", tags, [json.loads(v) for v in valueJSONs]])
+    if format != formats.JSON:
+      valueJSONs = [phoneValueJSON(v) for v in valueJSONs]
+    if format == formats.HTML:
+      result = escapeJSON(["VALUES", tags, [json.loads(v) for v in valueJSONs]]) # escape HTML markers 
+      WritePhoneOrWeb(self, '', lambda : json.dump(result, self.response.out))
+    else:
+      WritePhoneOrWeb(self, '', lambda : self.response.out.write(utf8('["VALUES", %s, [%s]]' % (json.dumps(tags), ', '.join(valueJSONs)))))
+
+  def post(self):
+    try:
+      tags = json.loads(self.request.get('tags'))
+    except ValueError:
+      tags = None
+    if type(tags) != listType or not all(isString(tag) for tag in tags) or len(tags) > maxBatchTags:
+      self.abort(400, 'tags must be a JSON list of at most %d strings' % maxBatchTags)
+    self.get_values(tags)
+
+  def get(self):
+    self.response.out.write('''
+    <html><body>
+    <form action="getvalues" method="post"
+          enctype=application/x-www-form-urlencoded>
+       <p>Tags:&nbsp;<input type="text" name="tags" /> (A JSON list of tags --- e.g., ["color", "food"].)</p>
+       <input type="hidden" name="fmt" value="html">
+       <input type="submit" value="Get values">
+    </form></body></html>\n''')
+
+# Get the entries whose tags start with the prefix parameter, or with the start and
+# end parameters, those whose tags lie in [start, end) (either may be left out).
+# The reply is ["ENTRIES", <triples>, <cursor>], with [<tag>, <value>, <timestamp>]
+# triples like those of *all_entries*, in tag order. With a limit parameter, only one
+# page of triples is returned, and cursor is for the next page (null after the last
+# page); without, the whole range is streamed and cursor is null.
+class GetPrefix(webapp2.RequestHandler):
+
+  def get_prefix(self):
+    format = replyFormat(self)
+    prefix = self.request.get('prefix')
+    if prefix:
+      if self.request.get('start') or self.request.get('end'):
+        self.abort(400, 'give either a prefix or a start/end range')
+      (start, end) = (prefix, storage.prefixEnd(prefix))
+    else:
+      (start, end) = (self.request.get('start') or None, self.request.get('end') or None)
+    logging.info('info:get_prefix(%s, %s)' % (start, end))
+    limit = pageLimit(self)
+    nextCursor = None
+    if limit is None:
+      entries = store.scan(start, end)
+    else:
+      try:
+        (entries, nextCursor) = store.scan_page(start, end, limit, self.request.get('cursor') or None)
+      except ValueError:
+        self.abort(400)
+    if format == formats.MSGPACK: # MessagePack replies are built in memory
+      triples = [entryTriple(e) for e in entries if e.tag != allKeysTag]
+      return WriteMessagePack(self, ["ENTRIES", triples, nextCursor])
+    texts = (entryTripleJSON(e) for e in entries if e.tag != allKeysTag)
+    if format == formats.HTML:
+      texts = (json.dumps(escapeJSON(json.loads(t))) for t in texts) # escape HTML markers 
+    StreamPhoneOrWeb(self, '', listChunks(['"ENTRIES"'], texts, [nextCursor]))
+
+  def post(self):
+    self.get_prefix()
+
+  def get(self):
+    if not self.request.GET:
+      self.response.out.write('''
+    <html><body>
+    <form action="getprefix" method="post"
+          enctype=application/x-www-form-urlencoded>
+       <p>Prefix:&nbsp;<input type="text" name="prefix" /> (Get the entries whose tags start with this prefix --- e.g., user42: for user42:score and user42:name.)</p>
+       <p>Limit:&nbsp;<input type="text" name="limit" /> (Optional: the most entries to get at a time.)</p>
+       <input type="hidden" name="fmt" value="html">
+       <input type="submit" value="Get entries">
+    </form></body></html>\n''')
+      return
+    self.get_prefix()
+
+# The change feed, for clients that would otherwise poll GetValue to see whether
+# anything has changed. The since parameter is the position given by the last reply,
+# and the reply is ["CHANGES", <changes>, <position>]: the tags stored or deleted since
+# then, oldest first, as [<tag>, <value>, <timestamp>] triples like those of
+# *all_entries* (with the value *delete* for a deleted tag), and the position to send
+# as since next time. Without since, only changes from now on are returned. If all
+# tags have been deleted since then, the changes start with
+# ["*all_tags*", "*delete*", <timestamp>], and the client should drop everything it has.
+# At most limit changes (maxPageSize by default) are returned at a time, so a client
+# that gets a full page should ask again at once. With a wait parameter (in seconds,
+# at most maxChangesWait), a request that finds no changes is held until there are
+# some or the time is up. Changes are reported a few seconds after they are made
+# (see Storage.changes). A position older than the tombstones kept (see
+# tombstoneDays) is answered with 410 Gone: the client should read all entries again
+# (*all_entries*) and ask for changes from then on.
+class Changes(webapp2.RequestHandler):
+
+  def changes(self):
+    format = replyFormat(self)
+    limit = pageLimit(self) or maxPageSize
+    try:
+      since = int(self.request.get('since') or storage.datePosition(datetime.datetime.utcnow()))
+      wait = min(float(self.request.get('wait') or 0), maxChangesWait)
+    except ValueError:
+      self.abort(400)
+    try:
+      (changes, position, truncated) = changesSince(since, limit, time.time() + wait)
+    except storage.PositionExpired as expired:
+      self.abort(410, 'since is too old (%s): read all entries again' % expired)
+    logging.info('info:changes(since=%d) found %d changes' % (since, len(changes)))
+    texts = [changeTripleJSON(e) for e in changes if e.tag != allKeysTag]
+    if truncated is not None:
+      texts.insert(0, json.dumps([allKeysTag, deleteValue, timeString(truncated)]))
+    if format == formats.MSGPACK:
+      WriteMessagePack(self, ["CHANGES", [json.loads(t) for t in texts], position])
+    elif format == formats.HTML:
+      result = escapeJSON(["CHANGES", [json.loads(t) for t in texts], position]) # escape HTML markers 
+      WritePhoneOrWeb(self, '', lambda : json.dump(result, self.response.out))
+    else:
+      WritePhoneOrWeb(self, '', lambda : self.response.out.write(utf8('["CHANGES", [%s], %d]' % (', '.join(texts), position))))
+
+  def post(self):
+    self.changes()
+
+  def get(self):
+    self.changes()
+
 # # Lyn: deletion now performed by storing "*delete*". 
 # # The DeleteEntry is called from the Web only, by pressing one of the
 # # buttons on the main page.  So there's no get method, only a post.
@@ -329,77 +677,217 @@ class GetValue(webapp2.RequestHandler):
 class DeleteEntry(webapp2.RequestHandler):
 
   def post(self):
-    logging.info('/deleteentry?%s\n|%s|' %
-                  (self.request.query_string, self.request.body))
-    entry_key_string = self.request.get('entry_key_string')
-    key = db.Key(entry_key_string)
-    # tag = self.request.get('tag')
-    db.run_in_transaction(dbSafeDelete,key)
-    self.redirect('/')
+    logging.info('/deleteentry?%s\n|%s|',
+                 self.request.query_string, tracing.preview(self.request.body))
+    # entry_key_string = self.request.get('entry_key_string')
+    tag = self.request.get('tag')
+    store.delete(tag)
+    invalidateValues([tag])
+    self.redirect(namespaces.path('/'))
+
+# Report the value cache counters as ["CACHE_STATS", {"hits": ..., "misses": ..., ...}]
+# (with the *all_...* result counters under "aggregates", the main page row
+# counters under "rows" and the write-behind buffer counters under "write_behind"),
+# for sizing TINYWEBDB_CACHE_SIZE and TINYWEBDB_CACHE_TTL. Restricted to admins in app.yaml.
+class CacheStats(webapp2.RequestHandler):
+
+  def get(self):
+    stats = valueCache.stats() if valueCache is not None else {}
+    stats['aggregates'] = aggregateCache.stats()
+    stats['rows'] = rowCache.stats()
+    stats['write_behind'] = writebehind.stats()
+    WritePhoneOrWeb(self, '', lambda : json.dump(["CACHE_STATS", stats], self.response.out))
+
+# Write out the values buffered by this instance (see writebehind.py) at once, and
+# report ["FLUSHED", <count>]. A GET only shows a button that posts (see postForm).
+# Restricted to admins in app.yaml.
+class FlushWrites(webapp2.RequestHandler):
+
+  def post(self):
+    flushed = writebehind.flush_all()
+    logging.info('info:flushwrites wrote %d buffered values' % flushed)
+    WritePhoneOrWeb(self, '', lambda : json.dump(["FLUSHED", flushed], self.response.out))
+
+  def get(self):
+    writePostPage(self, 'flushwrites', 'Write out buffered values')
+
+# Report the latest slow requests (see tracing.py), with the breakdown of their time,
+# as ["SLOW_REQUESTS", [<request>, ...]], newest first. Restricted to admins in app.yaml.
+class SlowRequests(webapp2.RequestHandler):
+
+  def get(self):
+    slow = list(reversed(tracing.slowRequests))
+    WritePhoneOrWeb(self, '', lambda : json.dump(["SLOW_REQUESTS", slow], self.response.out))
+
+# Report request, storage and special tag metrics in the Prometheus text format
+# (see metrics.py). Restricted to admins in app.yaml.
+class Metrics(webapp2.RequestHandler):
+
+  def get(self):
+    self.response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+    self.response.out.write(metrics.registry.render())
+
+# Re-key StoredData entities written by older versions of this service so that
+# they are addressed by tag (see datastore_storage.py), in batches (see migrateKeys).
+# A POST migrates batches of batch_size entities, starting at cursor, for up to
+# migrateTimeBudget seconds, and hands the rest to a task, which posts the cursor to
+# continue from and carries on in the same way. It reports ["MIGRATED", <count>,
+# <next cursor>], where the next cursor is the one the task continues from (or, without
+# a task queue, the one to post next), and null when there is nothing left to do.
+# A GET only shows a button that posts (see postForm). Restricted to admins (and so
+# to tasks) in app.yaml.
+class MigrateKeys(webapp2.RequestHandler):
+
+  def post(self):
+    cursor = self.request.get('cursor') or None
+    batchSize = int(self.request.get('batch_size') or migrateBatchSize)
+    (count, nextCursor) = migrateKeys(time.time() + migrateTimeBudget, cursor, batchSize)
+    logging.info('info:migrate_keys re-keyed %d entities%s' % (count, ', more to come' if nextCursor else ''))
+    prolog = ''
+    if nextCursor and self.request.get('fmt') == "html":
+      if taskqueue is not None:
+        prolog = '{count} entities have been migrated. The rest are being migrated in the background.<br><br>'.format(count=count)
+      else:
+        prolog = postForm('migratekeys', 'Migrate next batch', {'cursor': nextCursor}) + '<br>'
+    WritePhoneOrWeb(self, prolog, lambda : json.dump(["MIGRATED", count, nextCursor], self.response.out))
+
+  def get(self):
+    writePostPage(self, 'migratekeys', 'Migrate entities to tag keys',
+                  {'cursor': self.request.get('cursor'), 'batch_size': self.request.get('batch_size')})
+
+# Delete all entries in batches (see deleteAllTags), and report ["TRUNCATED", <count>,
+# <next cursor>], where the next cursor is null once the database is empty. A POST
+# without a cursor starts deleting, as storing *delete* in *all_tags* does; a task
+# queued by deleteAllTags posts the cursor to continue from, and the deletion carries
+# on from there, queueing another task if it runs out of time. With batch_size, a POST
+# deletes a single batch, so that a large database can also be emptied step by step
+# without a task queue. A GET only shows a button that posts (see postForm).
+# Restricted to admins (and so to tasks) in app.yaml.
+class Truncate(webapp2.RequestHandler):
+
+  def post(self):
+    cursor = self.request.get('cursor') or None
+    try:
+      if self.request.get('batch_size'):
+        (count, tags, nextCursor) = store.truncate(int(self.request.get('batch_size')), cursor)
+        invalidateValues(tags)
+      else:
+        (count, nextCursor) = deleteAllTags(time.time() + truncateTimeBudget, cursor)
+    except ValueError:
+      self.abort(400)
+    logging.info('info:truncate deleted %d entries%s' % (count, ', more to come' if nextCursor else ''))
+    prolog = ''
+    if nextCursor and self.request.get('fmt') == "html":
+      if taskqueue is not None and not self.request.get('batch_size'):
+        prolog = '{count} entries have been deleted. The rest are being deleted in the background.<br><br>'.format(count=count)
+      else:
+        prolog = postForm('truncate', 'Delete next batch',
+                          {'cursor': nextCursor, 'batch_size': self.request.get('batch_size')}) + '<br>'
+    WritePhoneOrWeb(self, prolog, lambda : json.dump(["TRUNCATED", count, nextCursor], self.response.out))
+
+  def get(self):
+    writePostPage(self, 'truncate', 'Delete all entries',
+                  {'cursor': self.request.get('cursor'), 'batch_size': self.request.get('batch_size')})
+
+# Delete old tombstones (see pruneTombstones). Cron sends a GET, which prunes
+# the tombstones of the default namespace made more than tombstoneDays days ago, and
+# queues a task for each other namespace; a task posts the date to prune before and
+# the cursor (if any) to continue from. Either hands what is left after
+# pruneTimeBudget seconds to another task. A GET reports ["PRUNED", <count>,
+# <next cursor>]; one that does not come from cron only shows a button that posts
+# (see postForm). Restricted to admins (and so to cron and tasks) in app.yaml.
+class PruneTombstones(webapp2.RequestHandler):
+
+  def post(self):
+    if not self.request.get('before'):
+      return self.prune()
+    try:
+      before = storage.positionDate(int(self.request.get('before')))
+    except ValueError:
+      self.abort(400)
+    (count, remaining) = pruneTombstones(time.time() + pruneTimeBudget, before, self.request.get('cursor') or None)
+    logging.info('info:prune_tombstones deleted %d tombstones%s' % (count, ', more to come' if remaining else ''))
+
+  def get(self):
+    if self.request.headers.get('X-Appengine-Cron') != 'true': # Set only by App Engine's cron
+      return writePostPage(self, 'prunetombstones', 'Delete old tombstones')
+    self.prune()
+
+  def prune(self):
+    before = datetime.datetime.utcnow() - datetime.timedelta(days=tombstoneDays)
+    if not namespaces.namespace() and taskqueue is not None:
+      for name in store.namespaces():
+        if name:
+          taskqueue.add(url='/ns/%s/prunetombstones' % name, params={'before': storage.datePosition(before)})
+    (count, nextCursor) = pruneTombstones(time.time() + pruneTimeBudget, before)
+    logging.info('info:prune_tombstones deleted %d tombstones' % count)
+    WritePhoneOrWeb(self, '', lambda : json.dump(["PRUNED", count, nextCursor], self.response.out))
 
 # Write the contents of a table to a web page.
+# The list is streamed out rather than built up in memory. With a limit parameter,
+# only one page of entries is written (itself a valid entries file), and the cursor
+# for the next page is returned in the X-Next-Cursor header. Clients that ask for
+# JSON get the same list as application/json, and those that ask for MessagePack,
+# the list of pairs encoded in it (built in memory).
 class WriteEntries(webapp2.RequestHandler):
 
   def post(self):
-    entries = StoredData.all().order("tag") # Orders lo to hi. Use "-tag" to order from hi to lo
-    # entries does not appear to be a list, so must convert it to one first 
-    entryList = []
-    for e in entries:
-      if e.tag != allKeysTag: # Don't put this key in table; it's implicit 
-        entryList.append([e.tag, json.loads(e.value)]) # tag/value pair, where tag is string
+    format = replyFormat(self)
+    limit = pageLimit(self)
+    if limit is None:
+      entries = store.scan() # Ordered by tag, lo to hi
+    else:
+      (entries, nextCursor) = scanPage(self, limit)
+      if nextCursor:
+        self.response.headers['X-Next-Cursor'] = nextCursor
+    entryList = ([e.tag, json.loads(e.value)] # tag/value pair, where tag is string
+                 for e in entries
+                 if e.tag != allKeysTag) # Don't put this key in table; it's implicit 
+    if format == formats.MSGPACK:
+      return WriteMessagePack(self, list(entryList))
     # Write contents of JSON entry list to new web page as text. 
     # Users can easily save this away in a text file. 
-    self.response.headers['Content-Type'] = 'text/plain'
-    writeJSONEntryList(self, entryList, "txt")
+    self.response.headers['Content-Type'] = formats.CONTENT_TYPES[formats.JSON] if format == formats.JSON else 'text/plain'
+    self.response.app_iter = bufferedChunks(jsonEntryListChunks(entryList, "txt"))
 
 # Read the contents of a file containing a json list of tag/value pairs
 # and add these to the table. 
+# The file is parsed as a stream (see entriesparser.py), and each pair is stored
+# as soon as it has been read and checked, a batch at a time. Parsing stops at the
+# first problem. Entries in batches stored before the problem was found stay
+# stored, so a file no larger than one batch is either stored completely or not at all.
 class AddEntries(webapp2.RequestHandler):
 
-  def addEntries(self, jsonEntries):
-    ## There are potential readers/writers errors here :(
-
-    ## First, update *all_tags* key list
-    allKeysEntry = db.GqlQuery("SELECT * FROM StoredData where tag = :1", allKeysTag).get()
-    if allKeysEntry:
-      keyListString = allKeysEntry.value
-      keyList = json.loads(keyListString)
-    else: 
-      keyList = []
-    allTags = map(lambda pair: pair[0], 
-                  filter(lambda pair: pair[0] not in specialTags and pair[1] not in specialValues,
-                         jsonEntries))
-    newTags = filter(lambda tag: tag not in keyList, allTags)
-    keyList.extend(newTags) # Add new tags to list
-    keyList.sort()  # keep key list sorted 
-    if allKeysEntry:
-      allKeysEntry.value = json.dumps(keyList) # only update text rep of value if there's a new key
-    else: 
-      allKeysEntry = StoredData(tag = allKeysTag, value = json.dumps(keyList)) # 
-    allKeysEntry.put() # Store updated key list 
-
-    ## Next, store each tag/value pair in table. 
-    for entryPair in jsonEntries:
-      tag = entryPair[0]
-      value = entryPair[1]
-      if tag not in specialTags and value not in specialValues:
-        stringValue = json.dumps(value)
-        entry = db.GqlQuery("SELECT * FROM StoredData where tag = :1", tag).get()
-        if entry:
-          entry.value = stringValue
-        else: 
-          entry = StoredData(tag = tag, value = stringValue)
-        entry.put()
-
-    ## Finally, write in web pages json list of all entry pairs. 
+  def addEntries(self, parser):
+    ## Store the tag/value pairs in table, a batch at a time. The tag index is updated
+    ## along with the entries. Only the first addEntriesEchoLimit pairs are kept to be shown.
+    shown = []
+    def remember(pairs):
+      for pair in pairs:
+        if len(shown) < addEntriesEchoLimit:
+          shown.append(pair)
+        yield pair
+    with tracing.span('add_entries'):
+      (stored, batches, deferred) = storeEntries(remember(parser.entries()), time.time() + addEntriesTimeBudget)
+
+    ## Finally, write in web pages json list of (the first) entry pairs. 
     self.response.headers['Content-Type'] = 'text/html'
     self.response.out.write('<html><body>') 
-    self.response.out.write('''
+    if deferred:
+      self.response.out.write('''
+    {stored} entries from this entry list have been added to the database.
+    The remaining {deferred} are being added in the background:<br>
+    '''.format(stored=stored, deferred=deferred))
+    else:
+      self.response.out.write('''
     Entries from this entry list have been added to the database:<br>
     ''')
-    writeJSONEntryList(self, escapeJSON(jsonEntries), "html")
+    logging.info('info:addEntries stored %d entries in %d batches, deferred %d' % (stored, batches, deferred))
+    writeJSONEntryList(self, escapeJSON(shown), "html")
+    if parser.count > len(shown):
+      self.response.out.write('<br>... and {more} more entries.'.format(more=parser.count - len(shown)))
     self.response.out.write('''<br>
-    <p><a href="/">
+    <p><a href="./">
     <i>Return to {serverName} TinyWebDB Main Page</i>
     </a><br><br>
     '''.format(serverName=serverName))
@@ -407,74 +895,393 @@ class AddEntries(webapp2.RequestHandler):
 
   def post(self):
     # self.response.out.write("add entries")
-    entriesString = self.request.get("entriesFile") # Contents of entries file. Should be in json format
-    logging.info('***info:entriesFile = %s)***' % entriesString)
+    entriesFile = self.request.POST.get("entriesFile") # Entries file. Should be in json format
+    if hasattr(entriesFile, 'file'): # An uploaded file, read as a stream
+      logging.info('***info:entriesFile = %s***' % entriesFile.filename)
+      parser = entriesparser.EntriesParser(entriesFile.file)
+    else: # Given as a form field
+      parser = entriesparser.EntriesParser(StringIO.StringIO(entriesFile or ''))
     try: 
-      entriesValue = json.loads(entriesString)
-      verifyTagValuePairs(entriesValue) # Raises error if there is a problem; otherwise just returns
-      self.addEntries(entriesValue)
-    except ValueError as valerror: 
-      self.fileError(entriesString, valerror)
+      self.addEntries(parser)
+    except entriesparser.EntriesError as error: 
+      self.fileError(error, getattr(error, 'stored', 0))
     except Exception as exc: 
-      self.fileError(entriesString, exc)
+      self.unexpectedError(exc)
 
-  def fileError(self, entriesString, error):
-    valErrorType = type(ValueError('foo'))
-    exceptionType = type(Exception('foo'))
+  def fileError(self, error, stored):
     self.response.headers['Content-Type'] = 'text/html'
-    if entriesString == "":
+    kind = error.kind
+    entry = error.entry
+    if kind == 'empty':
       self.response.out.write('Entries list file is empty! Perhaps you forgot to Choose a file?<br>')
-    elif type(error) == valErrorType: 
+    elif kind == 'malformed': 
       self.response.out.write('Entries list file is not well-formed JSON.<br>It must be a JSON list of tag/value pairs.<br><br>')
-      self.response.out.write(entriesString)
-    elif type(error) == exceptionType: 
-      entriesValue = json.loads(entriesString)
-      args = error.args
-      msg = args[0]
-      if msg == 'database_not_a_list':
-        self.response.out.write('Entries are not a list.<br>They must be a JSON list of tag/value pairs.<br><br>')
-        self.response.out.write(entriesString)
-      elif msg == 'entry_not_a_list': 
-        self.entryError(args[1], entriesValue, 
-                   'Entry is not a list.<br>It must be a two-element list of tag (string) and value.')
-      elif msg == 'entry_not_a_pair': 
-        self.entryError(args[1], entriesValue, 
-                   'Malformed entry.<br>It must be a two-element list of tag (string) and value, but this entry is a list with ' + str(len(args[1])) + ' elements.')
-      elif msg == 'entry_tag_not_a_string': 
-        self.entryError(args[1], entriesValue, 
-                   'In an entry (tag/value pair), the tag (first element) must be a string, but ' + str(args[1][0]) + ' is not a string.')
-      else:           
-        self.unexpectedError(error, entriesValue)
-    else:           
-      self.unexpectedError(error, entriesString)
+      self.response.out.write(escape('Problem at {where}: {detail}'.format(where=errorLocation(error), detail=error.detail)))
+    elif kind == 'database_not_a_list':
+      self.response.out.write('Entries are not a list.<br>They must be a JSON list of tag/value pairs.<br><br>')
+      self.response.out.write(abbreviatedJSON(entry))
+    elif kind == 'entry_not_a_list': 
+      self.entryError(error, 
+                 'Entry is not a list.<br>It must be a two-element list of tag (string) and value.')
+    elif kind == 'entry_not_a_pair': 
+      self.entryError(error, 
+                 'Malformed entry.<br>It must be a two-element list of tag (string) and value, but this entry is a list with ' + str(len(entry)) + ' elements.')
+    elif kind == 'entry_tag_not_a_string': 
+      self.entryError(error, 
+                 'In an entry (tag/value pair), the tag (first element) must be a string, but ' + abbreviatedJSON(entry[0]) + ' is not a string.')
+    if stored:
+      self.response.out.write('''<br><br>
+    The first {stored} entries of the file were added to the database before the problem was found.
+    '''.format(stored=stored))
     self.response.out.write('''<br>
-    <p><a href="/">
+    <p><a href="./">
     <i>Return to {serverName} TinyWebDB Main Page</i>
     </a><br><br>
     '''.format(serverName=serverName))
     self.response.out.write('</body></html>')
 
-  def entryError(self, entry, entries, msg):
-    self.response.out.write(msg + '<br><br>Entry:<br>')
-    self.response.out.write(entry)
-    self.response.out.write('<br><br>Entries list:<br>')
-    writeJSONEntryList(self, escapeJSON(entries), "html")
+  def entryError(self, error, msg):
+    self.response.out.write(msg + '<br><br>Entry (at {where}):<br>'.format(where=errorLocation(error)))
+    self.response.out.write(abbreviatedJSON(error.entry))
 
-  def unexpectedError(self, error, entriesStringOrValue):
+  def unexpectedError(self, error):
+    self.response.headers['Content-Type'] = 'text/html'
     self.response.out.write('Unexpected error in AddEntries.<br><br>')
-    self.response.out.write('Error type: ' + str(type(error)) + '<br><br>')
+    self.response.out.write('Error type: ' + escape(str(type(error))) + '<br><br>')
     self.response.out.write('Error args:<br><br>')
     args = error.args
     for i in range(len(args)):
       self.response.out.write('args[' + str(i) + ']<br>')
-      self.response.out.write(str(args[i]))
+      self.response.out.write(escape(str(args[i])))
       self.response.out.write('<br><br>')
-    if isString(entriesStringOrValue):
-      self.response.out.write('Entries:<br>')
-      self.response.out.write(entriesStringOrValue)
-    else: 
-      self.response.out.write('Entries list:<br>')
-      writeJSONEntryList(self, escapeJSON(entriesStringOrValue), "html")
+
+# "line <line>, column <column>" for an EntriesError
+def errorLocation(error):
+  return 'line {line}, column {column}'.format(line=error.line, column=error.column)
+
+# The JSON text of value, HTML-escaped and cut short if it is long
+def abbreviatedJSON(value, maxLength=1000):
+  text = json.dumps(value)
+  if len(text) > maxLength:
+    text = text[:maxLength] + ' ...'
+  return escape(text)
+
+# Delete all entries, starting at cursor, truncateBatchSize at a time and without reading
+# them. This also removes any *all_tags* entity left by older versions of this service,
+# leaving *all_tags* as the empty list. Once deadline (if any) has passed, the rest is
+# handed to a task if a task queue is available. Only entries stored before the
+# deletion started are deleted (see Storage.truncate), so entries stored while the
+# task is still at work are kept. Returns (number of entries deleted, cursor the task
+# continues from, or None if everything has been deleted).
+def deleteAllTags(deadline=None, cursor=None):
+  deleted = 0
+  while True:
+    (count, tags, cursor) = store.truncate(truncateBatchSize, cursor)
+    invalidateValues(tags)
+    deleted += count
+    if cursor is None:
+      return (deleted, None)
+    logging.info('info:deleteAllTags deleted %d entries so far' % deleted)
+    if deadline is not None and time.time() > deadline and taskqueue is not None:
+      taskqueue.add(url=namespaces.path('/truncate'), params={'cursor': cursor})
+      return (deleted, cursor)
+
+# Re-key legacy entities (see MigrateKeys), starting at cursor, batchSize at a time.
+# Once deadline has passed, the rest is handed to a task if a task queue is available.
+# Returns (number of entities re-keyed, cursor to continue from, or None once done).
+def migrateKeys(deadline, cursor=None, batchSize=migrateBatchSize):
+  migrated = 0
+  while True:
+    (count, cursor) = store.migrate_keys(batchSize, cursor)
+    migrated += count
+    if cursor is None or time.time() > deadline:
+      break
+  if cursor is not None and taskqueue is not None:
+    taskqueue.add(url=namespaces.path('/migratekeys'), params={'cursor': cursor, 'batch_size': batchSize})
+  return (migrated, cursor)
+
+# Returns store.changes(since, limit), unless there are no changes, in which case
+# the change version is checked every changesPollInterval seconds until it changes
+# or deadline has passed, and the changes are read again. As changes are only
+# reported once they have settled, they are also read again every
+# store.settle_seconds seconds.
+def changesSince(since, limit, deadline):
+  while True:
+    version = store.version()
+    (changes, position, truncated) = store.changes(since, limit)
+    if changes or truncated is not None or time.time() >= deadline:
+      return (changes, position, truncated)
+    read = time.time()
+    with tracing.waiting(since=since):
+      while time.time() < deadline:
+        time.sleep(max(0, min(changesPollInterval, deadline - time.time())))
+        if version is None or store.version() != version:
+          break
+        if store.settle_seconds and time.time() - read >= store.settle_seconds:
+          break
+
+# Delete the tombstones made before the date before, in batches, starting at cursor.
+# Once deadline has passed, the rest is handed to a task if a task queue is available.
+# Returns (number of tombstones deleted, cursor the task continues from, or None once done).
+def pruneTombstones(deadline, before, cursor=None):
+  pruned = 0
+  while True:
+    (count, cursor) = store.prune_tombstones(before, pruneBatchSize, cursor)
+    pruned += count
+    if cursor is None or time.time() > deadline:
+      break
+  if cursor is not None and taskqueue is not None:
+    taskqueue.add(url=namespaces.path('/prunetombstones'),
+                  params={'before': storage.datePosition(before), 'cursor': cursor})
+  return (pruned, cursor)
+
+# The entity tag (ETag) for the reply to a GetValue request for tag, when what is
+# stored is at version: the date of the entry of a regular tag (None if there is none),
+# or the change version of the storage engine for a special tag. Returns None if the
+# version is unknown, or too recent for queries to be sure to reflect the write that
+# made it (see VersionedCache). The tag and the parameters that shape the reply are
+# included, as POST requests for all tags share one URL.
+def versionTag(handler, tag, version):
+  if tag in specialTags and not aggregateCache.settled(namespaces.cacheKey(tag), version):
+    return None
+  parts = [tag, str(version), replyFormat(handler), handler.request.get('limit'), handler.request.get('cursor')]
+  return hashlib.md5(json.dumps(parts)).hexdigest()
+
+# Set the ETag (if any) and Last-Modified date (if any) of the response, and answer
+# with 304 Not Modified if the request's If-None-Match or (failing that)
+# If-Modified-Since header shows the client already has the reply. Returns True if so.
+# HTTP dates are in whole seconds, so an entry written in the current second gets no
+# Last-Modified date (and If-Modified-Since is not used for it): another write within
+# the second would have the same one, and a client that only revalidated by date
+# would be told its older value was current.
+def notModified(handler, etag, lastModified):
+  if lastModified is not None and lastModified.replace(microsecond=0) >= datetime.datetime.utcnow().replace(microsecond=0):
+    lastModified = None
+  if etag is not None:
+    handler.response.etag = etag
+  if lastModified is not None:
+    handler.response.last_modified = lastModified
+  request = handler.request
+  if 'If-None-Match' in request.headers:
+    unchanged = etag is not None and etag in request.if_none_match
+  elif request.if_modified_since is not None and lastModified is not None:
+    unchanged = lastModified.replace(microsecond=0, tzinfo=UTC) <= request.if_modified_since
+  else:
+    unchanged = False
+  if unchanged:
+    handler.response.status = 304
+    handler.response.headers.pop('Content-Type', None)
+  return unchanged
+
+# Returns the JSON text of the value of a special tag. Stored values are spliced in
+# as they are, without being parsed.
+def specialValueJSON(tag):
+  if tag == allKeysTag:
+    return json.dumps(aggregateValue(tag, allTagsValue))
+  elif tag == allValuesTag:
+    return '[' + ', '.join(aggregateValue(tag, allValuesTexts)) + ']'
+  elif tag == allTimestampsTag:
+    return json.dumps(aggregateValue(tag, allTimestampsValue))
+  elif tag == allEntriesTag:
+    return '[' + ', '.join(aggregateCache.stream(namespaces.cacheKey(tag), store.version(), allEntriesTexts())) + ']'
+
+# Returns a list of the JSON texts of the values for all the tags in *all_keys*
+# (which do not include special tags).
+def allValuesTexts():
+  entries = store.scan() # Ordered by tag, lo to hi
+  return [e.value for e in entries if e.tag != allKeysTag]
+
+# Returns a list of timestamps for all the tags in *all_keys* (which do not include special tags).
+def allTimestampsValue():
+  entries = store.scan() # Ordered by tag, lo to hi
+  result = [] 
+  for e in entries:
+    if e.tag != allKeysTag: 
+#      result.append(e.date.ctime())
+       result.append(timeString(e.date))
+  return result
+
+# Iterates over the JSON texts of all tag/value/timestamp triples (see entryTripleJSON),
+# in tag order
+def allEntriesTexts():
+  return (entryTripleJSON(e) for e in store.scan() if e.tag != allKeysTag)
+
+# Returns the Entry stored at tag, or None if there is none, going through the value cache.
+def storedEntry(tag):
+  if valueCache is None:
+    return store.get(tag)
+  entry = valueCache.get(namespaces.cacheKey(tag))
+  if entry is cache.MISSING:
+    token = valueCache.token([namespaces.cacheKey(tag)])
+    entry = store.get(tag)
+    valueCache.fill(namespaces.cacheKey(tag), entry, token)
+  return entry
+
+# The JSON text of the value of entry, or None if there is no entry
+def entryText(entry):
+  if entry:
+    return entry.value
+  else: 
+    return None
+
+# Returns the result of build() for the special tag, reusing the last one
+# computed if nothing has been stored or deleted since.
+def aggregateValue(tag, build):
+  return aggregateCache.get(namespaces.cacheKey(tag), store.version(), build)
+
+# Starts looking up the stored Entry of each of tags, returning a function that waits
+# for the lookup and returns a dictionary mapping each tag to its Entry (None if there
+# is none). Tags missing from the value cache are read from storage in one batch.
+def startStoredEntries(tags):
+  entries = {}
+  missing = []
+  for tag in tags:
+    if tag in entries:
+      continue
+    entry = valueCache.get(namespaces.cacheKey(tag)) if valueCache is not None else cache.MISSING
+    entries[tag] = None
+    if entry is cache.MISSING:
+      missing.append(tag)
+    else:
+      entries[tag] = entry
+  if not missing:
+    return lambda : entries
+  token = valueCache.token([namespaces.cacheKey(tag) for tag in missing]) if valueCache is not None else None
+  lookup = store.get_multi_async(missing)
+  def finish():
+    for (tag, entry) in zip(missing, lookup.get_result()):
+      entries[tag] = entry
+      if valueCache is not None:
+        valueCache.fill(namespaces.cacheKey(tag), entry, token)
+    return entries
+  return finish
+
+# The JSON text the phone gets for the value stored as the JSON text text (None if
+# there is none, which reads as ""), made without parsing it. This is the same as
+# json.dumps(addExtraQuotesExpectedByAppInventor(json.loads(text))): the text itself,
+# except that the extra quotes are spliced into a top-level string.
+def phoneValueJSON(text):
+  if text is None:
+    text = '""'
+  if text.startswith('"'):
+    return '"\\"' + text[1:-1] + '\\""'
+  return text
+
+# Drop changed tags from the value cache. Call this after the change has been written.
+def invalidateValues(tags):
+  if valueCache is not None:
+    valueCache.invalidate_multi([namespaces.cacheKey(tag) for tag in tags])
+
+# Drop the cached entries of tags of namespace once their buffered values have
+# been written (see writebehind.py), as those read from the buffer carry another date.
+# Flushes may run outside any request, so the namespace is given.
+def invalidateFlushed(namespace, tags):
+  if valueCache is not None:
+    valueCache.invalidate_multi([namespaces.cacheKey(tag, namespace) for tag in tags])
+
+# Returns the sorted list of all tags (which do not include special tags), read
+# page by page from the tag index of the storage engine. Like the other special
+# tags, *all_tags* is read through aggregateValue, so it is only read again after
+# something has been stored or deleted.
+def allTagsValue():
+  return [tag for tag in store.tags() if tag != allKeysTag] # Skip an *all_tags* entity left by older versions
+
+# Stores one chunk of entries left over by AddEntries. The entries parameter is a
+# JSON list of tag/value pairs that has already been checked. A chunk that cannot be
+# stored in time is split further. Restricted to admins (and so to tasks) in app.yaml.
+class AddEntriesTask(webapp2.RequestHandler):
+
+  def post(self):
+    entries = json.loads(self.request.get('entries'))
+    (stored, batches, deferred) = storeEntries(entries, time.time() + addEntriesTimeBudget)
+    logging.info('info:addEntriesTask stored %d entries in %d batches, deferred %d' % (stored, batches, deferred))
+
+# Store the tag/value pairs of the iterable entries (skipping special tags and values),
+# addEntriesBatchSize at a time. Each batch is written while the next one is read, and
+# the write of a batch has finished before that of the next one starts, so that later
+# pairs for a tag win over earlier ones. Once deadline has passed, the remaining pairs
+# are handed to tasks if a task queue is available. Returns (number of pairs stored,
+# number of batches, number of pairs deferred). If reading entries raises an
+# EntriesError, the pairs of the batch being collected are not stored, and the number
+# of pairs that were is recorded in the error as stored.
+def storeEntries(entries, deadline):
+  entries = iter(entries)
+  stored = 0
+  batches = 0
+  batch = []
+  writing = None # Waits for the write of the last batch
+  try:
+    for pair in entries:
+      if pair[0] in specialTags or pair[1] in specialValues:
+        continue
+      batch.append(pair)
+      if len(batch) == addEntriesBatchSize:
+        if writing:
+          writing()
+          writing = None
+        if time.time() > deadline and taskqueue is not None:
+          return (stored, batches, deferEntries(itertools.chain(batch, entries)))
+        writing = startBatch(batch)
+        stored += len(batch)
+        batches += 1
+        logging.info('info:storeEntries stored %d entries so far' % stored)
+        batch = []
+  except entriesparser.EntriesError as error:
+    if writing:
+      writing()
+    error.stored = stored
+    raise
+  if writing:
+    writing()
+  if batch:
+    storeBatch(batch)
+    stored += len(batch)
+    batches += 1
+  return (stored, batches, 0)
+
+def storeBatch(pairs):
+  startBatch(pairs)()
+
+# Start writing the tag/value pairs, returning a function that waits for the write
+# to finish and then invalidates the tags written
+def startBatch(pairs):
+  with tracing.span('serialize', entries=len(pairs)):
+    values = dict((tag, json.dumps(value)) for (tag, value) in pairs) # The last value for a tag wins
+  writing = store.write_async(values.items(), [])
+  def finish():
+    writing.get_result()
+    invalidateValues(values.keys())
+  return finish
+
+# Queue tasks storing the tag/value pairs, each with at most taskPayloadSize characters
+# of entries (a larger single pair gets a task of its own). Returns the number of pairs.
+# All the pairs are read (and so checked) before any task is queued, so a problem
+# found in them leaves nothing to be stored later. Tasks may run in any order, so only
+# the last pair for each tag is queued: the same pair wins as when the pairs are
+# stored one after another.
+def deferEntries(pairs):
+  count = 0
+  last = collections.OrderedDict() # tag -> JSON text of its last pair
+  for pair in pairs:
+    if pair[0] in specialTags or pair[1] in specialValues:
+      continue
+    last[pair[0]] = json.dumps(pair)
+    count += 1
+  chunk = []
+  size = 0
+  for text in last.values():
+    if chunk and size + len(text) > taskPayloadSize:
+      queueEntries(chunk)
+      chunk = []
+      size = 0
+    chunk.append(text)
+    size += len(text) + 2
+  if chunk:
+    queueEntries(chunk)
+  return count
+
+def queueEntries(pairTexts):
+  taskqueue.add(url=namespaces.path('/addentriestask'), params={'entries': '[' + ', '.join(pairTexts) + ']'})
 
 # ########################################
 # #### Procedures used in displaying the main page
@@ -483,34 +1290,149 @@ class AddEntries(webapp2.RequestHandler):
 def timeString (time): 
   return time.strftime("%m/%d/%Y %H:%M:%S")
 
+# Return [<tag>,<value>,<timestamp>] for a stored entry
+def entryTriple(e):
+# return [e.tag,json.loads(e.value),e.date.ctime()]
+  return [e.tag,json.loads(e.value),timeString(e.date)]
+
+# The JSON text of entryTriple(e), made without parsing the stored value
+def entryTripleJSON(e):
+  return '[%s, %s, %s]' % (json.dumps(e.tag), e.value, json.dumps(timeString(e.date)))
+
+# The JSON text of the triple for an entry returned by store.changes (see Changes):
+# that of entryTripleJSON, or for a deleted tag, one with the value *delete*
+def changeTripleJSON(e):
+  if e.value is None:
+    return json.dumps([e.tag, deleteValue, timeString(e.date)])
+  return entryTripleJSON(e)
+
 def writeJSONEntryList(self, entryList, format):
+  for chunk in jsonEntryListChunks(entryList, format):
+    self.response.out.write(chunk)
+
+# Yields the text of a JSON list of tag/value pairs, one pair per line, a piece at a
+# time. entryList can be any iterable, so the list is never held in memory.
+def jsonEntryListChunks(entryList, format):
   newlineString = "<br>"
   if format == "txt":
     newlineString = "\n"
-  self.response.out.write('[%s' % newlineString) # begin list of entries.
+  yield '[%s' % newlineString # begin list of entries.
   # [lyn, 12/4/2011] Following simple code puts comma after last entry, which json.loads doesn't like
   # for pair in entryList:
   #   self.response.out.write('%s,\n' % json.dumps(pair)) # write tag/value pair, one per line. 
-  maxIndex = len(entryList) - 1 # indices start at 0, not 1
-  index = 0
+  # So the comma is written before every entry but the first instead.
+  separator = ''
   for pair in entryList:
-    self.response.out.write(json.dumps(pair)) # write tag/value pair, one per line. 
-    if index != maxIndex:
-      self.response.out.write(",")
-    self.response.out.write(newlineString)
-    index = index + 1
-  self.response.out.write(']') # end list of entries.
-
-### Show the tags and values as a table.
-def stored_entries_HTML():
-
-  def HTMLEntry (tag, value, timestamp, hasDeleteButton):
-    # logging.info("HTMLEntry(" + tag + "," + value + "," + timestamp + "," + str(hasDeleteButton))
-    deleteButtonHTML = '<td></td>\n' # No delete button
-    if hasDeleteButton: 
-      deleteButtonHTML = '''
+    yield separator + json.dumps(pair) # write tag/value pair, one per line. 
+    separator = ',' + newlineString
+  if separator:
+    yield newlineString
+  yield ']' # end list of entries.
+
+# Yields the JSON text of ["VALUE", tag, <list of items>, <extras>...] a piece at a time,
+# byte for byte what json.dump would write for the whole list, given the JSON text of
+# each item.
+def valueListChunks(tag, itemTexts, extras=()):
+  return listChunks(['"VALUE"', json.dumps(tag)], itemTexts, extras)
+
+# Like valueListChunks, for [<heads>..., <list of items>, <extras>...], given the
+# JSON text of each head
+def listChunks(headTexts, itemTexts, extras=()):
+  yield '[' + ''.join(text + ', ' for text in headTexts) + '['
+  separator = ''
+  for text in itemTexts:
+    yield separator + text
+    separator = ', '
+  yield ']' + ''.join(', ' + json.dumps(extra) for extra in extras) + ']'
+
+# Groups small pieces of output into chunks of about size characters
+def bufferedChunks(chunks, size=65536):
+  buffered = []
+  length = 0
+  for chunk in chunks:
+    buffered.append(chunk)
+    length += len(chunk)
+    if length >= size:
+      yield utf8(''.join(buffered))
+      buffered = []
+      length = 0
+  if buffered:
+    yield utf8(''.join(buffered))
+
+# Stored JSON text is unicode; responses are written as UTF-8 bytes
+def utf8(text):
+  if isinstance(text, unicode):
+    return text.encode('utf-8')
+  return text
+
+# The limit parameter of a paginated request (at most maxPageSize), or None
+# if the request is not paginated
+def pageLimit(handler):
+  limit = handler.request.get('limit')
+  if not limit:
+    return None
+  try:
+    limit = int(limit)
+  except ValueError:
+    handler.abort(400)
+  if limit <= 0:
+    handler.abort(400)
+  return min(limit, maxPageSize)
+
+# The page of entries selected by the limit and cursor parameters of a request,
+# and the cursor for the next page
+def scanPage(handler, limit):
+  try:
+    return store.scan_page(limit=limit, cursor=handler.request.get('cursor') or None)
+  except ValueError:
+    handler.abort(400)
+
+### Show the tags and values of a page of entries as a table, a row at a time.
+### The first page (unfiltered) also shows the special tags; the tags in *all_tags* are
+### listed only when the whole table fits on that page.
+def stored_entries_HTML(entries, firstPage, wholeTable):
+
+  # Stored tag/value entries
+  entries = [e for e in entries # Ordered by tag
+             if e.tag != allKeysTag] # Left over from older versions; shown below from the tag index
+
+  if firstPage:
+    ### AllKeys entry
+    if wholeTable:
+      allKeysValue = escape(json.dumps([e.tag for e in entries]))
+    else:
+      allKeysValue = '<i>A list of all other tags</i>'
+    allKeysTime = ""
+
+    # Special quadruples
+    quadruples = [[allKeysTag, allKeysValue, allKeysTime, True], 
+                  [allValuesTag, '<i>A list of all values, in the same order as all tags</i>', '', False], 
+                  [allTimestampsTag, '<i>A list of all timestamps, in the same order as all tags</i>', '', False], 
+                  [allEntriesTag, '<i>A list of all tag/value/timestamp triples</i>', '', False]]
+    for q in quadruples:
+      yield HTMLEntry(q[0], q[1], q[2], q[3])
+
+  for e in entries:
+    yield entryRowHTML(e)
+
+# The table row for a stored entry. Rows are kept in rowCache by namespace, tag and
+# date, so a row is only escaped and formatted again once its entry has been rewritten.
+def entryRowHTML(e):
+  key = (namespaces.namespace(), e.tag, e.date)
+  row = rowCache.get(key)
+  if row is None:
+  # row = HTMLEntry(escape(e.tag), escape(e.value), e.date.ctime(), True)
+    row = HTMLEntry(escape(e.tag), escape(e.value), timeString(e.date), True)
+    rowCache.put(key, row)
+  return row
+
+def HTMLEntry (tag, value, timestamp, hasDeleteButton):
+  # logging.info("HTMLEntry(" + tag + "," + value + "," + timestamp + "," + str(hasDeleteButton))
+  deleteButtonHTML = '<td></td>\n' # No delete button
+  if hasDeleteButton: 
+    deleteButtonHTML = '''
         <td>
-          <form action="/storeavalue" method="post"
+          <form action="storeavalue" method="post"
                 enctype=application/x-www-form-urlencoded>
             <input type="hidden" name="tag" value="{tag}">
 	    <input type="hidden" name="value" value="{deleteValue}">
@@ -520,7 +1442,7 @@ def stored_entries_HTML():
         </td>\n
         '''.format(tag=tag, deleteValue=deleteValue)
 
-    entryHTML = '''
+  entryHTML = '''
       <tr>
         <td>{tag}</td>
         <td>{value}</td>
@@ -529,36 +1451,7 @@ def stored_entries_HTML():
       </tr>
       '''.format(tag=tag, value=value, timestamp=timestamp, deleteButton=deleteButtonHTML)
 
-    return entryHTML
-
-  ### AllKeys entry
-  allKeysEntry = db.GqlQuery("SELECT * FROM StoredData where tag = :1", allKeysTag).get()
-  if allKeysEntry:
-    allKeysValue = allKeysEntry.value
-#   allKeysTime = allKeysEntry.date.ctime()
-    allKeysTime = timeString(allKeysEntry.date)
-  else:
-    allKeysValue = json.dumps([])
-    allKeysTime = ""
-
-  # Special quadruples
-  quadruples = [[allKeysTag, allKeysValue, allKeysTime, True], 
-                [allValuesTag, '<i>A list of all values, in the same order as all tags</i>', '', False], 
-                [allTimestampsTag, '<i>A list of all timestamps, in the same order as all tags</i>', '', False], 
-                [allEntriesTag, '<i>A list of all tag/value/timestamp triples</i>', '', False]]
-
-  # Stored tag/value entries
-  # This next line is replaced by the one under it, in order to help
-  # protect against SQL injection attacks.  Does it help enough?
-  entries = db.GqlQuery("SELECT * FROM StoredData ORDER BY tag")
-# keyValueQuadruples = [[escape(e.tag), escape(e.value), e.date.ctime(), True] 
-  keyValueQuadruples = [[escape(e.tag), escape(e.value), timeString(e.date), True] 
-                        for e in entries
-                        if e.tag != allKeysTag] # We've already shown all keys above 
-
-  quadruples.extend(keyValueQuadruples)
-  # logging.info("entries=" + str(entries))
-  return ''.join([HTMLEntry(q[0], q[1], q[2], q[3]) for q in quadruples])
+  return entryHTML
 
 #### Utilty procedures for generating the output
 
@@ -569,8 +1462,70 @@ def WritePhoneOrWeb(handler, prolog, writer):
   if handler.request.get('fmt') == "html":
     WritePhoneOrWebToWeb(handler, prolog, writer) # Only write prolog on web page 
   else:
-    handler.response.headers['Content-Type'] = 'application/jsonrequest'
-    writer()
+    handler.response.headers['Content-Type'] = jsonContentType(handler)
+    with tracing.span('write_response'):
+      writer()
+
+#### Like WritePhoneOrWeb, but the output is given as an iterable of strings.
+#### The phone gets them streamed as the response body; on the Web they are
+#### written out one at a time.
+def StreamPhoneOrWeb(handler, prolog, chunks):
+  if handler.request.get('fmt') == "html":
+    WritePhoneOrWebToWeb(handler, prolog, lambda : writeChunks(handler, chunks)) # Only write prolog on web page 
+  else:
+    handler.response.headers['Content-Type'] = jsonContentType(handler)
+    handler.response.app_iter = bufferedChunks(chunks)
+
+# A form with a button that posts params (those that are not empty) and fmt=html to
+# action. The admin requests that change something do so only when posted, and a GET
+# of them shows this instead, so that a link or image on another page cannot make an
+# admin's browser change anything.
+def postForm(action, label, params={}):
+  fields = ''.join('<input type="hidden" name="{name}" value="{value}">'.format(name=name, value=escape(value, True))
+                   for (name, value) in sorted(params.items()) if value)
+  return '''<form action="{action}" method="post" enctype=application/x-www-form-urlencoded>
+       {fields}<input type="hidden" name="fmt" value="html">
+       <input type="submit" value="{label}">
+    </form>'''.format(action=action, fields=fields, label=escape(label, True))
+
+def writePostPage(handler, action, label, params={}):
+  handler.response.headers['Content-Type'] = 'text/html'
+  handler.response.out.write('<html><body>\n    ' + postForm(action, label, params) + '</body></html>\n')
+
+#### Write result (a value JSON can hold) for a client that asked for MessagePack
+def WriteMessagePack(handler, result):
+  handler.response.headers['Content-Type'] = formats.CONTENT_TYPES[formats.MSGPACK]
+  with tracing.span('write_response'):
+    handler.response.out.write(formats.packed(result))
+
+# The format of the reply to a request (see formats.py): formats.PHONE, HTML, JSON
+# or MSGPACK. Aborts with 406 Not Acceptable if fmt asks for an unavailable format,
+# so handlers that reply in more than one format call it before doing anything else.
+def replyFormat(handler):
+  fmt = handler.request.get('fmt')
+  format = formats.negotiate(fmt, handler.request.headers.get('Accept', ''))
+  if format is None:
+    handler.abort(406, '%s replies are not available' % fmt)
+  if not fmt:
+    handler.response.headers['Vary'] = 'Accept'
+  return format
+
+# The content type of a JSON reply: application/json for clients that asked for
+# plain JSON (or MessagePack, available or not, where a request has no reply in it),
+# and otherwise App Inventor's application/jsonrequest. Never refuses the request,
+# which may already have stored something.
+def jsonContentType(handler):
+  fmt = handler.request.get('fmt')
+  format = formats.negotiate(fmt, handler.request.headers.get('Accept', ''))
+  if not fmt:
+    handler.response.headers['Vary'] = 'Accept'
+  if format in (None, formats.JSON, formats.MSGPACK):
+    return formats.CONTENT_TYPES[formats.JSON]
+  return formats.CONTENT_TYPES[formats.PHONE]
+
+def writeChunks(handler, chunks):
+  for chunk in chunks:
+    handler.response.out.write(chunk)
 
 #### Result when writing to the Web
 def WritePhoneOrWebToWeb(handler, prolog, writer):
@@ -580,20 +1535,17 @@ def WritePhoneOrWebToWeb(handler, prolog, writer):
   handler.response.out.write('''
   <em>The server will send this to the component:</em>
   <p />''')
-  writer()
+  with tracing.span('write_response'):
+    writer()
   WriteWebFooter(handler, writer)
 
 def WriteWebFooter(handler, writer):
   handler.response.out.write('''
-  <p><a href="/">
+  <p><a href="./">
   <i>Return to %s TinyWebDB Main Page</i>
   </a>''' % serverName)
   handler.response.out.write('</body></html>')
 
-### A utility that guards against attempts to delete a non-existent object
-def dbSafeDelete(key):
-  if db.get(key) :  db.delete(key)
-
 ### Escape HTML markup within strings within a JSON value
 listType = type([])
 dictType = type({})
@@ -627,32 +1579,42 @@ def escapeJSON(jsonValue):
   else:
     return jsonValue # Return other values unchanged (including base type values and objects/functions)
 
-## Check that a database specification has the form of tag/value pairs. 
-## Raise an exception when it does not.
-def verifyTagValuePairs(database):
-  if type(database) != listType:
-    raise Exception('database_not_a_list', database)
-  else:
-    for entry in database:
-      if type(entry) != listType:
-        raise Exception('entry_not_a_list', entry, database)
-      elif len(entry) != 2: 
-        raise Exception('entry_not_a_pair', entry, database)
-      elif not(isString(entry[0])):
-        raise Exception('entry_tag_not_a_string', entry, database)
-  # Get here only if all entries valid
-
 ### Assign the classes to the URLs
 
-application = webapp2.WSGIApplication([
+routes = [
     ('/', MainPage),
     ('/storeavalue', StoreAValue),
+    ('/storevalues', StoreValues),
     ## To delete, use /storeavalue with *delete* as value
     ## ('/deleteentry', DeleteEntry),
     ('/getvalue', GetValue),
+    ('/getvalues', GetValues),
+    ('/getprefix', GetPrefix),
+    ('/changes', Changes),
     ('/addentries', AddEntries),
-    ('/writeentries', WriteEntries)
-], debug=True)
+    ('/addentriestask', AddEntriesTask),
+    ('/writeentries', WriteEntries),
+    ('/migratekeys', MigrateKeys),
+    ('/truncate', Truncate),
+    ('/prunetombstones', PruneTombstones),
+    ('/cachestats', CacheStats),
+    ('/flushwrites', FlushWrites),
+    ('/metrics', Metrics),
+    ('/slowrequests', SlowRequests)
+]
+
+application = webapp2.WSGIApplication(routes, debug=True)
+# Compress large responses for clients that accept it
+application = compression.compress(application)
+# Count and time every request by handler for /metrics
+application = metrics.instrument(application, dict((path, handler.__name__) for (path, handler) in routes))
+# Handle every request in its namespace, given by a /ns/<namespace> URL prefix or parameter.
+# TINYWEBDB_NAMESPACES lists (comma separated) the namespaces allowed; if it is not set,
+# any TINYWEBDB_MAX_NAMESPACES (100 by default) are.
+application = namespaces.route(application,
+  [n.strip() for n in os.environ['TINYWEBDB_NAMESPACES'].split(',') if n.strip()]
+  if 'TINYWEBDB_NAMESPACES' in os.environ else None,
+  int(os.environ.get('TINYWEBDB_MAX_NAMESPACES', '100')))
 
 # [lyn, 2014/11/11] Remove these for webapp2
 # def main():
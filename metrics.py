@@ -0,0 +1,284 @@
+### Request and storage metrics for the TinyWebDB service, exposed by /metrics in
+### the Prometheus text format.
+###
+### instrument wraps the WSGI application so that every request is timed and
+### counted by handler, together with the size of its response, and
+### InstrumentedStorage wraps the storage engine so that every storage call is
+### counted and timed, both overall and per request. The numbers are kept per
+### process, so on App Engine each instance reports its own. Requests and storage
+### calls are also traced (see tracing.py).
+
+import collections
+import threading
+import time
+import types
+
+import storage
+import tracing
+
+# Upper bounds of the histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+CALL_COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 100, 1000)
+
+class Counter(object):
+
+  def __init__(self, name, help, labels=()):
+    self.name = name
+    self.help = help
+    self.labels = labels
+    self.lock = threading.Lock()
+    self.values = collections.defaultdict(float) # label values -> count
+
+  def inc(self, amount=1, **labels):
+    key = tuple(labels[label] for label in self.labels)
+    with self.lock:
+      self.values[key] += amount
+
+  def lines(self):
+    yield '# HELP %s %s' % (self.name, self.help)
+    yield '# TYPE %s counter' % self.name
+    with self.lock:
+      values = sorted(self.values.items())
+    for (key, value) in values:
+      yield '%s%s %s' % (self.name, labelText(self.labels, key), number(value))
+
+class Histogram(object):
+
+  def __init__(self, name, help, buckets, labels=()):
+    self.name = name
+    self.help = help
+    self.buckets = buckets
+    self.labels = labels
+    self.lock = threading.Lock()
+    self.values = {} # label values -> [count per bucket..., count, sum]
+
+  def observe(self, value, **labels):
+    key = tuple(labels[label] for label in self.labels)
+    with self.lock:
+      counts = self.values.get(key)
+      if counts is None:
+        counts = self.values[key] = [0] * (len(self.buckets) + 2)
+      for (i, bound) in enumerate(self.buckets):
+        if value <= bound:
+          counts[i] += 1
+      counts[-2] += 1
+      counts[-1] += value
+
+  def lines(self):
+    yield '# HELP %s %s' % (self.name, self.help)
+    yield '# TYPE %s histogram' % self.name
+    with self.lock:
+      values = sorted((key, list(counts)) for (key, counts) in self.values.items())
+    for (key, counts) in values:
+      for (bound, count) in zip(self.buckets, counts):
+        yield '%s_bucket%s %d' % (self.name, labelText(self.labels + ('le',), key + (number(bound),)), count)
+      yield '%s_bucket%s %d' % (self.name, labelText(self.labels + ('le',), key + ('+Inf',)), counts[-2])
+      yield '%s_sum%s %s' % (self.name, labelText(self.labels, key), number(counts[-1]))
+      yield '%s_count%s %d' % (self.name, labelText(self.labels, key), counts[-2])
+
+class Registry(object):
+
+  def __init__(self):
+    self.metrics = []
+
+  def counter(self, name, help, labels=()):
+    return self.add(Counter(name, help, labels))
+
+  def histogram(self, name, help, buckets, labels=()):
+    return self.add(Histogram(name, help, buckets, labels))
+
+  def add(self, metric):
+    self.metrics.append(metric)
+    return metric
+
+  # The text of every metric, in the Prometheus exposition format
+  def render(self):
+    return ''.join(line + '\n' for metric in self.metrics for line in metric.lines())
+
+def labelText(labels, values):
+  if not labels:
+    return ''
+  return '{%s}' % ','.join('%s="%s"' % (label, escapeLabelValue(value))
+                           for (label, value) in zip(labels, values))
+
+def escapeLabelValue(value):
+  if isinstance(value, unicode):
+    value = value.encode('utf-8')
+  return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def number(value):
+  if value == int(value):
+    return str(int(value))
+  return repr(value)
+
+registry = Registry()
+
+requests = registry.counter('tinywebdb_requests_total', 'Requests handled, by handler and status code.',
+                            ('handler', 'status'))
+requestSeconds = registry.histogram('tinywebdb_request_seconds', 'Time to handle a request and send its response.',
+                                    LATENCY_BUCKETS, ('handler',))
+responseBytes = registry.histogram('tinywebdb_response_bytes', 'Size of response bodies.',
+                                   SIZE_BUCKETS, ('handler',))
+storageCalls = registry.counter('tinywebdb_storage_calls_total', 'Storage engine calls, by method.',
+                                ('method',))
+storageSeconds = registry.histogram('tinywebdb_storage_call_seconds', 'Time spent in storage engine calls, by kind.',
+                                    LATENCY_BUCKETS, ('kind',))
+requestStorageCalls = registry.histogram('tinywebdb_request_storage_calls', 'Storage engine calls made by one request, by kind.',
+                                         CALL_COUNT_BUCKETS, ('handler', 'kind'))
+requestStorageSeconds = registry.histogram('tinywebdb_request_storage_seconds', 'Time one request spent in storage engine calls.',
+                                           LATENCY_BUCKETS, ('handler',))
+specialTags = registry.counter('tinywebdb_special_tag_requests_total', 'Reads and writes of special tags.',
+                               ('tag', 'operation'))
+
+# Count a read ('get') or write ('store') of a special tag
+def countSpecialTag(tag, operation):
+  specialTags.inc(tag=tag, operation=operation)
+
+## Storage calls
+
+# The kind each storage method is counted as; other methods count as 'other'
+STORAGE_CALL_KINDS = {'get': 'lookup', 'get_multi': 'lookup', 'get_multi_async': 'lookup',
+                      'scan': 'query', 'scan_page': 'query', 'tags': 'query', 'changes': 'query',
+                      'put': 'write', 'put_multi': 'write', 'write': 'write', 'write_async': 'write',
+                      'delete': 'delete', 'delete_multi': 'delete', 'truncate': 'delete',
+                      'prune_tombstones': 'delete'}
+KINDS = ('lookup', 'query', 'write', 'delete', 'other')
+
+# The storage calls of the request being handled by this thread: a dictionary
+# mapping each kind to the number of calls, and 'seconds' to their total time
+current = threading.local()
+
+def recordStorageCall(method, kind, start, seconds):
+  tracing.record('storage.' + method, start, seconds)
+  storageSeconds.observe(seconds, kind=kind)
+  calls = getattr(current, 'calls', None)
+  if calls is not None:
+    calls[kind] += 1
+    calls['seconds'] += seconds
+
+# Wraps a storage engine (see storage.py), counting and timing each call of its
+# methods. A call that returns a generator is timed while the generator runs, and
+# one that returns a Future while it is started and while its result is waited for.
+class InstrumentedStorage(object):
+
+  def __init__(self, storage):
+    self.storage = storage
+
+  def __getattr__(self, name):
+    attribute = getattr(self.storage, name)
+    if name.startswith('_') or not callable(attribute):
+      return attribute
+    kind = STORAGE_CALL_KINDS.get(name, 'other')
+    if kind == 'other' and name in ('version', 'changed'):
+      return attribute # Bookkeeping rather than storage work
+    def call(*args, **kwargs):
+      storageCalls.inc(method=name)
+      start = time.time()
+      try:
+        result = attribute(*args, **kwargs)
+      except:
+        recordStorageCall(name, kind, start, time.time() - start)
+        raise
+      seconds = time.time() - start
+      if isinstance(result, types.GeneratorType):
+        return timedIterator(result, name, kind, start, seconds)
+      if isinstance(result, storage.Future):
+        return timedFuture(result, name, kind, start, seconds)
+      recordStorageCall(name, kind, start, seconds)
+      return result
+    return call
+
+# Iterate over iterator, recording the time spent in it (starting with seconds,
+# from start) once it is done
+def timedIterator(iterator, method, kind, start, seconds):
+  try:
+    while True:
+      resumed = time.time()
+      try:
+        item = next(iterator)
+      except StopIteration:
+        return
+      finally:
+        seconds += time.time() - resumed
+      yield item
+  finally:
+    recordStorageCall(method, kind, start, seconds)
+
+# A Future of the result of future, recording the time spent waiting for it (on
+# top of seconds, from start) once it is done
+def timedFuture(future, method, kind, start, seconds):
+  def wait():
+    waited = time.time()
+    try:
+      return future.get_result()
+    finally:
+      recordStorageCall(method, kind, start, seconds + time.time() - waited)
+  return storage.Future(wait)
+
+## Requests
+
+# Wrap the WSGI application so that each request is counted and timed under the
+# name of its handler, found in handlerNames (a dictionary mapping paths to names).
+# The time includes sending a streamed response. Each request is traced as well.
+def instrument(application, handlerNames):
+
+  def instrumented(environ, start_response):
+    handler = handlerNames.get(environ.get('PATH_INFO', ''), 'other')
+    status = []
+    def startResponse(statusLine, headers, exc_info=None):
+      status[:] = [statusLine.split(' ', 1)[0]]
+      return start_response(statusLine, headers, exc_info) if exc_info else start_response(statusLine, headers)
+    calls = current.calls = dict((kind, 0) for kind in KINDS)
+    calls['seconds'] = 0.0
+    trace = tracing.begin(environ.get('REQUEST_METHOD', ''), environ.get('PATH_INFO', ''))
+    start = time.time()
+    try:
+      body = application(environ, startResponse)
+    except:
+      finish(handler, '500', start, 0, calls, trace)
+      raise
+    return MeasuredBody(body, handler, status, start, calls, trace)
+
+  return instrumented
+
+# A response body that records the request once it has been sent: when it has
+# been iterated over or closed, whichever happens first.
+class MeasuredBody(object):
+
+  def __init__(self, body, handler, status, start, calls, trace):
+    self.body = body
+    self.handler = handler
+    self.status = status
+    self.start = start
+    self.calls = calls
+    self.trace = trace
+    self.size = 0
+    self.finished = False
+
+  def __iter__(self):
+    for chunk in self.body:
+      self.size += len(chunk)
+      yield chunk
+    self.finish()
+
+  def close(self):
+    if hasattr(self.body, 'close'):
+      self.body.close()
+    self.finish()
+
+  def finish(self):
+    if not self.finished:
+      self.finished = True
+      finish(self.handler, self.status[0] if self.status else '500', self.start, self.size, self.calls, self.trace)
+
+def finish(handler, status, start, size, calls, trace):
+  requests.inc(handler=handler, status=status)
+  requestSeconds.observe(time.time() - start, handler=handler)
+  responseBytes.observe(size, handler=handler)
+  for kind in KINDS:
+    requestStorageCalls.observe(calls[kind], handler=handler, kind=kind)
+  requestStorageSeconds.observe(calls['seconds'], handler=handler)
+  if getattr(current, 'calls', None) is calls:
+    current.calls = None
+  tracing.end(trace, handler, status)
@@ -0,0 +1,116 @@
+### Namespaces for the TinyWebDB service.
+###
+### Several apps can share one deployment without sharing their data. Each
+### request belongs to a namespace: the one named by a /ns/<namespace>/ prefix
+### of its URL (so an App Inventor app only needs its TinyWebDB ServiceURL set to
+### http://<server>/ns/<namespace>), or else by its namespace parameter, or else
+### the default namespace, ''. Every namespace has its own entries, tag index,
+### change version and tombstones, kept apart by the storage engine (see
+### Storage.for_namespace), so listing, truncating or exporting one namespace
+### only touches that namespace, and writes to different namespaces never contend.
+###
+### route wraps the WSGI application to find the namespace of each request, and
+### NamespacedStorage sends each storage call to the engine of that namespace.
+### Every namespace used keeps an engine (and, on SQLite, a database; with write-behind,
+### a buffer) for as long as the process lives, and clients choose the names, so
+### route only accepts the names allowed, or else at most max_namespaces different
+### ones (besides the default namespace) per process.
+
+import re
+import threading
+
+import webob
+import webob.exc
+
+# The names App Engine allows for namespaces. They never contain ':' (see cacheKey).
+NAME_PATTERN = re.compile(r'[0-9A-Za-z._-]{1,100}$')
+PATH_PATTERN = re.compile(r'/ns/([^/]*)')
+
+# The namespace of the request being handled by this thread
+current = threading.local()
+
+def namespace():
+  return getattr(current, 'namespace', '')
+
+# The key under which caches keep name (such as a tag) for the current namespace,
+# or for the namespace space if given
+def cacheKey(name, space=None):
+  if space is None:
+    space = namespace()
+  return space + ':' + name
+
+# The URL of path (which starts with '/') within the current namespace
+def path(path):
+  if namespace():
+    return '/ns/' + namespace() + path
+  return path
+
+# Wrap the WSGI application so that each request is handled in its namespace.
+# A /ns/<namespace> prefix is dropped from PATH_INFO (webapp2 routes on the whole
+# path, SCRIPT_NAME included), so the application sees the same paths in every
+# namespace. If allowed (a list of names) is given, requests for other namespaces
+# are refused; otherwise, once max_namespaces have been used, requests for a new one
+# are (with 403 Forbidden).
+def route(application, allowed=None, max_namespaces=100):
+  used = set()
+  usedLock = threading.Lock()
+
+  def accepted(name):
+    if not name:
+      return True
+    if allowed is not None:
+      return name in allowed
+    with usedLock:
+      if name not in used and len(used) >= max_namespaces:
+        return False
+      used.add(name)
+      return True
+
+  def routed(environ, start_response):
+    path = environ.get('PATH_INFO', '')
+    match = PATH_PATTERN.match(path)
+    if match:
+      name = match.group(1)
+      if not NAME_PATTERN.match(name):
+        return webob.exc.HTTPBadRequest('bad namespace')(environ, start_response)
+      if match.end() == len(path): # Relative links on the main page need the slash
+        location = environ.get('SCRIPT_NAME', '') + path + '/'
+        return webob.exc.HTTPMovedPermanently(location=location)(environ, start_response)
+      environ['PATH_INFO'] = path[match.end():]
+    else:
+      name = webob.Request(environ).params.get('namespace', '')
+    if name and not NAME_PATTERN.match(name):
+      return webob.exc.HTTPBadRequest('bad namespace')(environ, start_response)
+    if not accepted(name):
+      return webob.exc.HTTPForbidden('namespace not available')(environ, start_response)
+    current.namespace = str(name) # Also while a streamed response is sent
+    return application(environ, start_response)
+
+  return routed
+
+# Wraps the storage engine of the default namespace, passing each call on to the
+# engine of the current namespace. Engines are made as namespaces are first used,
+# and kept, so there are only as many as route accepts namespaces.
+class NamespacedStorage(object):
+
+  def __init__(self, storage):
+    self.storage = storage
+    self.lock = threading.Lock()
+    self.engines = {'': storage} # namespace -> engine
+
+  def engine(self):
+    name = namespace()
+    with self.lock:
+      engine = self.engines.get(name)
+      if engine is None:
+        engine = self.engines[name] = self.storage.for_namespace(name)
+    return engine
+
+  # The namespaces the engine knows of, with those used since this instance started
+  def namespaces(self):
+    with self.lock:
+      used = list(self.engines.keys())
+    return sorted(set(self.storage.namespaces()) | set(used))
+
+  def __getattr__(self, name):
+    return getattr(self.engine(), name)
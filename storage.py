@@ -0,0 +1,591 @@
+### Storage engines for the TinyWebDB service.
+###
+### The request handlers in main.py never talk to google.appengine.ext.db
+### directly. Instead they go through a Storage object, which maps tags to
+### the JSON text of their values. Two engines are provided:
+###
+### + DatastoreStorage (datastore_storage.py), which keeps entries in the
+###   StoredData kind of the App Engine datastore. This is the default.
+### + SQLiteStorage (this file), which keeps entries in a local SQLite
+###   database. With the file name ":memory:" it is a purely in-memory store,
+###   handy for load tests and for running without the App Engine SDK.
+###
+### The engine is chosen by the TINYWEBDB_STORAGE environment variable
+### (see make_storage below).
+###
+### Both engines also keep what the change feed (Storage.changes) needs: entries
+### can be found by date, a deleted entry leaves a tombstone (its tag and the
+### date it was deleted), and a truncation of the whole database is recorded with
+### the date it started. A tag stored again loses its tombstone, so there is never
+### more than one per tag, and old tombstones are deleted by prune_tombstones, which
+### records the date they were kept from.
+###
+### An engine holds the entries of one namespace (see namespaces.py), and gives
+### the engine of any other namespace through for_namespace.
+###
+### Lookups and writes can also be started asynchronously (get_multi_async and
+### write_async), returning a Future, so that a request can overlap storage calls
+### that do not depend on each other, and its own work with them. The datastore
+### engine issues such calls as asynchronous RPCs; SQLiteStorage, which has
+### nothing to overlap, does the work at once and returns a finished Future.
+
+import base64
+import datetime
+import glob
+import itertools
+import os
+import sqlite3
+import threading
+import zlib
+
+# Number of rows SQLiteStorage.scan reads per query
+SCAN_BATCH_SIZE = 500
+
+# Values of at least compressMinSize characters are stored compressed, if that makes
+# them smaller. 0 (the default) turns compression off; compressed values already
+# stored can always be read.
+compressMinSize = int(os.environ.get('TINYWEBDB_COMPRESS_VALUES', '0'))
+# Marks a compressed value. No JSON text starts with it.
+COMPRESSED_PREFIX = '~z:'
+
+# Change feed positions are dates, given as microseconds since EPOCH
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# Raised by Storage.write when an atomic write could not be applied (for instance
+# because of contention). Nothing has been written.
+class WriteFailed(Exception):
+  pass
+
+# Raised by Storage.changes when asked for the changes after a position older than
+# the tombstones kept (see prune_tombstones): deletions since then may be missing.
+class PositionExpired(Exception):
+  pass
+
+# The result of an asynchronous storage call. get_result waits for the call to
+# finish (calling wait, once) and returns its result, or raises its exception.
+class Future(object):
+
+  def __init__(self, wait):
+    self.wait = wait
+    self.done = False
+    self.result = None
+    self.error = None
+
+  def get_result(self):
+    if not self.done:
+      self.done = True
+      try:
+        self.result = self.wait()
+      except Exception as error:
+        self.error = error
+    if self.error is not None:
+      raise self.error
+    return self.result
+
+# A Future of function(*args), called now
+def finished(function, *args):
+  try:
+    result = function(*args)
+  except Exception as error:
+    def wait():
+      raise error
+    return Future(wait)
+  return Future(lambda : result)
+
+# An entry returned by a Storage engine. value is the JSON text of the value
+# and date is the (GMT) datetime at which the entry was last written. An engine
+# may give the value as stored, compressed or not (see encodeValue); it is only
+# decompressed when it is first asked for.
+class Entry(object):
+
+  def __init__(self, tag, value, date):
+    self.tag = tag
+    self.storedValue = value
+    self.date = date
+
+  @property
+  def value(self):
+    if isCompressed(self.storedValue):
+      self.storedValue = decodeValue(self.storedValue)
+    return self.storedValue
+
+  def __repr__(self):
+    return 'Entry(%r, %r, %r)' % (self.tag, self.storedValue, self.date)
+
+# The interface every storage engine implements. Values are always JSON text;
+# encoding and decoding is left to the caller.
+class Storage(object):
+
+  # The most tags an atomic write may touch, or None if there is no limit
+  max_atomic_tags = None
+
+  # How many seconds after a write queries (scan, tags, changes) may still not
+  # reflect it. Lookups by tag always do.
+  settle_seconds = 0
+
+  # Return the Entry stored at tag, or None if there is none.
+  def get(self, tag):
+    raise NotImplementedError()
+
+  # Return a list with the Entry (or None) for each tag in tags, in order.
+  def get_multi(self, tags):
+    return [self.get(tag) for tag in tags]
+
+  # Store value (JSON text) at tag, returning the new Entry.
+  def put(self, tag, value):
+    raise NotImplementedError()
+
+  # Store each (tag, value) pair in pairs, returning the new Entries.
+  def put_multi(self, pairs):
+    return [self.put(tag, value) for (tag, value) in pairs]
+
+  # Delete the entry stored at tag. Deleting a missing tag does nothing.
+  def delete(self, tag):
+    raise NotImplementedError()
+
+  def delete_multi(self, tags):
+    for tag in tags:
+      self.delete(tag)
+
+  # Store the (tag, value) pairs of puts and delete the tags of deletes. With
+  # atomic, either all of it happens or (raising WriteFailed) none of it does,
+  # and at most max_atomic_tags tags may be involved.
+  def write(self, puts, deletes, atomic=False):
+    if atomic:
+      raise WriteFailed('atomic writes are not supported')
+    self.put_multi(puts)
+    self.delete_multi(deletes)
+
+  # Start get_multi(tags), returning a Future of its result. Unless an engine
+  # can overlap calls, the lookup is made at once.
+  def get_multi_async(self, tags):
+    return finished(self.get_multi, tags)
+
+  # Start write(puts, deletes, atomic), returning a Future of the new Entries of
+  # puts. Unless an engine can overlap calls, the write is made at once.
+  def write_async(self, puts, deletes, atomic=False):
+    return finished(self.write, puts, deletes, atomic)
+
+  # Iterate over the entries ordered by tag, from start (inclusive) to
+  # end (exclusive). Either bound may be None for an open range.
+  def scan(self, start=None, end=None):
+    raise NotImplementedError()
+
+  # Return (entries, next cursor): a list of at most limit entries of the
+  # range [start, end) in tag order, starting where the page that returned
+  # cursor left off (or at the beginning if cursor is None). The next cursor
+  # is None after the last page. Cursors are opaque, URL-safe strings.
+  #
+  # This default implementation resumes a scan after the last tag of the
+  # previous page.
+  def scan_page(self, start=None, end=None, limit=100, cursor=None):
+    after = None
+    if cursor:
+      after = decodeCursor(cursor)
+      if start is None or after > start:
+        start = after
+    entries = (e for e in self.scan(start, end) if e.tag != after)
+    page = list(itertools.islice(entries, limit))
+    if len(page) < limit:
+      return (page, None)
+    return (page, encodeCursor(page[-1].tag))
+
+  # Iterate over the tags in the range [start, end) in order, without fetching
+  # their values. This is the tag index behind *all_tags*.
+  def tags(self, start=None, end=None):
+    return (e.tag for e in self.scan(start, end))
+
+  # Return the change version: a number that changes whenever an entry is
+  # stored or deleted, so results computed from the whole database can be
+  # reused for as long as it stays the same. None means that the version is
+  # unknown and nothing should be reused.
+  def version(self):
+    return None
+
+  # Re-key up to batch_size entries written by older versions of the service,
+  # starting at cursor. Returns (number re-keyed, next cursor), where the next
+  # cursor is None when done. Engines that always key entries by tag have
+  # nothing to do.
+  def migrate_keys(self, batch_size, cursor=None):
+    return (0, None)
+
+  # Return (changes, position, truncated): the entries stored or deleted after
+  # position (see datePosition), oldest first, where a deleted entry has the value
+  # None; the position to ask from next time; and the date the whole database was
+  # last truncated, if that happened after position (None otherwise), in which case
+  # the changes start at the truncation. At most limit changes are returned, except
+  # that changes made at the same moment are never split between two calls.
+  # Changes are only returned once they are settle_seconds old, so that one a query
+  # does not reflect yet is not passed over for a later one that it does. Raises
+  # PositionExpired if tombstones made after position have been pruned.
+  def changes(self, since, limit=100):
+    after = positionDate(since)
+    truncated = self.truncated_at()
+    if truncated is None or truncated <= after:
+      truncated = None
+    else:
+      after = truncated
+    pruned = self.pruned_at()
+    if pruned is not None and after < pruned:
+      raise PositionExpired('tombstones before %s have been pruned' % pruned)
+    horizon = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.settle_seconds)
+    changes = self.changes_after(after, limit)
+    settled = [c for c in changes if c.date <= horizon]
+    if len(settled) < len(changes):
+      changes = settled # Every settled change after position
+    elif len(changes) >= limit:
+      last = changes[-1].date
+      changes = [c for c in changes if c.date < last] + self.changes_at(last)
+    if changes:
+      after = changes[-1].date
+    return (changes, max(since, datePosition(after)), truncated)
+
+  # Return a list of at most limit changes (see changes) made after date, ordered
+  # by date and then by tag.
+  def changes_after(self, date, limit):
+    raise NotImplementedError()
+
+  # Return a list of the changes made at date, ordered by tag.
+  def changes_at(self, date):
+    raise NotImplementedError()
+
+  # Return the date at which the last truncation of the database started, or None.
+  def truncated_at(self):
+    return None
+
+  # Delete up to batch_size tombstones made before the date before, starting where
+  # the call that returned cursor left off. The first call records before (see
+  # pruned_at). Returns (number deleted, next cursor), where the next cursor is None
+  # once none are left. Engines without tombstones have nothing to do.
+  def prune_tombstones(self, before, batch_size, cursor=None):
+    return (0, None)
+
+  # Return the date before which tombstones may have been pruned, or None.
+  def pruned_at(self):
+    return None
+
+  # Return the names of the namespaces (see for_namespace) that may hold entries.
+  def namespaces(self):
+    return ['']
+
+  # Return an engine of the same kind for the namespace (a name of at most 100
+  # letters, digits, '.', '_' and '-'), whose entries are kept apart from those of
+  # every other namespace. The namespace '' is this engine's own.
+  def for_namespace(self, namespace):
+    if not namespace:
+      return self
+    raise NotImplementedError()
+
+  # Delete up to batch_size entries, starting where the call that returned
+  # cursor left off (or at the beginning if cursor is None), without reading
+  # their values. Returns (number deleted, deleted tags, next cursor), where
+  # the next cursor is None once every entry has been deleted. Engines that record
+  # the start of a truncation (see truncated_at) only delete the entries stored
+  # before it, so that nothing stored after a truncation started is lost.
+  def truncate(self, batch_size, cursor=None):
+    after = None
+    if cursor:
+      after = decodeCursor(cursor)
+    tags = list(itertools.islice((tag for tag in self.tags(after) if tag != after), batch_size))
+    self.delete_multi(tags)
+    if len(tags) < batch_size:
+      return (len(tags), tags, None)
+    return (len(tags), tags, encodeCursor(tags[-1]))
+
+# A Storage engine on top of the sqlite3 module. A single connection is
+# shared by all request threads (app.yaml says threadsafe: true), so every
+# operation holds a lock.
+class SQLiteStorage(Storage):
+
+  def __init__(self, filename=':memory:'):
+    self.filename = filename
+    self.lock = threading.RLock()
+    self.connection = sqlite3.connect(filename, check_same_thread=False,
+                                      detect_types=sqlite3.PARSE_DECLTYPES)
+    self.connection.execute('''CREATE TABLE IF NOT EXISTS StoredData (
+                                 tag TEXT PRIMARY KEY,
+                                 value TEXT,
+                                 date TIMESTAMP NOT NULL)''')
+    self.connection.execute('CREATE INDEX IF NOT EXISTS StoredDataDate ON StoredData (date)')
+    self.connection.execute('''CREATE TABLE IF NOT EXISTS Tombstones (
+                                 tag TEXT PRIMARY KEY,
+                                 date TIMESTAMP NOT NULL)''')
+    self.connection.execute('CREATE INDEX IF NOT EXISTS TombstonesDate ON Tombstones (date)')
+    # A single row holding the date the last truncation started
+    self.connection.execute('''CREATE TABLE IF NOT EXISTS Truncation (
+                                 id INTEGER PRIMARY KEY CHECK (id = 0),
+                                 date TIMESTAMP NOT NULL)''')
+    # A single row holding the date before which tombstones have been pruned
+    self.connection.execute('''CREATE TABLE IF NOT EXISTS Pruning (
+                                 id INTEGER PRIMARY KEY CHECK (id = 0),
+                                 date TIMESTAMP NOT NULL)''')
+    # A single row holding the change version, bumped in the same transaction
+    # as every write
+    self.connection.execute('''CREATE TABLE IF NOT EXISTS Changes (
+                                 id INTEGER PRIMARY KEY CHECK (id = 0),
+                                 version INTEGER NOT NULL)''')
+    self.connection.execute('INSERT OR IGNORE INTO Changes (id, version) VALUES (0, 0)')
+    self.connection.commit()
+
+  def get(self, tag):
+    with self.lock:
+      row = self.connection.execute(
+        'SELECT tag, value, date FROM StoredData WHERE tag = ?', (tag,)).fetchone()
+    return rowEntry(row)
+
+  def get_multi(self, tags):
+    tags = list(tags)
+    found = {}
+    with self.lock:
+      # Stay well below SQLite's limit on the number of host parameters
+      for i in range(0, len(tags), 500):
+        chunk = tags[i:i + 500]
+        rows = self.connection.execute(
+          'SELECT tag, value, date FROM StoredData WHERE tag IN (%s)'
+          % ','.join('?' * len(chunk)), chunk)
+        for row in rows:
+          found[row[0]] = rowEntry(row)
+    return [found.get(tag) for tag in tags]
+
+  def put(self, tag, value):
+    return self.put_multi([(tag, value)])[0]
+
+  def put_multi(self, pairs):
+    return self.write(pairs, [])
+
+  def delete(self, tag):
+    self.delete_multi([tag])
+
+  def delete_multi(self, tags):
+    self.write([], tags)
+
+  # Every write is a single transaction, so atomic needs no extra work. The date
+  # is taken while holding the lock, so that dates follow the order of the writes.
+  def write(self, puts, deletes, atomic=False):
+    with self.lock:
+      now = datetime.datetime.utcnow()
+      entries = [Entry(tag, value, now) for (tag, value) in puts]
+      with self.connection:
+        self.connection.executemany(
+          'INSERT OR REPLACE INTO StoredData (tag, value, date) VALUES (?, ?, ?)',
+          [(e.tag, encodeValue(e.value), e.date) for e in entries])
+        self.connection.executemany('DELETE FROM Tombstones WHERE tag = ?',
+                                    [(e.tag,) for e in entries])
+        for tag in deletes:
+          if self.connection.execute('DELETE FROM StoredData WHERE tag = ?', (tag,)).rowcount:
+            self.connection.execute('INSERT OR REPLACE INTO Tombstones (tag, date) VALUES (?, ?)', (tag, now))
+        self.changed()
+    return entries
+
+  # Must be called within the transaction making the change
+  def changed(self):
+    self.connection.execute('UPDATE Changes SET version = version + 1 WHERE id = 0')
+
+  def version(self):
+    with self.lock:
+      return self.connection.execute('SELECT version FROM Changes WHERE id = 0').fetchone()[0]
+
+  # Read SCAN_BATCH_SIZE rows at a time, so that a long scan neither holds
+  # the lock nor keeps all rows in memory.
+  def scan(self, start=None, end=None):
+    after = None
+    while True:
+      (where, params) = tagRange(start, end, after)
+      with self.lock:
+        rows = self.connection.execute(
+          'SELECT tag, value, date FROM StoredData %s ORDER BY tag LIMIT %d'
+          % (where, SCAN_BATCH_SIZE), params).fetchall()
+      for row in rows:
+        yield rowEntry(row)
+      if len(rows) < SCAN_BATCH_SIZE:
+        return
+      after = rows[-1][0]
+
+  def scan_page(self, start=None, end=None, limit=100, cursor=None):
+    after = None
+    if cursor:
+      after = decodeCursor(cursor)
+    (where, params) = tagRange(start, end, after)
+    with self.lock:
+      rows = self.connection.execute(
+        'SELECT tag, value, date FROM StoredData %s ORDER BY tag LIMIT %d'
+        % (where, limit), params).fetchall()
+    page = [rowEntry(row) for row in rows]
+    if len(page) < limit:
+      return (page, None)
+    return (page, encodeCursor(page[-1].tag))
+
+  def tags(self, start=None, end=None):
+    (where, params) = tagRange(start, end)
+    with self.lock:
+      rows = self.connection.execute(
+        'SELECT tag FROM StoredData %s ORDER BY tag' % where, params).fetchall()
+    return [row[0] for row in rows]
+
+  # Finding and deleting the batch is one transaction. The first batch records the
+  # start of the truncation, and every batch only deletes entries stored no later
+  # than that (writes take their date under the lock), so entries stored while the
+  # truncation goes on are kept. The cursor is the last tag looked at.
+  def truncate(self, batch_size, cursor=None):
+    after = None
+    if cursor:
+      after = decodeCursor(cursor)
+    (where, params) = tagRange(None, None, after)
+    with self.lock:
+      now = datetime.datetime.utcnow()
+      with self.connection:
+        if cursor is None:
+          self.connection.execute('INSERT OR REPLACE INTO Truncation (id, date) VALUES (0, ?)', (now,))
+        started = self.truncated_at()
+        rows = self.connection.execute(
+          'SELECT tag, date FROM StoredData %s ORDER BY tag LIMIT %d' % (where, batch_size), params).fetchall()
+        tags = [tag for (tag, date) in rows if started is None or date <= started]
+        self.connection.executemany('DELETE FROM StoredData WHERE tag = ?',
+                                    [(tag,) for tag in tags])
+        if tags or cursor is None:
+          self.changed()
+    if len(rows) < batch_size:
+      return (len(tags), tags, None)
+    return (len(tags), tags, encodeCursor(rows[-1][0]))
+
+  # Stored entries and tombstones are found through their date indexes
+  def changes_after(self, date, limit):
+    return self.changesWhere('date > ?', date, limit)
+
+  def changes_at(self, date):
+    return self.changesWhere('date = ?', date)
+
+  def changesWhere(self, condition, date, limit=None):
+    with self.lock:
+      rows = self.connection.execute(
+        '''SELECT tag, value, date FROM StoredData WHERE %s
+           UNION ALL SELECT tag, NULL, date FROM Tombstones WHERE %s
+           ORDER BY date, tag%s''' % (condition, condition, ' LIMIT %d' % limit if limit is not None else ''),
+        (date, date)).fetchall()
+    return [rowEntry(row) for row in rows]
+
+  def truncated_at(self):
+    with self.lock:
+      row = self.connection.execute('SELECT date FROM Truncation WHERE id = 0').fetchone()
+    return row[0] if row else None
+
+  # Tombstones are deleted oldest first; the cursor is the position of the last one
+  # deleted. Writes of their tags take the lock, so none is replaced meanwhile.
+  def prune_tombstones(self, before, batch_size, cursor=None):
+    with self.lock:
+      with self.connection:
+        if cursor is None:
+          pruned = self.pruned_at()
+          if pruned is None or pruned < before:
+            self.connection.execute('INSERT OR REPLACE INTO Pruning (id, date) VALUES (0, ?)', (before,))
+          start = EPOCH
+        else:
+          start = positionDate(int(cursor))
+        rows = self.connection.execute(
+          'SELECT tag, date FROM Tombstones WHERE date >= ? AND date < ? ORDER BY date LIMIT %d' % batch_size,
+          (start, before)).fetchall()
+        self.connection.executemany('DELETE FROM Tombstones WHERE tag = ?', [(row[0],) for row in rows])
+    if len(rows) < batch_size:
+      return (len(rows), None)
+    return (len(rows), str(datePosition(rows[-1][1])))
+
+  def pruned_at(self):
+    with self.lock:
+      row = self.connection.execute('SELECT date FROM Pruning WHERE id = 0').fetchone()
+    return row[0] if row else None
+
+  # The namespaces are the databases named like this one (see for_namespace)
+  def namespaces(self):
+    if self.filename == ':memory:':
+      return ['']
+    (root, extension) = os.path.splitext(self.filename)
+    return [''] + [name[len(root) + 1:len(name) - len(extension)]
+                   for name in sorted(glob.glob('%s.*%s' % (root, extension)))]
+
+  # Each namespace is a database of its own (with a connection and lock of its own):
+  # another in-memory database, or the file named like this one, with the namespace
+  # before its extension
+  def for_namespace(self, namespace):
+    if not namespace:
+      return self
+    if self.filename == ':memory:':
+      return SQLiteStorage(':memory:')
+    (root, extension) = os.path.splitext(self.filename)
+    return SQLiteStorage('%s.%s%s' % (root, namespace, extension))
+
+# The WHERE clause (and its parameters) selecting tags in [start, end)
+# that come after the tag after (if any)
+def tagRange(start, end, after=None):
+  clauses = []
+  params = []
+  if start is not None:
+    clauses.append('tag >= ?')
+    params.append(start)
+  if end is not None:
+    clauses.append('tag < ?')
+    params.append(end)
+  if after is not None:
+    clauses.append('tag > ?')
+    params.append(after)
+  if clauses:
+    return ('WHERE ' + ' AND '.join(clauses), params)
+  return ('', params)
+
+# The end of the range of tags starting with prefix (which must not be empty), for scan,
+# scan_page and tags: the least string after all of them
+def prefixEnd(prefix):
+  return prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+
+# A cursor that resumes a scan after the given tag
+def encodeCursor(tag):
+  return base64.urlsafe_b64encode(tag.encode('utf-8'))
+
+def decodeCursor(cursor):
+  try:
+    return base64.urlsafe_b64decode(str(cursor)).decode('utf-8')
+  except (TypeError, ValueError):
+    raise ValueError('bad cursor: %s' % cursor)
+
+# The text to store for the JSON text value: the value itself, or if it is long,
+# COMPRESSED_PREFIX followed by the base64 encoding of its UTF-8 text compressed with zlib
+def encodeValue(value):
+  if not compressMinSize or len(value) < compressMinSize:
+    return value
+  encoded = COMPRESSED_PREFIX + base64.b64encode(zlib.compress(value.encode('utf-8')))
+  if len(encoded) >= len(value):
+    return value
+  return encoded
+
+def isCompressed(text):
+  return text is not None and text.startswith(COMPRESSED_PREFIX)
+
+def decodeValue(text):
+  return zlib.decompress(base64.b64decode(text[len(COMPRESSED_PREFIX):])).decode('utf-8')
+
+# The change feed position of date
+def datePosition(date):
+  delta = date - EPOCH
+  return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+def positionDate(position):
+  return EPOCH + datetime.timedelta(microseconds=position)
+
+def rowEntry(row):
+  if row is None:
+    return None
+  return Entry(row[0], row[1], row[2])
+
+# Build the storage engine described by spec, which is one of
+#   datastore           -- the App Engine datastore (the default)
+#   memory              -- an in-memory SQLite database
+#   sqlite:<filename>   -- a SQLite database in the given file
+def make_storage(spec):
+  if not spec or spec == 'datastore':
+    import datastore_storage # Needs the App Engine SDK, so only import it on demand
+    return datastore_storage.DatastoreStorage()
+  elif spec == 'memory':
+    return SQLiteStorage(':memory:')
+  elif spec.startswith('sqlite:'):
+    return SQLiteStorage(spec[len('sqlite:'):])
+  else:
+    raise ValueError('unknown storage engine: %s' % spec)
@@ -0,0 +1,96 @@
+### A concurrent write stress run against a local storage engine.
+###
+### Many threads drive main.application through WSGI at once, each storing
+### (and now and then deleting) its own tags with /storeavalue and
+### /storevalues while all of them also keep overwriting one shared tag.
+### Afterwards the run checks that *all_tags* lists exactly the tags that
+### should exist and that every one of them holds its last value, and reports
+### the throughput reached. It exits with status 1 if anything was lost.
+###
+### Usage: python stress.py [--threads N] [--ops N] [--storage SPEC]
+### where SPEC is a TINYWEBDB_STORAGE value (memory by default; the datastore
+### engine needs the App Engine SDK).
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+sharedTag = 'shared'
+
+# Send a POST to application and return the decoded JSON reply
+def post(application, path, params):
+  import webapp2
+  response = webapp2.Request.blank(path, POST=params).get_response(application)
+  if response.status_int != 200:
+    raise Exception('%s returned %s' % (path, response.status))
+  return json.loads(response.body)
+
+# The work of one thread: ops writes of its own tags, every fifth one a batch
+# of five through /storevalues, every seventh one deleting an earlier tag, and
+# every third one overwriting the shared tag. Records what should be stored.
+def worker(application, number, ops, expected, failures):
+  mine = {}
+  try:
+    for i in range(ops):
+      tag = 't%d:%d' % (number, i)
+      if i % 5 == 0:
+        pairs = [[tag + ':%d' % k, [number, i, k]] for k in range(5)]
+        post(application, '/storevalues', {'entries': json.dumps(pairs)})
+        for (t, value) in pairs:
+          mine[t] = value
+      else:
+        post(application, '/storeavalue', {'tag': tag, 'value': json.dumps([number, i])})
+        mine[tag] = [number, i]
+      if i % 7 == 6:
+        victim = 't%d:%d' % (number, i - 3)
+        post(application, '/storeavalue', {'tag': victim, 'value': json.dumps('*delete*')})
+        mine.pop(victim, None)
+      if i % 3 == 0:
+        post(application, '/storeavalue', {'tag': sharedTag, 'value': json.dumps([number, i])})
+  except Exception as error:
+    failures.append(error)
+  expected.update(mine) # Threads write disjoint tags
+
+def run(threadCount, ops, spec):
+  os.environ['TINYWEBDB_STORAGE'] = spec
+  os.environ.setdefault('TINYWEBDB_CACHE', 'local')
+  import main
+  expected = {}
+  failures = []
+  threads = [threading.Thread(target=worker, args=(main.application, n, ops, expected, failures))
+             for n in range(threadCount)]
+  start = time.time()
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  seconds = time.time() - start
+  requests = threadCount * (ops + ops // 7 + (ops + 2) // 3)
+
+  import writebehind
+  writebehind.flush_all() # *all_tags* only lists buffered tags once they are written
+  tags = post(main.application, '/getvalue', {'tag': '*all_tags*'})[2]
+  expectedTags = sorted(expected.keys() + [sharedTag])
+  lost = [tag for tag in expectedTags if tag not in set(tags)]
+  extra = [tag for tag in tags if tag not in expected and tag != sharedTag]
+  wrong = []
+  for (tag, value) in expected.items():
+    if json.loads(main.entryText(main.store.get(tag)) or 'null') != value:
+      wrong.append(tag)
+  print('threads=%d requests=%d seconds=%.2f requests_per_second=%.0f tags=%d lost=%d extra=%d wrong=%d failures=%d'
+        % (threadCount, requests, seconds, requests / seconds, len(tags),
+           len(lost), len(extra), len(wrong), len(failures)))
+  for error in failures[:5]:
+    print('failure: %r' % (error,))
+  return not (lost or extra or wrong or failures)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Concurrent write stress run for the TinyWebDB service')
+  parser.add_argument('--threads', type=int, default=16)
+  parser.add_argument('--ops', type=int, default=200, help='writes per thread')
+  parser.add_argument('--storage', default='memory', help='TINYWEBDB_STORAGE engine spec')
+  args = parser.parse_args()
+  sys.exit(0 if run(args.threads, args.ops, args.storage) else 1)
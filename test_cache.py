@@ -0,0 +1,146 @@
+### Tests of the caches (cache.py): when VersionedCache keeps a result, and that
+### ValueCache never serves a value read before its tag was invalidated.
+###
+### Usage: python -m unittest test_cache
+
+import time
+import unittest
+
+import cache
+
+# Counts the calls of build, returning value from each
+class Builder(object):
+
+  def __init__(self, value):
+    self.value = value
+    self.calls = 0
+
+  def __call__(self):
+    self.calls += 1
+    return self.value
+
+class VersionedCacheTest(unittest.TestCase):
+
+  def test_result_is_kept_until_the_version_changes(self):
+    aggregates = cache.VersionedCache()
+    build = Builder(['a', 'b'])
+    self.assertEqual(aggregates.get('tags', 1, build), ['a', 'b'])
+    self.assertEqual(aggregates.get('tags', 1, build), ['a', 'b'])
+    self.assertEqual(build.calls, 1)
+    aggregates.get('tags', 2, build)
+    self.assertEqual(build.calls, 2)
+
+  def test_unknown_version_is_never_kept(self):
+    aggregates = cache.VersionedCache()
+    build = Builder(['a'])
+    aggregates.get('tags', None, build)
+    aggregates.get('tags', None, build)
+    self.assertEqual(build.calls, 2)
+    self.assertFalse(aggregates.settled('tags', None))
+
+  def test_result_is_only_kept_once_its_version_has_settled(self):
+    aggregates = cache.VersionedCache(settle=0.05)
+    build = Builder(['a'])
+    self.assertFalse(aggregates.settled('tags', 1))
+    aggregates.get('tags', 1, build)
+    aggregates.get('tags', 1, build)
+    self.assertEqual(build.calls, 2)
+    time.sleep(0.06)
+    self.assertTrue(aggregates.settled('tags', 1))
+    aggregates.get('tags', 1, build)
+    aggregates.get('tags', 1, build)
+    self.assertEqual(build.calls, 3)
+    self.assertFalse(aggregates.settled('tags', 2)) # A new version starts again
+
+  def test_stream_keeps_items_within_max_chars(self):
+    aggregates = cache.VersionedCache(max_chars=3 * cache.itemChars('x'))
+    self.assertEqual(list(aggregates.stream('entries', 1, iter(['x', 'y', 'z']))), ['x', 'y', 'z'])
+    self.assertEqual(list(aggregates.stream('entries', 1, iter([]))), ['x', 'y', 'z'])
+    self.assertEqual(list(aggregates.stream('more', 1, iter(['x', 'y', 'z', 'w']))), ['x', 'y', 'z', 'w'])
+    self.assertEqual(list(aggregates.stream('more', 1, iter([]))), [])
+
+  def test_least_recently_used_results_make_room(self):
+    aggregates = cache.VersionedCache(max_chars=2 * cache.itemChars('x'))
+    aggregates.get('a', 1, Builder(['x']))
+    aggregates.get('b', 1, Builder(['y']))
+    aggregates.get('a', 1, Builder(['never built']))
+    aggregates.get('c', 1, Builder(['z']))
+    self.assertEqual(aggregates.get('a', 1, Builder(['rebuilt'])), ['x'])
+    self.assertEqual(aggregates.get('b', 1, Builder(['rebuilt'])), ['rebuilt'])
+
+# The part of the memcache client that ValueCache uses, shared by the caches of
+# several instances
+class FakeMemcache(object):
+
+  def __init__(self):
+    self.values = {}
+
+  def get_multi(self, keys):
+    return dict((key, self.values[key]) for key in keys if key in self.values)
+
+  def add(self, key, value, time=0):
+    if key in self.values:
+      return False
+    self.values[key] = value
+    return True
+
+  def delete(self, key):
+    self.values.pop(key, None)
+
+  def delete_multi(self, keys, key_prefix=''):
+    for key in keys:
+      self.values.pop(key_prefix + key, None)
+
+  def offset_multi(self, mapping, key_prefix='', initial_value=None):
+    result = {}
+    for (key, delta) in mapping.items():
+      value = self.values.get(key_prefix + key, initial_value) + delta
+      self.values[key_prefix + key] = result[key] = value
+    return result
+
+class ValueCacheTest(unittest.TestCase):
+
+  def test_fill_after_a_local_invalidation_is_dropped(self):
+    values = cache.ValueCache()
+    token = values.token(['t'])
+    values.invalidate('t') # A write of t, after the old value was read
+    values.fill('t', 'old', token)
+    self.assertIs(values.get('t'), cache.MISSING)
+    token = values.token(['t'])
+    values.fill('t', 'new', token)
+    self.assertEqual(values.get('t'), 'new')
+
+  def test_late_fill_from_another_instance_is_not_served(self):
+    shared = FakeMemcache()
+    reader = cache.ValueCache(memcache_client=shared)
+    writer = cache.ValueCache(memcache_client=shared)
+    token = reader.token(['t']) # The reader reads the old value...
+    writer.invalidate('t') # ...while the writer stores a new one
+    reader.fill('t', 'old', token)
+    self.assertIs(writer.get('t'), cache.MISSING)
+    token = writer.token(['t'])
+    writer.fill('t', 'new', token)
+    self.assertEqual(cache.ValueCache(memcache_client=shared).get('t'), 'new')
+
+  def test_fill_does_not_replace_a_value_in_memcache(self):
+    shared = FakeMemcache()
+    first = cache.ValueCache(memcache_client=shared)
+    token = first.token(['t'])
+    first.fill('t', 'one', token)
+    cache.ValueCache(memcache_client=shared).fill('t', 'two', token)
+    self.assertEqual(cache.ValueCache(memcache_client=shared).get('t'), 'one')
+
+class LRUCacheTest(unittest.TestCase):
+
+  def test_bounded_by_chars(self):
+    rows = cache.LRUCache(max_chars=2 * cache.itemChars('x'))
+    rows.put('a', 'x')
+    rows.put('b', 'y')
+    rows.get('a')
+    rows.put('c', 'z')
+    self.assertEqual((rows.get('a'), rows.get('b'), rows.get('c')), ('x', None, 'z'))
+    rows.put('big', 'x' * 1000)
+    self.assertIsNone(rows.get('big'))
+
+if __name__ == '__main__':
+  unittest.main()
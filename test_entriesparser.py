@@ -0,0 +1,105 @@
+### Tests of the entries file parser (entriesparser.py) against the sample entries
+### files in sampleEntriesFiles, each of which is either a valid entries file or
+### shows one kind of problem.
+###
+### Usage: python -m unittest test_entriesparser
+
+import io
+import json
+import os
+import StringIO
+import unittest
+
+import entriesparser
+
+SAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sampleEntriesFiles')
+
+# The valid sample files, with the number of entries in each
+VALID = {
+  'entries.txt': 6,
+  'entriesWithANonListValue.txt': 5,
+  'entriesWithAllListValues.txt': 5,
+}
+
+# The invalid sample files, with the kind, line and column of their problem and
+# the number of entries yielded before it
+INVALID = {
+  'entriesEntryNotAList.txt': ('entry_not_a_list', 2, 1, 0),
+  'entriesEntryNotAPair.txt': ('entry_not_a_pair', 2, 1, 0),
+  'entriesEntryTagNotAString1.txt': ('entry_tag_not_a_string', 2, 1, 0),
+  'entriesEntryTagNotAString2.txt': ('entry_tag_not_a_string', 2, 1, 0),
+  'entriesEntryTagNotAString3.txt': ('entry_tag_not_a_string', 2, 1, 0),
+  'entriesMalformed1.txt': ('malformed', 7, 1, 4), # The list is never closed
+  'entriesMalformed2.txt': ('malformed', 4, 1, 2),
+  'entriesMalformed3.txt': ('malformed', 4, 1, 2),
+  'entriesMalformed4.txt': ('malformed', 4, 1, 2),
+  'entriesMalformed5.txt': ('malformed', 2, 1, 0), # An unquoted tag
+  'entriesMalformed6.txt': ('entry_not_a_list', 1, 2, 0), # No enclosing list
+  'entriesNotAList1.txt': ('database_not_a_list', 1, 1, 0),
+  'entriesNotAList2.txt': ('database_not_a_list', 1, 1, 0),
+  'entriesNotAList3.txt': ('database_not_a_list', 1, 1, 0),
+}
+
+def sampleText(name):
+  with io.open(os.path.join(SAMPLES, name), encoding='utf-8') as f:
+    return f.read()
+
+# Parse text, returning (entries, error), where error is the EntriesError raised (or None)
+def parse(text):
+  parser = entriesparser.EntriesParser(StringIO.StringIO(text))
+  entries = []
+  try:
+    for entry in parser.entries():
+      entries.append(entry)
+  except entriesparser.EntriesError as error:
+    return (entries, error)
+  return (entries, None)
+
+class SampleFilesTest(unittest.TestCase):
+
+  def test_every_sample_is_covered(self):
+    self.assertEqual(sorted(os.listdir(SAMPLES)), sorted(VALID.keys() + INVALID.keys()))
+
+  def test_valid_samples(self):
+    for (name, count) in sorted(VALID.items()):
+      (entries, error) = parse(sampleText(name))
+      self.assertIsNone(error, name)
+      self.assertEqual(len(entries), count, name)
+      self.assertEqual(entries, json.loads(sampleText(name)), name)
+
+  def test_invalid_samples(self):
+    for (name, (kind, line, column, count)) in sorted(INVALID.items()):
+      (entries, error) = parse(sampleText(name))
+      self.assertIsNotNone(error, name)
+      self.assertEqual((error.kind, error.line, error.column), (kind, line, column), name)
+      self.assertEqual(len(entries), count, name)
+
+# The same files (and strings with escaped quotes) read a few characters at a
+# time, so that every token is split across blocks somewhere
+class SmallBlocksTest(SampleFilesTest):
+
+  def setUp(self):
+    self.readSize = entriesparser.READ_SIZE
+    entriesparser.READ_SIZE = 3
+
+  def tearDown(self):
+    entriesparser.READ_SIZE = self.readSize
+
+  def test_escaped_quotes_across_blocks(self):
+    text = u'[["a\\"b", "c\\\\"], ["\\\\\\"", [1, "]"]],\n [" ", {"k": "\\u00e9"}]]'
+    for size in range(1, 8):
+      entriesparser.READ_SIZE = size
+      (entries, error) = parse(text)
+      self.assertIsNone(error, size)
+      self.assertEqual(entries, json.loads(text), size)
+
+  def test_error_position_after_block_boundaries(self):
+    text = u'[\n  ["one", 1],\n  ["two", 2],\n  [3, "three"]\n]'
+    for size in range(1, 8):
+      entriesparser.READ_SIZE = size
+      (entries, error) = parse(text)
+      self.assertEqual((error.kind, error.line, error.column), ('entry_tag_not_a_string', 4, 3), size)
+      self.assertEqual(len(entries), 2, size)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,100 @@
+### Tests of namespaces (namespaces.py): the entries of each are kept apart, and
+### route only accepts the namespaces allowed.
+###
+### Usage: python -m unittest test_namespaces
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import webob
+
+import namespaces
+import storage
+
+# Call the method of store in namespace, as route does for a request
+def inNamespace(name, store, method, *args):
+  namespaces.current.namespace = name
+  try:
+    return getattr(store, method)(*args)
+  finally:
+    namespaces.current.namespace = ''
+
+class IsolationTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.store = namespaces.NamespacedStorage(storage.SQLiteStorage(os.path.join(self.directory, 'tinywebdb.db')))
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_entries_are_kept_apart(self):
+    inNamespace('', self.store, 'put', 'color', '"red"')
+    inNamespace('app1', self.store, 'put', 'color', '"blue"')
+    inNamespace('app1', self.store, 'put', 'size', '1')
+    self.assertEqual(inNamespace('', self.store, 'get', 'color').value, '"red"')
+    self.assertEqual(inNamespace('app1', self.store, 'get', 'color').value, '"blue"')
+    self.assertIsNone(inNamespace('app2', self.store, 'get', 'color'))
+    self.assertEqual(inNamespace('', self.store, 'tags'), ['color'])
+    self.assertEqual(inNamespace('app1', self.store, 'tags'), ['color', 'size'])
+
+  def test_truncating_one_namespace_keeps_the_others(self):
+    inNamespace('', self.store, 'put', 'a', '1')
+    inNamespace('app1', self.store, 'put', 'a', '2')
+    inNamespace('app1', self.store, 'truncate', 100)
+    self.assertEqual(inNamespace('app1', self.store, 'tags'), [])
+    self.assertEqual(inNamespace('', self.store, 'tags'), ['a'])
+    self.assertIsNone(inNamespace('', self.store, 'truncated_at'))
+
+  def test_change_feeds_and_versions_are_kept_apart(self):
+    since = storage.datePosition(storage.EPOCH)
+    version = inNamespace('', self.store, 'version')
+    inNamespace('app1', self.store, 'put', 'a', '1')
+    self.assertEqual(inNamespace('', self.store, 'version'), version)
+    self.assertEqual(inNamespace('', self.store, 'changes', since)[0], [])
+    self.assertEqual([c.tag for c in inNamespace('app1', self.store, 'changes', since)[0]], ['a'])
+
+  def test_namespaces_are_listed(self):
+    inNamespace('app1', self.store, 'put', 'a', '1')
+    inNamespace('app.2', self.store, 'put', 'a', '1')
+    self.assertEqual(self.store.namespaces(), ['', 'app.2', 'app1'])
+    fresh = namespaces.NamespacedStorage(storage.SQLiteStorage(os.path.join(self.directory, 'tinywebdb.db')))
+    self.assertEqual(fresh.namespaces(), ['', 'app.2', 'app1'])
+
+def application(environ, start_response):
+  start_response('200 OK', [('Content-Type', 'text/plain')])
+  return [namespaces.namespace() + ' ' + environ['PATH_INFO']]
+
+class RouteTest(unittest.TestCase):
+
+  def get(self, routed, path):
+    response = webob.Request.blank(path).get_response(routed)
+    return (response.status_int, response.body)
+
+  def test_prefix_and_parameter(self):
+    routed = namespaces.route(application)
+    self.assertEqual(self.get(routed, '/ns/app1/getvalue'), (200, 'app1 /getvalue'))
+    self.assertEqual(self.get(routed, '/getvalue?namespace=app2'), (200, 'app2 /getvalue'))
+    self.assertEqual(self.get(routed, '/getvalue'), (200, ' /getvalue'))
+    self.assertEqual(self.get(routed, '/ns/app1')[0], 301)
+    self.assertEqual(self.get(routed, '/ns/a:b/getvalue')[0], 400)
+
+  def test_at_most_max_namespaces(self):
+    routed = namespaces.route(application, max_namespaces=2)
+    self.assertEqual(self.get(routed, '/ns/a/')[0], 200)
+    self.assertEqual(self.get(routed, '/ns/b/')[0], 200)
+    self.assertEqual(self.get(routed, '/ns/c/')[0], 403)
+    self.assertEqual(self.get(routed, '/?namespace=c')[0], 403)
+    self.assertEqual(self.get(routed, '/ns/a/')[0], 200)
+    self.assertEqual(self.get(routed, '/')[0], 200)
+
+  def test_only_those_allowed(self):
+    routed = namespaces.route(application, allowed=['a'])
+    self.assertEqual(self.get(routed, '/ns/a/')[0], 200)
+    self.assertEqual(self.get(routed, '/ns/b/')[0], 403)
+    self.assertEqual(self.get(routed, '/')[0], 200)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,97 @@
+### Tests of the change feed of the SQLite storage engine (storage.py): paging,
+### truncations and the pruning of tombstones.
+###
+### Usage: python -m unittest test_storage
+
+import datetime
+import unittest
+
+import storage
+
+def now():
+  return storage.datePosition(datetime.datetime.utcnow())
+
+# Read the whole change feed after position since, limit changes at a time,
+# returning (the changes, the last position, the truncation dates seen)
+def readFeed(engine, since, limit):
+  changes = []
+  truncations = []
+  while True:
+    (page, since, truncated) = engine.changes(since, limit)
+    if truncated is not None:
+      truncations.append(truncated)
+    if not page:
+      return (changes, since, truncations)
+    changes.extend(page)
+
+class ChangesTest(unittest.TestCase):
+
+  def setUp(self):
+    self.engine = storage.SQLiteStorage(':memory:')
+    self.start = now()
+
+  def test_pages_return_every_change_once_in_order(self):
+    for i in range(7):
+      self.engine.put('tag%d' % i, str(i))
+    self.engine.delete('tag3')
+    (changes, position, truncations) = readFeed(self.engine, self.start, 2)
+    self.assertEqual([(c.tag, c.value) for c in changes],
+                     [('tag%d' % i, str(i)) for i in range(7) if i != 3] + [('tag3', None)])
+    self.assertEqual(truncations, [])
+    self.assertEqual(self.engine.changes(position, 2)[0], [])
+
+  def test_changes_made_together_are_not_split(self):
+    self.engine.put_multi([('a', '1'), ('b', '2'), ('c', '3')])
+    (changes, position, truncated) = self.engine.changes(self.start, 2)
+    self.assertEqual([c.tag for c in changes], ['a', 'b', 'c'])
+
+  def test_unsettled_changes_wait(self):
+    self.engine.settle_seconds = 60
+    self.engine.put('a', '1')
+    self.assertEqual(self.engine.changes(self.start, 10), ([], self.start, None))
+
+  def test_paging_across_a_truncation(self):
+    for tag in 'abc':
+      self.engine.put(tag, '1')
+    (page, position, truncated) = self.engine.changes(self.start, 2)
+    self.assertEqual([c.tag for c in page], ['a', 'b'])
+    (count, tags, cursor) = self.engine.truncate(2)
+    self.engine.put('d', '2') # Stored while the truncation goes on
+    while cursor:
+      (count, tags, cursor) = self.engine.truncate(2, cursor)
+    self.engine.delete('d')
+    self.engine.put('e', '3')
+    (changes, position, truncations) = readFeed(self.engine, position, 1)
+    self.assertEqual(truncations, [self.engine.truncated_at()])
+    # Entries deleted by the truncation leave no tombstones; those stored since it started are kept
+    self.assertEqual([(c.tag, c.value) for c in changes], [('d', None), ('e', '3')])
+    self.assertEqual(self.engine.tags(), ['e'])
+
+  def test_pruned_tombstones_expire_older_positions(self):
+    self.engine.put('a', '1')
+    self.engine.delete('a')
+    self.engine.put('b', '2')
+    middle = now()
+    self.engine.delete('b')
+    before = storage.positionDate(middle)
+    self.assertEqual(self.engine.prune_tombstones(before, 10), (1, None))
+    self.assertEqual(self.engine.pruned_at(), before)
+    self.assertRaises(storage.PositionExpired, self.engine.changes, self.start, 10)
+    (changes, position, truncated) = self.engine.changes(middle, 10)
+    self.assertEqual([(c.tag, c.value) for c in changes], [('b', None)])
+
+  def test_pruning_goes_in_batches(self):
+    for i in range(5):
+      self.engine.put('tag%d' % i, '1')
+      self.engine.delete('tag%d' % i)
+    before = datetime.datetime.utcnow()
+    (count, cursor) = self.engine.prune_tombstones(before, 2)
+    pruned = count
+    while cursor:
+      (count, cursor) = self.engine.prune_tombstones(before, 2, cursor)
+      pruned += count
+    self.assertEqual(pruned, 5)
+    self.assertEqual(readFeed(self.engine, storage.datePosition(before), 10)[0], [])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,92 @@
+### Tests of write-behind buffering (writebehind.py) over an in-memory SQLite
+### storage engine (storage.py).
+###
+### Usage: python -m unittest test_writebehind
+
+import threading
+import unittest
+
+import storage
+import writebehind
+
+# A storage engine whose writes wait until release is set, after signalling started
+class SlowStorage(object):
+
+  def __init__(self, storage):
+    self.storage = storage
+    self.started = threading.Event()
+    self.release = threading.Event()
+    self.fail = False
+
+  def __getattr__(self, name):
+    return getattr(self.storage, name)
+
+  def write(self, puts, deletes, atomic=False):
+    self.started.set()
+    self.release.wait(5)
+    if self.fail:
+      raise RuntimeError('write failed')
+    return self.storage.write(puts, deletes, atomic)
+
+class FlushTest(unittest.TestCase):
+
+  def setUp(self):
+    self.slow = SlowStorage(storage.SQLiteStorage(':memory:'))
+    self.flushedTags = []
+    self.buffer = writebehind.WriteBehindStorage(self.slow, ['sensor:*'], 3600, 100,
+                                                 lambda namespace, tags : self.flushedTags.extend(tags))
+
+  def tearDown(self):
+    self.slow.release.set()
+    with writebehind.buffersLock:
+      writebehind.buffers.remove(self.buffer)
+
+  # Start flushing in another thread, returning it once the write is under way
+  def startFlush(self):
+    def flush():
+      try:
+        self.buffer.flush()
+      except RuntimeError:
+        pass
+    thread = threading.Thread(target=flush)
+    thread.start()
+    self.assertTrue(self.slow.started.wait(5))
+    return thread
+
+  def test_get_during_flush_sees_the_buffered_value(self):
+    self.slow.storage.put('sensor:1', '1')
+    self.buffer.put('sensor:1', '2')
+    thread = self.startFlush()
+    self.assertEqual(self.buffer.get('sensor:1').value, '2')
+    self.assertEqual(self.buffer.get_multi(['sensor:1'])[0].value, '2')
+    self.slow.release.set()
+    thread.join()
+    self.assertEqual(self.buffer.get('sensor:1').value, '2')
+    self.assertEqual(self.slow.storage.get('sensor:1').value, '2')
+    self.assertEqual(self.buffer.stats()['buffered'], 0)
+    self.assertEqual(self.flushedTags, ['sensor:1'])
+
+  def test_value_stored_during_flush_stays_buffered(self):
+    self.buffer.put('sensor:1', '1')
+    thread = self.startFlush()
+    self.buffer.put('sensor:1', '2')
+    self.slow.release.set()
+    thread.join()
+    self.assertEqual(self.buffer.get('sensor:1').value, '2')
+    self.assertEqual(self.slow.storage.get('sensor:1').value, '1')
+    self.assertEqual(self.buffer.stats()['buffered'], 1)
+
+  def test_failed_flush_keeps_the_values(self):
+    self.slow.storage.put('sensor:1', '1')
+    self.buffer.put('sensor:1', '2')
+    self.slow.fail = True
+    thread = self.startFlush()
+    self.assertEqual(self.buffer.get('sensor:1').value, '2')
+    self.slow.release.set()
+    thread.join()
+    self.assertEqual(self.buffer.get('sensor:1').value, '2')
+    self.assertEqual(self.slow.storage.get('sensor:1').value, '1')
+    self.assertEqual(self.flushedTags, [])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,137 @@
+### Request tracing for the TinyWebDB service.
+###
+### Every request gets a trace, a list of spans: the parts of its work (parsing,
+### storage calls, writing the response) with their start and duration and a
+### few attributes, such as a short preview of a value. Recording a span costs
+### little, and nothing is logged for most requests. A trace is only logged
+###   + for a random sample of requests (TINYWEBDB_TRACE_SAMPLE, the fraction
+###     of requests sampled, 0.01 by default), and
+###   + for every request that took at least TINYWEBDB_SLOW_REQUEST_SECONDS
+###     (1 by default). The last slowRequestsKept of these are also kept for
+###     /slowrequests. Time spent waiting (see waiting) does not count.
+### The request itself is traced by metrics.instrument.
+
+import collections
+import contextlib
+import logging
+import os
+import random
+import threading
+import time
+
+sampleRate = float(os.environ.get('TINYWEBDB_TRACE_SAMPLE', '0.01'))
+slowRequestSeconds = float(os.environ.get('TINYWEBDB_SLOW_REQUEST_SECONDS', '1'))
+
+# The most spans a trace records, and the most characters of a value a preview shows
+MAX_SPANS = 1000
+PREVIEW_LENGTH = 100
+
+slowRequestsKept = 100
+slowRequests = collections.deque(maxlen=slowRequestsKept) # The latest slow request summaries
+
+class Trace(object):
+
+  def __init__(self, method, path, sampled):
+    self.method = method
+    self.path = path
+    self.sampled = sampled
+    self.start = time.time()
+    self.spans = [] # (name, start, seconds, attributes)
+    self.dropped = 0 # Spans not recorded, beyond MAX_SPANS
+    self.waited = 0.0 # Seconds spent waiting rather than working
+
+  def add(self, name, start, seconds, attributes):
+    if len(self.spans) < MAX_SPANS:
+      self.spans.append((name, start, seconds, attributes))
+    else:
+      self.dropped += 1
+
+  # A JSON-friendly description of the trace, with times in milliseconds
+  # from the start of the request
+  def summary(self, handler, status, seconds):
+    spans = []
+    for (name, start, spanSeconds, attributes) in self.spans:
+      span = {'name': name, 'start_ms': milliseconds(start - self.start), 'ms': milliseconds(spanSeconds)}
+      span.update(attributes)
+      spans.append(span)
+    return {'method': self.method, 'path': self.path, 'handler': handler, 'status': status,
+            'time': time.strftime('%m/%d/%Y %H:%M:%S', time.gmtime(self.start)),
+            'ms': milliseconds(seconds), 'waited_ms': milliseconds(self.waited),
+            'spans': spans, 'dropped_spans': self.dropped}
+
+# The trace of the request being handled by this thread
+current = threading.local()
+
+# Start tracing a request
+def begin(method, path):
+  trace = Trace(method, path, random.random() < sampleRate)
+  current.trace = trace
+  return trace
+
+# Finish tracing a request (once its response has been sent), logging the
+# trace if the request was sampled or slow
+def end(trace, handler, status):
+  if getattr(current, 'trace', None) is trace:
+    current.trace = None
+  seconds = time.time() - trace.start
+  slow = seconds - trace.waited >= slowRequestSeconds
+  if not (slow or trace.sampled):
+    return
+  summary = trace.summary(handler, status, seconds)
+  if slow:
+    slowRequests.append(summary)
+    logging.warning('slow request: %s', describe(summary))
+  else:
+    logging.info('trace: %s', describe(summary))
+
+# Record the code in a with statement as a span of the current trace, if any
+@contextlib.contextmanager
+def span(name, **attributes):
+  trace = getattr(current, 'trace', None)
+  if trace is None:
+    yield
+    return
+  start = time.time()
+  try:
+    yield
+  finally:
+    trace.add(name, start, time.time() - start, attributes)
+
+# Record the code in a with statement as a 'wait' span of the current trace, if
+# any: time the request spends waiting for something to happen (such as a change
+# for a long poll), which does not make it slow
+@contextlib.contextmanager
+def waiting(**attributes):
+  trace = getattr(current, 'trace', None)
+  start = time.time()
+  try:
+    with span('wait', **attributes):
+      yield
+  finally:
+    if trace is not None:
+      trace.waited += time.time() - start
+
+# Record a span that has already ended
+def record(name, start, seconds, **attributes):
+  trace = getattr(current, 'trace', None)
+  if trace is not None:
+    trace.add(name, start, seconds, attributes)
+
+# The start of value (a string, or anything with a repr) for logs and spans
+def preview(value, length=PREVIEW_LENGTH):
+  text = value if isinstance(value, basestring) else repr(value)
+  if len(text) > length:
+    return text[:length] + '... (%d characters)' % len(text)
+  return text
+
+# One line describing a trace summary
+def describe(summary):
+  spans = '; '.join('%s %.1fms%s' % (span['name'], span['ms'],
+                                     ''.join(' %s=%s' % (key, span[key]) for key in sorted(span)
+                                             if key not in ('name', 'start_ms', 'ms')))
+                    for span in summary['spans'])
+  return '%s %s (%s) %s %.1fms: %s' % (summary['method'], summary['path'], summary['handler'],
+                                       summary['status'], summary['ms'], spans)
+
+def milliseconds(seconds):
+  return round(seconds * 1000, 3)
@@ -0,0 +1,298 @@
+### Write-behind buffering of frequently stored tags for the TinyWebDB service.
+###
+### Apps that store the same few tags several times a second (sensor readings,
+### game state) can have those stores buffered rather than written at once.
+### TINYWEBDB_WRITE_BEHIND is a comma separated list of tag patterns (in fnmatch
+### syntax, e.g. "sensor:*,game:state"); when it is set, the storage engine is
+### wrapped in a WriteBehindStorage, and a single store (put) of a matching tag
+### only records the latest value of the tag in a buffer. Lookups of the tag are
+### answered from the buffer. The buffer is written out in one batched write
+###   + once its oldest value has waited TINYWEBDB_WRITE_BEHIND_INTERVAL seconds
+###     (1 by default), checked on every storage call and, where the process may
+###     run one, by a flusher thread every quarter of that interval,
+###   + as soon as it holds TINYWEBDB_WRITE_BEHIND_SIZE tags (100 by default),
+###   + by flush_all, called by /flushwrites, when the process exits and, on
+###     App Engine instances that get one, from the shutdown hook.
+### A flush that fails is logged, and leaves the values in the buffer for the next
+### one; only a direct call of flush raises the error.
+###
+### Durability: a buffered value is only in the memory of the instance that took
+### it (0 as the interval writes every store through, as without buffering).
+###   + Outside App Engine, and on App Engine instances with manual or basic scaling
+###     (which may run background threads), the flusher thread writes it out within
+###     about 1.25 times the interval, so if the instance dies without shutting
+###     down, that much of the last stores of matching tags is lost.
+###   + On App Engine instances with automatic scaling there is no flusher thread and
+###     no shutdown hook. A value is written out only when the instance next makes
+###     a storage call once it is due, fills its buffer, or serves /flushwrites, so
+###     an instance that gets no more requests holds it for as long as it lives,
+###     and loses it when it is shut down. Only buffer values that may be lost there.
+### Other instances, and every read other than a lookup of the tag (*all_...* tags,
+### /getprefix, the change feed, exports), see a buffered value only once it has
+### been written.
+###
+### Any other write that involves a matching tag (batch stores, deletes,
+### truncation) first drops the tag from the buffer, waiting for a flush under
+### way, so a buffered value never overwrites a later one.
+
+import atexit
+import datetime
+import fnmatch
+import logging
+import threading
+import time
+
+from storage import Entry, Future, finished
+
+try:
+  from google.appengine.api import runtime
+except ImportError:
+  runtime = None # Outside App Engine, buffers are only flushed at exit
+
+try:
+  from google.appengine.api import background_thread
+except ImportError:
+  background_thread = None # Outside App Engine, the flusher is a daemon thread
+
+# The buffers of every namespace, for flush_all and stats
+buffers = []
+buffersLock = threading.Lock()
+
+# Whether the flusher thread has been started (None until it is first tried)
+flusher = None
+
+# Wraps storage (a storage engine, see storage.py) in a WriteBehindStorage
+# buffering the tags matching patterns (a comma separated string), or returns it
+# as it is if there are none. Once buffered values have been written, flushed
+# (if given) is called with the namespace and the tags, so that caches of what
+# was read while they were buffered can be dropped.
+def wrap(storage, patterns, interval=1, max_size=100, flushed=None):
+  patterns = [p.strip() for p in (patterns or '').split(',') if p.strip()]
+  if not patterns:
+    return storage
+  return WriteBehindStorage(storage, patterns, interval, max_size, flushed)
+
+class WriteBehindStorage(object):
+
+  def __init__(self, storage, patterns, interval, max_size, flushed=None, namespace=''):
+    self.storage = storage
+    self.patterns = patterns
+    self.interval = interval
+    self.max_size = max_size
+    self.on_flush = flushed
+    self.namespace = namespace
+    self.lock = threading.Lock() # Guards the buffer
+    self.flushing = threading.Lock() # Held while buffered values are written out
+    self.buffer = {} # tag -> Entry with the latest value stored
+    self.oldest = None # When the oldest buffered value was stored
+    self.puts = 0
+    self.coalesced = 0 # Buffered values replaced by a later one before being written
+    self.flushes = 0
+    self.flushed = 0
+    with buffersLock:
+      buffers.append(self)
+
+  def __getattr__(self, name):
+    attribute = getattr(self.storage, name)
+    if callable(attribute) and not name.startswith('_'):
+      self.flush_if_due()
+    return attribute
+
+  def buffered(self, tag):
+    return any(fnmatch.fnmatchcase(tag, pattern) for pattern in self.patterns)
+
+  def for_namespace(self, namespace):
+    if not namespace:
+      return self
+    return WriteBehindStorage(self.storage.for_namespace(namespace), self.patterns, self.interval, self.max_size,
+                              self.on_flush, namespace)
+
+  def get(self, tag):
+    self.flush_if_due()
+    with self.lock:
+      entry = self.buffer.get(tag)
+    if entry is not None:
+      return entry
+    return self.storage.get(tag)
+
+  def get_multi(self, tags):
+    return self.get_multi_async(tags).get_result()
+
+  def get_multi_async(self, tags):
+    self.flush_if_due()
+    tags = list(tags)
+    with self.lock:
+      found = dict((tag, self.buffer[tag]) for tag in tags if tag in self.buffer)
+    missing = [tag for tag in tags if tag not in found]
+    lookup = self.storage.get_multi_async(missing)
+    def wait():
+      found.update(zip(missing, lookup.get_result()))
+      return [found[tag] for tag in tags]
+    return Future(wait)
+
+  # The only write that is buffered
+  def put(self, tag, value):
+    if not self.buffered(tag) or self.interval <= 0:
+      return self.put_multi([(tag, value)])[0]
+    entry = Entry(tag, value, datetime.datetime.utcnow())
+    with self.lock:
+      if tag in self.buffer:
+        self.coalesced += 1
+      elif not self.buffer:
+        self.oldest = time.time()
+      self.buffer[tag] = entry
+      self.puts += 1
+      full = len(self.buffer) >= self.max_size
+    if flusher is None:
+      startFlusher(self.interval)
+    if full:
+      self.flush_quietly()
+    else:
+      self.flush_if_due()
+    return entry
+
+  def put_multi(self, pairs):
+    return self.write(pairs, [])
+
+  def delete(self, tag):
+    self.delete_multi([tag])
+
+  def delete_multi(self, tags):
+    self.write([], tags)
+
+  def write(self, puts, deletes, atomic=False):
+    return self.write_async(puts, deletes, atomic).get_result()
+
+  def write_async(self, puts, deletes, atomic=False):
+    self.flush_if_due()
+    tags = [tag for tag in [tag for (tag, value) in puts] + list(deletes) if self.buffered(tag)]
+    if not tags:
+      return self.storage.write_async(puts, deletes, atomic)
+    with self.flushing:
+      self.discard(tags)
+      return finished(self.storage.write, puts, deletes, atomic)
+
+  def truncate(self, batch_size, cursor=None):
+    if cursor is None:
+      with self.flushing:
+        self.discard(None)
+        return self.storage.truncate(batch_size, cursor)
+    return self.storage.truncate(batch_size, cursor)
+
+  # Drop tags (all of them if None) from the buffer. Must hold self.flushing.
+  def discard(self, tags):
+    with self.lock:
+      if tags is None:
+        self.buffer.clear()
+      else:
+        for tag in tags:
+          self.buffer.pop(tag, None)
+      if not self.buffer:
+        self.oldest = None
+
+  # Flush if the oldest buffered value has waited interval seconds. Called on the
+  # way to other storage work, so a failure is only logged (by flush).
+  def flush_if_due(self):
+    oldest = self.oldest
+    if oldest is not None and time.time() - oldest >= self.interval:
+      self.flush_quietly()
+
+  def flush_quietly(self):
+    try:
+      self.flush()
+    except Exception:
+      pass # Logged by flush; the values stay buffered for the next flush
+
+  # Write out the buffered values in one batched write, returning how many there
+  # were. They stay in the buffer (and so are what lookups get) until the write has
+  # finished, and are then dropped unless they have been stored again meanwhile.
+  # If the write fails, they are retried by a later flush, an interval on.
+  def flush(self):
+    with self.flushing:
+      with self.lock:
+        entries = self.buffer.values()
+      if not entries:
+        return 0
+      started = time.time()
+      try:
+        self.storage.write([(e.tag, e.value) for e in entries], [])
+      except Exception:
+        logging.exception('write-behind flush of %d tags failed', len(entries))
+        with self.lock:
+          self.oldest = time.time()
+        raise
+      with self.lock:
+        for e in entries:
+          if self.buffer.get(e.tag) is e:
+            del self.buffer[e.tag]
+        self.oldest = started if self.buffer else None # Stored since the flush started
+        self.flushes += 1
+        self.flushed += len(entries)
+    if self.on_flush is not None:
+      self.on_flush(self.namespace, [e.tag for e in entries])
+    return len(entries)
+
+  def stats(self):
+    with self.lock:
+      return {'buffered': len(self.buffer), 'puts': self.puts, 'coalesced': self.coalesced,
+              'flushes': self.flushes, 'flushed': self.flushed}
+
+# Write out every buffer, returning the number of values written
+def flush_all():
+  with buffersLock:
+    current = list(buffers)
+  flushed = 0
+  for buffer in current:
+    try:
+      flushed += buffer.flush()
+    except Exception:
+      pass # Logged by flush; carry on with the other buffers
+  return flushed
+
+# The counters of all buffers added up, with the settings of the first one
+def stats():
+  with buffersLock:
+    current = list(buffers)
+  total = {'buffered': 0, 'puts': 0, 'coalesced': 0, 'flushes': 0, 'flushed': 0}
+  for buffer in current:
+    for (key, value) in buffer.stats().items():
+      total[key] += value
+  if current:
+    total.update({'patterns': current[0].patterns, 'interval': current[0].interval,
+                  'max_size': current[0].max_size, 'flusher': bool(flusher)})
+  return total
+
+# Start the thread that flushes the buffers that are due every quarter of interval
+# (see the top of this file), unless it has been tried already. On App Engine it is
+# a background thread, which only instances with manual or basic scaling may run.
+def startFlusher(interval):
+  global flusher
+  with buffersLock:
+    if flusher is not None:
+      return
+    flusher = False
+  try:
+    if background_thread is not None:
+      background_thread.start_new_background_thread(flushDue, [interval / 4.0])
+    else:
+      thread = threading.Thread(target=flushDue, args=(interval / 4.0,))
+      thread.daemon = True
+      thread.start()
+    flusher = True
+  except Exception as error:
+    logging.info('info:write-behind has no flusher thread (%s); buffers are flushed by requests' % error)
+
+def flushDue(period):
+  try:
+    while True:
+      time.sleep(period)
+      with buffersLock:
+        current = list(buffers)
+      for buffer in current:
+        buffer.flush_if_due()
+  except Exception:
+    pass # The interpreter is shutting down (flush_if_due raises nothing else)
+
+atexit.register(flush_all)
+if runtime is not None:
+  runtime.set_shutdown_hook(lambda : flush_all())